@@ -5,33 +5,145 @@ Soporta entradas multimodales: texto, audio e imágenes.
 """
 
 import os
+import asyncio
 import base64
+import mmap
+import io
+import shutil
+import stat
+import sys
+import subprocess
 import tempfile
 import json
-from typing import TypedDict, Annotated, Literal, Optional, List, Dict, Any
+import logging
+import random
+import re
+import hashlib
+import time
+import threading
+import functools
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TypedDict, Annotated, Literal, Optional, List, Dict, Any, Tuple
 from dotenv import load_dotenv
+from pydantic import BaseModel, Field
 
-# Importar pydub para conversión de audio (opcional, solo si está instalado)
+# Importar Pillow para reducir imágenes grandes antes de enviarlas a Vision (opcional)
 try:
-    from pydub import AudioSegment
-    PYDUB_AVAILABLE = True
+    from PIL import Image
+    PIL_AVAILABLE = True
 except ImportError:
-    PYDUB_AVAILABLE = False
+    PIL_AVAILABLE = False
+
+# Importar orjson para serializar la salida de las herramientas (opcional, más rápido que json)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, AIMessage, BaseMessage, SystemMessage
+from langchain_core.messages import HumanMessage, AIMessage, BaseMessage, SystemMessage, ToolMessage, message_chunk_to_message
 from langchain_core.tools import tool
+from langchain_core.rate_limiters import InMemoryRateLimiter
 from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import ToolNode
 from langgraph.graph.message import add_messages
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, RateLimitError, pydantic_function_tool
 
-# Cargar variables de entorno
-# Buscar .env en el directorio actual y en el directorio padre
-load_dotenv()  # Busca en el directorio actual (despense-agent/)
-load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))  # Busca en el directorio padre
+import prompts
+from prompts import ESTADOS_VALIDOS, TOOL_TRANSCRIBIR, TOOL_IMAGEN, compose_system, ejemplos_relevantes
+
+# Los mensajes de diagnóstico van por logging en lugar de print: en producción no
+# se emiten (ni se formatean) salvo que la aplicación configure un handler
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
+
+# ============================================================================
+# ENTORNO Y CLIENTES (inicialización diferida)
+# ============================================================================
+# Nada se carga ni se conecta al importar el módulo: el .env y los clientes se
+# inicializan en el primer uso. Así importar es rápido y las pruebas pueden
+# ajustar variables de entorno o reemplazar los clientes antes de usarlos.
+@functools.lru_cache(maxsize=1)
+def _cargar_entorno() -> None:
+    """Carga las variables de entorno desde .env (una sola vez)."""
+    # Buscar .env en el directorio actual y en el directorio padre
+    load_dotenv()  # Busca en el directorio actual (despense-agent/)
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))  # Busca en el directorio padre
+
+
+@functools.lru_cache(maxsize=1)
+def get_openai_client() -> OpenAI:
+    """Retorna el cliente de OpenAI para APIs multimodales, creándolo en el primer uso."""
+    _cargar_entorno()
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_openai_async_client() -> AsyncOpenAI:
+    """Versión asíncrona de `get_openai_client`."""
+    _cargar_entorno()
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+
+# ============================================================================
+# LÍMITE DE TASA PARA LLAMADAS A OPENAI
+# ============================================================================
+# Un único token bucket por proceso, compartido por todas las herramientas, el
+# LLM del agente y los caminos síncrono y asíncrono. Si aun así OpenAI responde
+# 429, se reintenta con backoff exponencial con jitter antes de mostrar el error.
+_MAX_REINTENTOS_429 = 3
+
+
+@functools.lru_cache(maxsize=1)
+def _rate_limiter() -> InMemoryRateLimiter:
+    """Token bucket dimensionado según OPENAI_RPM (peticiones por minuto del plan)."""
+    _cargar_entorno()
+    rpm = float(os.getenv("OPENAI_RPM", "500"))
+    return InMemoryRateLimiter(
+        requests_per_second=rpm / 60,
+        check_every_n_seconds=0.05,
+        max_bucket_size=max(1.0, rpm / 60),
+    )
+
+
+def _rebobinar_archivo(kwargs: Dict[str, Any]) -> None:
+    """Vuelve al inicio el archivo a subir, para que un reintento lo envíe completo."""
+    archivo = kwargs.get("file")
+    if hasattr(archivo, "seek"):
+        archivo.seek(0)
+
+
+def _rate_limited_call(fn, *args, **kwargs):
+    """Ejecuta una llamada a OpenAI respetando el token bucket y reintentando ante 429."""
+    for intento in range(_MAX_REINTENTOS_429 + 1):
+        _rate_limiter().acquire()
+        try:
+            return fn(*args, **kwargs)
+        except RateLimitError:
+            if intento == _MAX_REINTENTOS_429:
+                raise
+            espera = 2 ** intento + random.random()
+            _log.warning("⚠️  Límite de tasa de OpenAI, reintentando en %.1f s", espera)
+            time.sleep(espera)
+            _rebobinar_archivo(kwargs)
+
+
+async def _arate_limited_call(fn, *args, **kwargs):
+    """Versión asíncrona de `_rate_limited_call`."""
+    for intento in range(_MAX_REINTENTOS_429 + 1):
+        await _rate_limiter().aacquire()
+        try:
+            return await fn(*args, **kwargs)
+        except RateLimitError:
+            if intento == _MAX_REINTENTOS_429:
+                raise
+            espera = 2 ** intento + random.random()
+            _log.warning("⚠️  Límite de tasa de OpenAI, reintentando en %.1f s", espera)
+            await asyncio.sleep(espera)
+            _rebobinar_archivo(kwargs)
 
-# Inicializar cliente de OpenAI para APIs multimodales
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # ============================================================================
 # BASE DE DATOS SIMULADA (Diccionario global)
@@ -47,9 +159,398 @@ DESPENSA_DB = {
 }
 
 
+def _normalizar_producto(datos: Any) -> Dict[str, Any]:
+    """
+    Convierte una entrada de la despensa al esquema {"stock", "unidad", "estado"}.
+    Las entradas en formato antiguo (solo el estado como string) quedan con stock 0.
+    """
+    if isinstance(datos, dict):
+        return {
+            "stock": datos.get("stock", 0),
+            "unidad": datos.get("unidad", "unidad"),
+            "estado": datos.get("estado", "MEDIO"),
+        }
+    return {"stock": 0, "unidad": "unidad", "estado": str(datos)}
+
+
+def _es_bajo_stock(datos: Dict[str, Any]) -> bool:
+    """Indica si un producto debe aparecer en la lista de compras."""
+    return datos["estado"] == "BAJO" or datos["stock"] == 0
+
+
+# Todas las entradas comparten el mismo esquema, así el resto del código no
+# necesita distinguir entre formatos
+DESPENSA_DB = {nombre: _normalizar_producto(datos) for nombre, datos in DESPENSA_DB.items()}
+
+# Índice de productos con bajo stock, mantenido en cada actualización para que la
+# lista de compras no tenga que recorrer toda la despensa
+_LOW_STOCK: set[str] = {nombre for nombre, datos in DESPENSA_DB.items() if _es_bajo_stock(datos)}
+
+# Búsqueda insensible a tildes: "azucar" encuentra "azúcar". Se indexa cada
+# nombre sin tildes hacia su clave real en la despensa
+_ACCENT_TABLE = str.maketrans("áéíóúüñ", "aeiouun")
+_DB_KEY_FOLDED: Dict[str, str] = {nombre.translate(_ACCENT_TABLE): nombre for nombre in DESPENSA_DB}
+
+
+def _resolver_nombre(item_name: str) -> str:
+    """Retorna la clave de la despensa que corresponde a un nombre, ignorando mayúsculas y tildes."""
+    item_name_lower = item_name.lower().strip()
+    return _DB_KEY_FOLDED.get(item_name_lower.translate(_ACCENT_TABLE), item_name_lower)
+
+# Versión de la despensa: se incrementa cada vez que DESPENSA_DB cambia, de modo
+# que las respuestas cacheadas quedan invalidadas automáticamente
+_DB_VERSION = 0
+
+# Candado para escrituras concurrentes (varias llamadas a run_agent en paralelo).
+# Las escrituras y los recorridos completos lo toman; las lecturas de un solo
+# producto no lo necesitan porque cada actualización reemplaza la entrada entera.
+_DB_LOCK = threading.RLock()
+
+
+# ============================================================================
+# CACHÉ DE RESPUESTAS (prompt -> respuesta)
+# ============================================================================
+_RESPONSE_CACHE_MAX = 256
+# Las respuestas expiran: aunque la despensa no cambie, un saludo o una consulta
+# cacheada no debería repetirse tal cual indefinidamente
+_RESPONSE_CACHE_TTL = 300
+_RESPONSE_CACHE: "OrderedDict[tuple, Tuple[float, str]]" = OrderedDict()
+_RESPONSE_CACHE_LOCK = threading.Lock()
+_PUNTUACION_RE = re.compile(r"[^\w\s]")
+_ESPACIOS_RE = re.compile(r"\s+")
+
+
+def _normalizar_consulta(texto: str) -> str:
+    """
+    Normaliza el texto del usuario para usarlo como clave de caché
+    (minúsculas, sin puntuación y con espacios colapsados).
+    """
+    texto = _PUNTUACION_RE.sub(" ", texto.lower())
+    return _ESPACIOS_RE.sub(" ", texto).strip()
+
+
+def _clave_cache(user_input: str, chat_history: Optional[list]) -> tuple:
+    """
+    Construye la clave de caché a partir del input, el final del historial y la
+    versión de la BD. Se usan los últimos mensajes (no el largo del historial)
+    porque los historiales acotados dejan de crecer: dos conversaciones distintas
+    con el mismo largo no deben compartir respuestas.
+    """
+    historial = chat_history or ()
+    cola = tuple(str(getattr(mensaje, "content", mensaje)) for mensaje in list(historial)[-2:])
+    return (_normalizar_consulta(user_input), len(historial), hash(cola), _DB_VERSION)
+
+
+def _cache_get(clave: tuple) -> Optional[str]:
+    with _RESPONSE_CACHE_LOCK:
+        entrada = _RESPONSE_CACHE.get(clave)
+        if entrada is None:
+            return None
+        expira, respuesta = entrada
+        if expira < time.monotonic():
+            del _RESPONSE_CACHE[clave]
+            return None
+        _RESPONSE_CACHE.move_to_end(clave)
+        return respuesta
+
+
+def _cache_put(clave: tuple, respuesta: str) -> None:
+    with _RESPONSE_CACHE_LOCK:
+        _RESPONSE_CACHE[clave] = (time.monotonic() + _RESPONSE_CACHE_TTL, respuesta)
+        _RESPONSE_CACHE.move_to_end(clave)
+        if len(_RESPONSE_CACHE) > _RESPONSE_CACHE_MAX:
+            _RESPONSE_CACHE.popitem(last=False)
+
+
+# ============================================================================
+# CACHÉ DE ARCHIVOS MULTIMEDIA (por hash de contenido)
+# ============================================================================
+# Transcripciones y análisis de imágenes se memorizan por el hash del archivo
+# (más la versión de modelos y prompts), así un mismo audio/foto reenviado no
+# vuelve a llamar a Whisper o Vision. Además se persisten en disco para
+# reutilizarlos entre procesos.
+_MEDIA_CACHE_MAX = 512
+_MEDIA_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_MEDIA_CACHE_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1)
+def _media_cache_dir() -> str:
+    """Directorio de la caché multimedia en disco (configurable con DESPENSA_CACHE_DIR)."""
+    _cargar_entorno()
+    return os.path.expanduser(os.getenv("DESPENSA_CACHE_DIR", "~/.despensa_cache"))
+
+
+def _hash_archivo(path: str) -> str:
+    """Calcula el hash BLAKE2b (128 bits) del contenido de un archivo leyéndolo por bloques."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(bloque)
+    return digest.hexdigest()
+
+
+def _hash_bytes(datos: bytes) -> str:
+    """Calcula el hash BLAKE2b (128 bits) de un contenido ya leído en memoria."""
+    return hashlib.blake2b(datos, digest_size=16).hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def _version_cache_multimedia() -> str:
+    """
+    Huella de todo lo que determina un resultado cacheado: modelos, prompts y
+    esquema del extracto. Forma parte de la clave, así que cambiar cualquiera de
+    ellos deja de reutilizar los resultados anteriores sin borrar la caché a mano.
+    """
+    huella = json.dumps([
+        _WHISPER_MODEL, _VISION_MODEL, _VISION_PROMPT,
+        os.getenv("EXTRACTION_MODEL", _EXTRACTION_CLOUD_MODEL), _EXTRACT_SYSTEM,
+        AnalisisImagen.model_json_schema(),
+    ], sort_keys=True, ensure_ascii=False)
+    return _hash_bytes(huella.encode("utf-8"))[:8]
+
+
+def _resultado_cacheado_valido(resultado: str) -> bool:
+    """
+    Verifica que un resultado persistido siga teniendo la forma del extracto actual
+    y que no sea el respaldo de una extracción fallida (versiones anteriores lo
+    guardaban en caché como si fuera un resultado válido).
+    """
+    try:
+        extracto = ExtractoProductos.model_validate(_loads(resultado)["extracto_estructurado"])
+    except (ValueError, KeyError, TypeError):
+        return False
+    return extracto.intencion != _INTENCION_ERROR
+
+
+def _media_cache_get(digest: str) -> Optional[str]:
+    """Busca un resultado en la caché en memoria y, si no está, en disco."""
+    clave = f"{digest}-{_version_cache_multimedia()}"
+    with _MEDIA_CACHE_LOCK:
+        resultado = _MEDIA_CACHE.get(clave)
+        if resultado is not None:
+            _MEDIA_CACHE.move_to_end(clave)
+            return resultado
+    
+    ruta = os.path.join(_media_cache_dir(), f"{clave}.txt")
+    try:
+        with open(ruta, "r", encoding="utf-8") as f:
+            resultado = f.read()
+    except OSError:
+        return None
+    
+    # Un archivo corrupto o de un esquema anterior se descarta en vez de llegar al agente
+    if not _resultado_cacheado_valido(resultado):
+        _log.warning("⚠️  Resultado inválido en la caché multimedia, se descarta: %s", ruta)
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+        return None
+    
+    _media_cache_put(digest, resultado, persistir=False)
+    return resultado
+
+
+def _media_cache_put(digest: str, resultado: str, persistir: bool = True) -> None:
+    """Guarda un resultado en la caché en memoria (LRU acotada) y opcionalmente en disco."""
+    clave = f"{digest}-{_version_cache_multimedia()}"
+    with _MEDIA_CACHE_LOCK:
+        _MEDIA_CACHE[clave] = resultado
+        _MEDIA_CACHE.move_to_end(clave)
+        if len(_MEDIA_CACHE) > _MEDIA_CACHE_MAX:
+            _MEDIA_CACHE.popitem(last=False)
+    
+    if persistir:
+        try:
+            os.makedirs(_media_cache_dir(), exist_ok=True)
+            with open(os.path.join(_media_cache_dir(), f"{clave}.txt"), "w", encoding="utf-8") as f:
+                f.write(resultado)
+        except OSError as e:
+            _log.warning("⚠️  No se pudo persistir la caché multimedia: %s", e)
+
+
+# Análisis en curso por hash (single-flight): si llega el mismo archivo mientras
+# otro hilo ya lo está procesando, se espera ese resultado en vez de repetir la llamada
+_MEDIA_EN_CURSO: Dict[str, Future] = {}
+_MEDIA_EN_CURSO_LOCK = threading.Lock()
+
+
+def _una_sola_vez(digest: str, calcular) -> str:
+    """
+    Ejecuta `calcular()` para un archivo solo si ningún otro hilo lo está haciendo
+    ya; los hilos que llegan después reciben el mismo resultado.
+    """
+    with _MEDIA_EN_CURSO_LOCK:
+        futuro = _MEDIA_EN_CURSO.get(digest)
+        lider = futuro is None
+        if lider:
+            futuro = _MEDIA_EN_CURSO[digest] = Future()
+    if not lider:
+        _log.debug("⏳ Archivo idéntico en proceso, esperando su resultado")
+        return futuro.result()
+    
+    try:
+        # Otro hilo pudo terminar entre la consulta a la caché y tomar el turno
+        resultado = _media_cache_get(digest)
+        if resultado is None:
+            resultado = calcular()
+        futuro.set_result(resultado)
+        return resultado
+    except BaseException as e:
+        futuro.set_exception(e)
+        raise
+    finally:
+        with _MEDIA_EN_CURSO_LOCK:
+            del _MEDIA_EN_CURSO[digest]
+
+
+async def _auna_sola_vez(digest: str, acalcular) -> str:
+    """
+    Versión asíncrona de `_una_sola_vez` (comparte el registro, así que también
+    deduplica contra el camino síncrono): espera el resultado sin bloquear el event loop.
+    """
+    with _MEDIA_EN_CURSO_LOCK:
+        futuro = _MEDIA_EN_CURSO.get(digest)
+        lider = futuro is None
+        if lider:
+            futuro = _MEDIA_EN_CURSO[digest] = Future()
+    if not lider:
+        _log.debug("⏳ Archivo idéntico en proceso, esperando su resultado")
+        return await asyncio.wrap_future(futuro)
+    
+    try:
+        resultado = _media_cache_get(digest)
+        if resultado is None:
+            resultado = await acalcular()
+        futuro.set_result(resultado)
+        return resultado
+    except BaseException as e:
+        futuro.set_exception(e)
+        raise
+    finally:
+        with _MEDIA_EN_CURSO_LOCK:
+            del _MEDIA_EN_CURSO[digest]
+
+
 # ============================================================================
 # EXTRACCIÓN ESTRUCTURADA DE PRODUCTOS
 # ============================================================================
+class ProductoExtraido(BaseModel):
+    """Producto mencionado por el usuario."""
+    nombre: str = Field(description="Nombre del producto en singular y minúsculas")
+    cantidad: Optional[int] = Field(description="Cantidad mencionada, o null si no se indica")
+    unidad: str = Field(description="Unidad de medida (unidad, kg, litro, paquete, etc.). Usa 'unidad' si no se menciona")
+
+
+class ExtractoProductos(BaseModel):
+    """Información estructurada extraída de un mensaje del usuario."""
+    accion: Literal["UPDATE", "CREATE", "QUERY", "SHOPPING_LIST"] = Field(description="Acción que el usuario quiere realizar")
+    productos: List[ProductoExtraido] = Field(description="Productos mencionados con sus cantidades")
+    intencion: str = Field(description="Descripción breve de la intención del usuario")
+
+
+class AnalisisImagen(ExtractoProductos):
+    """Extracto estructurado obtenido directamente del análisis de una imagen."""
+    descripcion: str = Field(description="Resumen breve de los productos visibles en la imagen")
+
+
+# Instrucciones fijas de extracción. Van siempre como mensaje de sistema, idénticas
+# entre llamadas, y el texto del usuario va aparte: así el prefijo es estable y
+# OpenAI puede reutilizarlo con su caché automática de prompts.
+_EXTRACT_SYSTEM = """Analiza el texto del usuario y extrae información estructurada sobre productos de despensa.
+
+Acciones posibles:
+- "UPDATE": Actualizar stock de productos existentes (ej: "tengo 3 manzanas", "me quedan 2 leches")
+- "CREATE": Crear nuevos productos (ej: "agregué plátanos", "compré galletas nuevas")
+- "QUERY": Consultar productos (ej: "¿qué tengo?", "¿cuántas manzanas tengo?")
+- "SHOPPING_LIST": Generar lista de compras (ej: "¿qué me falta?", "¿qué debo comprar?")"""
+
+# La extracción es una tarea acotada (clasificar + parsear), así que puede
+# delegarse a un modelo más pequeño, incluso local, mediante cualquier servidor
+# compatible con la API de OpenAI (vLLM, llama.cpp, Ollama...)
+_EXTRACTION_CLOUD_MODEL = "gpt-4o-mini"
+
+
+@functools.lru_cache(maxsize=1)
+def _llms_extraccion():
+    """
+    Crea los clientes de extracción en el primer uso. La salida estructurada
+    garantiza que la respuesta cumple el esquema, sin limpiar bloques markdown
+    ni parsear JSON a mano.
+    
+    Returns:
+        Tupla (modelo, llm, llm_nube). `llm_nube` es el respaldo en la nube y solo
+        existe si la extracción apunta a un servidor propio (EXTRACTION_BASE_URL)
+    """
+    _cargar_entorno()
+    modelo = os.getenv("EXTRACTION_MODEL", _EXTRACTION_CLOUD_MODEL)
+    base_url = os.getenv("EXTRACTION_BASE_URL") or None
+    
+    llm = ChatOpenAI(
+        model=modelo,
+        base_url=base_url,
+        api_key=os.getenv("EXTRACTION_API_KEY") or None,
+        temperature=0,
+        seed=0,
+        # Un servidor propio no comparte el límite de tasa de OpenAI
+        rate_limiter=None if base_url else _rate_limiter(),
+    ).with_structured_output(ExtractoProductos, method="json_schema")
+    
+    llm_nube = ChatOpenAI(model=_EXTRACTION_CLOUD_MODEL, temperature=0, seed=0, rate_limiter=_rate_limiter()).with_structured_output(
+        ExtractoProductos, method="json_schema"
+    ) if base_url else None
+    
+    return modelo, llm, llm_nube
+
+
+# Extractos ya calculados por texto: una misma transcripción o análisis de imagen
+# (reintentos, webhooks reenviados) no vuelve a llamar al LLM
+_EXTRACT_CACHE_MAX = 512
+_EXTRACT_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_EXTRACT_CACHE_LOCK = threading.Lock()
+
+
+def _copiar_extracto(extracto: Dict[str, Any]) -> Dict[str, Any]:
+    """Copia un extracto cacheado para que quien lo reciba pueda modificarlo sin alterar la caché."""
+    return {**extracto, "productos": [dict(producto) for producto in extracto.get("productos", [])]}
+
+
+def _extract_cache_get(texto: str) -> Optional[Dict[str, Any]]:
+    """Busca el extracto de un texto en la caché y retorna una copia, o None."""
+    with _EXTRACT_CACHE_LOCK:
+        extracto_cacheado = _EXTRACT_CACHE.get(texto)
+        if extracto_cacheado is None:
+            return None
+        _EXTRACT_CACHE.move_to_end(texto)
+    _log.debug("⚡ Extracción obtenida desde caché")
+    return _copiar_extracto(extracto_cacheado)
+
+
+def _extract_cache_put(texto: str, extracto: Dict[str, Any]) -> None:
+    """Guarda un extracto exitoso en la caché (los errores no se cachean y se reintentan)."""
+    copia = _copiar_extracto(extracto)
+    with _EXTRACT_CACHE_LOCK:
+        _EXTRACT_CACHE[texto] = copia
+        _EXTRACT_CACHE.move_to_end(texto)
+        if len(_EXTRACT_CACHE) > _EXTRACT_CACHE_MAX:
+            _EXTRACT_CACHE.popitem(last=False)
+
+
+# Pool propio para las extracciones en lote síncronas (`run_agent_bulk` con bulk=False):
+# cada texto es una llamada independiente al LLM y se solapan entre sí
+_EXTRACTION_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="despensa-extraccion")
+
+# Intención del extracto de respaldo cuando la extracción falla. Ese extracto
+# nunca se cachea: un error transitorio no debe quedar guardado para siempre
+_INTENCION_ERROR = "error al procesar"
+
+
+def _extracto_error() -> Dict[str, Any]:
+    """Extracto de respaldo (consulta vacía) para cuando la extracción falla."""
+    return {"accion": "QUERY", "productos": [], "intencion": _INTENCION_ERROR}
+
+
 def extraer_productos_desde_texto(texto: str) -> Dict[str, Any]:
     """
     Extrae información estructurada de productos y cantidades desde texto transcrito.
@@ -69,179 +570,207 @@ def extraer_productos_desde_texto(texto: str) -> Dict[str, Any]:
             "intencion": "actualizar stock" | "consultar" | "crear productos" | "lista de compras"
         }
     """
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-    
-    prompt = f"""Analiza el siguiente texto del usuario y extrae información estructurada sobre productos de despensa.
-
-Texto del usuario: "{texto}"
-
-Extrae:
-1. La ACCIÓN que el usuario quiere realizar:
-   - "UPDATE": Actualizar stock de productos existentes (ej: "tengo 3 manzanas", "me quedan 2 leches")
-   - "CREATE": Crear nuevos productos (ej: "agregué plátanos", "compré galletas nuevas")
-   - "QUERY": Consultar productos (ej: "¿qué tengo?", "¿cuántas manzanas tengo?")
-   - "SHOPPING_LIST": Generar lista de compras (ej: "¿qué me falta?", "¿qué debo comprar?")
-
-2. Los PRODUCTOS mencionados con sus cantidades:
-   - Para cada producto, extrae: nombre, cantidad (número), unidad (unidad/kg/litro/paquete/etc)
-   - Si no se menciona cantidad, usa null
-   - Si no se menciona unidad, usa "unidad" por defecto
-
-3. La INTENCIÓN general del usuario
-
-Responde SOLO con un JSON válido en este formato exacto:
-{{
-    "accion": "UPDATE" | "CREATE" | "QUERY" | "SHOPPING_LIST",
-    "productos": [
-        {{"nombre": "nombre_producto", "cantidad": número_o_null, "unidad": "unidad"}},
-        ...
-    ],
-    "intencion": "descripción breve de la intención"
-}}
-
-Ejemplos:
-
-Usuario: "tengo 1 plátano, 3 manzanas, 1 leche, 2 galletas"
-{{
-    "accion": "UPDATE",
-    "productos": [
-        {{"nombre": "plátano", "cantidad": 1, "unidad": "unidad"}},
-        {{"nombre": "manzana", "cantidad": 3, "unidad": "unidad"}},
-        {{"nombre": "leche", "cantidad": 1, "unidad": "litro"}},
-        {{"nombre": "galleta", "cantidad": 2, "unidad": "paquete"}}
-    ],
-    "intencion": "actualizar stock de productos existentes"
-}}
-
-Usuario: "¿qué me falta comprar?"
-{{
-    "accion": "SHOPPING_LIST",
-    "productos": [],
-    "intencion": "generar lista de productos que faltan"
-}}
-
-Usuario: "compré plátanos y galletas nuevas"
-{{
-    "accion": "CREATE",
-    "productos": [
-        {{"nombre": "plátano", "cantidad": null, "unidad": "unidad"}},
-        {{"nombre": "galleta", "cantidad": null, "unidad": "paquete"}}
-    ],
-    "intencion": "crear nuevos productos en la despensa"
-}}
-
-Responde SOLO con el JSON, sin texto adicional:"""
+    extracto = _extraer_productos(texto)
+    return extracto if extracto is not None else _extracto_error()
+
 
+def _extraer_productos(texto: str) -> Optional[Dict[str, Any]]:
+    """Como `extraer_productos_desde_texto`, pero retorna None si la extracción falla."""
+    extracto_cacheado = _extract_cache_get(texto)
+    if extracto_cacheado is not None:
+        return extracto_cacheado
+    
+    mensajes = [SystemMessage(content=_EXTRACT_SYSTEM), HumanMessage(content=texto)]
     try:
-        response = llm.invoke(prompt)
-        contenido = response.content.strip()
-        
-        # Limpiar el contenido si tiene markdown code blocks
-        if contenido.startswith("```json"):
-            contenido = contenido.replace("```json", "").replace("```", "").strip()
-        elif contenido.startswith("```"):
-            contenido = contenido.replace("```", "").strip()
-        
-        # Parsear JSON
-        resultado = json.loads(contenido)
+        modelo, llm, llm_nube = _llms_extraccion()
+        try:
+            resultado = llm.invoke(mensajes).model_dump()
+        except Exception as e:
+            if llm_nube is None:
+                raise
+            # El modelo local no respondió o no respetó el esquema: reintentar en la nube
+            _log.warning("⚠️  Extracción con %s falló (%s), usando %s", modelo, e, _EXTRACTION_CLOUD_MODEL)
+            resultado = llm_nube.invoke(mensajes).model_dump()
         
         # Logging simplificado - solo información esencial
-        print(f"📦 Extracción: {resultado.get('accion')} - {len(resultado.get('productos', []))} producto(s)")
+        _log.debug("📦 Extracción: %s - %s producto(s)", resultado.get('accion'), len(resultado.get('productos', [])))
         
+        _extract_cache_put(texto, resultado)
         return resultado
         
-    except json.JSONDecodeError as e:
-        print(f"⚠️  Error parseando JSON: {e}")
-        print(f"   Contenido recibido: {contenido[:200]}")
-        # Retornar estructura por defecto
-        return {
-            "accion": "QUERY",
-            "productos": [],
-            "intencion": "no se pudo extraer información estructurada"
-        }
     except Exception as e:
-        print(f"❌ Error extrayendo productos: {e}")
-        return {
-            "accion": "QUERY",
-            "productos": [],
-            "intencion": "error al procesar"
-        }
+        _log.error("❌ Error extrayendo productos: %s", e)
+        return None
+
+
+async def _aextraer_productos(texto: str) -> Optional[Dict[str, Any]]:
+    """Versión asíncrona de `_extraer_productos` (comparte la caché)."""
+    extracto_cacheado = _extract_cache_get(texto)
+    if extracto_cacheado is not None:
+        return extracto_cacheado
+    
+    mensajes = [SystemMessage(content=_EXTRACT_SYSTEM), HumanMessage(content=texto)]
+    try:
+        modelo, llm, llm_nube = _llms_extraccion()
+        try:
+            resultado = (await llm.ainvoke(mensajes)).model_dump()
+        except Exception as e:
+            if llm_nube is None:
+                raise
+            _log.warning("⚠️  Extracción con %s falló (%s), usando %s", modelo, e, _EXTRACTION_CLOUD_MODEL)
+            resultado = (await llm_nube.ainvoke(mensajes)).model_dump()
+        
+        _log.debug("📦 Extracción: %s - %s producto(s)", resultado.get('accion'), len(resultado.get('productos', [])))
+        
+        _extract_cache_put(texto, resultado)
+        return resultado
+    
+    except Exception as e:
+        _log.error("❌ Error extrayendo productos: %s", e)
+        return None
+
+
+@functools.lru_cache(maxsize=1)
+def _plantilla_linea_batch() -> Tuple[str, str]:
+    """
+    Serializa una sola vez la parte fija del cuerpo de cada request del batch
+    (modelo, esquema de salida y el mensaje de sistema, que es lo más largo de
+    escapar). Retorna el JSON que va antes y después del contenido del usuario.
+    """
+    esquema = pydantic_function_tool(ExtractoProductos)["function"]
+    cuerpo_fijo = _dumps({
+        "model": _EXTRACTION_CLOUD_MODEL,
+        "temperature": 0,
+        "seed": 0,
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": esquema["name"], "schema": esquema["parameters"], "strict": True},
+        },
+    })
+    mensaje_sistema = _dumps({"role": "system", "content": _EXTRACT_SYSTEM})
+    prefijo = f'{cuerpo_fijo[:-1]},"messages":[{mensaje_sistema},{{"role":"user","content":'
+    return prefijo, "}]}"
+
+
+def _extraer_productos_batch(textos: List[str], intervalo_sondeo: float = 30.0) -> List[Dict[str, Any]]:
+    """
+    Extrae productos de varios textos usando la Batch API de OpenAI (mitad de costo,
+    pero con latencia de minutos a horas). Pensado solo para cargas masivas.
+    
+    Args:
+        textos: Textos del usuario a procesar
+        intervalo_sondeo: Segundos entre consultas del estado del batch
+    
+    Returns:
+        Lista de extractos en el mismo orden que `textos`
+    """
+    # Un request por línea; custom_id permite reordenar los resultados. Solo el
+    # id y el texto del usuario cambian entre líneas: el resto ya viene serializado
+    prefijo_cuerpo, sufijo_cuerpo = _plantilla_linea_batch()
+    lineas = [
+        f'{{"custom_id":"{i}","method":"POST","url":"/v1/chat/completions","body":'
+        f'{prefijo_cuerpo}{_dumps(texto)}{sufijo_cuerpo}}}'
+        for i, texto in enumerate(textos)
+    ]
+    client = get_openai_client()
+    archivo = client.files.create(
+        file=("extraccion.jsonl", "\n".join(lineas).encode("utf-8")),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=archivo.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    _log.debug("📦 Batch %s enviado con %s texto(s)", batch.id, len(textos))
+    
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(intervalo_sondeo)
+        batch = client.batches.retrieve(batch.id)
+    
+    extractos = [_extracto_error() for _ in textos]
+    if batch.status != "completed" or not batch.output_file_id:
+        _log.error("❌ Batch %s terminó con estado %s", batch.id, batch.status)
+        return extractos
+    
+    for linea in client.files.content(batch.output_file_id).text.splitlines():
+        if not linea.strip():
+            continue
+        item = _loads(linea)
+        try:
+            contenido = item["response"]["body"]["choices"][0]["message"]["content"]
+            extractos[int(item["custom_id"])] = ExtractoProductos.model_validate_json(contenido).model_dump()
+        except Exception as e:
+            _log.error("❌ Error en resultado %s del batch: %s", item.get('custom_id'), e)
+    
+    return extractos
 
 
 # ============================================================================
 # ESTADO DEL GRAFO
 # ============================================================================
 class AgentState(TypedDict):
-    """Estado del agente que mantiene el historial de conversación, input del usuario y archivos multimedia."""
+    """
+    Estado del agente que mantiene el historial de conversación y el input del
+    usuario. Los archivos multimedia se procesan antes de entrar al grafo y su
+    resultado llega como un mensaje más.
+    """
     messages: Annotated[list[BaseMessage], add_messages]
     user_input: str
-    media_file_path: Optional[str]  # Ruta del archivo multimedia (audio o imagen)
+    _system_injected: bool  # True si el SystemMessage ya está al inicio de `messages`
 
 
 # ============================================================================
-# HERRAMIENTAS (TOOLS)
+# SERIALIZACIÓN JSON
 # ============================================================================
-@tool
-def consultar_despensa(item_name: str) -> str:
-    """
-    Consulta el estado actual de un ítem en la despensa.
-    
-    Args:
-        item_name: Nombre del ítem a consultar (ej: "leche", "huevos")
-    
-    Returns:
-        JSON string con información del producto o mensaje de error
-    """
-    item_name_lower = item_name.lower().strip()
+def _dumps(obj: Any) -> str:
+    """Serializa a JSON (UTF-8 sin escapar), usando orjson si está disponible."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def _loads(data: str) -> Any:
+    """Parsea JSON, usando orjson si está disponible."""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# ============================================================================
+# OPERACIONES SOBRE LA DESPENSA
+# ============================================================================
+# Las herramientas son envoltorios delgados sobre estas funciones, que trabajan
+# con diccionarios. Así el procesamiento de extractos las llama directamente sin
+# pasar por la maquinaria de LangChain ni serializar/parsear JSON por producto.
+def _consultar_item(item_name: str) -> Dict[str, Any]:
+    """Consulta un ítem de la despensa y retorna el resultado como diccionario."""
+    item_name_lower = _resolver_nombre(item_name)
     producto = DESPENSA_DB.get(item_name_lower)
     
     if producto is None:
-        return json.dumps({
+        return {
             "accion": "QUERY",
             "producto": item_name,
             "encontrado": False,
             "mensaje": f"El ítem '{item_name}' no está registrado en la despensa."
-        }, ensure_ascii=False)
-    
-    # Compatibilidad con formato antiguo y nuevo
-    if isinstance(producto, dict):
-        resultado = {
-            "accion": "QUERY",
-            "producto": item_name,
-            "encontrado": True,
-            "stock": producto.get("stock"),
-            "unidad": producto.get("unidad", "unidad"),
-            "estado": producto.get("estado", "MEDIO"),
-            "mensaje": f"El producto '{item_name}' tiene {producto.get('stock', 0)} {producto.get('unidad', 'unidad')} y está en estado {producto.get('estado', 'MEDIO')}"
-        }
-    else:
-        # Formato antiguo (solo estado)
-        resultado = {
-            "accion": "QUERY",
-            "producto": item_name,
-            "encontrado": True,
-            "estado": producto,
-            "mensaje": f"El estado de '{item_name}' es: {producto}"
         }
     
-    return json.dumps(resultado, ensure_ascii=False)
+    return {
+        "accion": "QUERY",
+        "producto": item_name,
+        "encontrado": True,
+        "stock": producto["stock"],
+        "unidad": producto["unidad"],
+        "estado": producto["estado"],
+        "mensaje": f"El producto '{item_name}' tiene {producto['stock']} {producto['unidad']} y está en estado {producto['estado']}"
+    }
 
 
-@tool
-def actualizar_despensa(item_name: str, cantidad: Optional[int] = None, unidad: Optional[str] = None, estado: Optional[str] = None) -> str:
-    """
-    Actualiza o crea un producto en la despensa con información estructurada.
-    
-    Args:
-        item_name: Nombre del producto
-        cantidad: Cantidad de stock (opcional)
-        unidad: Unidad de medida (opcional, default: "unidad")
-        estado: Estado del producto "BAJO", "MEDIO", "ALTO" (opcional, se calcula si no se proporciona)
-    
-    Returns:
-        JSON string con información de la actualización
-    """
-    item_name_lower = item_name.lower().strip()
+def _update_item(item_name: str, cantidad: Optional[int] = None, unidad: Optional[str] = None, estado: Optional[str] = None) -> Dict[str, Any]:
+    """Actualiza o crea un ítem de la despensa y retorna el resultado como diccionario."""
+    global _DB_VERSION
+    item_name_lower = _resolver_nombre(item_name)
     unidad = unidad or "unidad"
     
     # Calcular estado basado en cantidad si no se proporciona
@@ -258,96 +787,142 @@ def actualizar_despensa(item_name: str, cantidad: Optional[int] = None, unidad:
     estado_upper = estado.upper().strip()
     
     # Validar que el estado sea válido
-    estados_validos = ["BAJO", "MEDIO", "ALTO"]
-    if estado_upper not in estados_validos:
-        return json.dumps({
+    if estado_upper not in ESTADOS_VALIDOS:
+        return {
             "accion": "UPDATE",
             "producto": item_name,
             "exito": False,
             "error": f"Estado '{estado}' no válido. Use: BAJO, MEDIO o ALTO"
-        }, ensure_ascii=False)
-    
-    # Verificar si el producto ya existe
-    producto_existente = DESPENSA_DB.get(item_name_lower)
-    es_nuevo = producto_existente is None
+        }
     
-    # Actualizar o crear el producto
-    DESPENSA_DB[item_name_lower] = {
-        "stock": cantidad if cantidad is not None else (producto_existente.get("stock", 0) if isinstance(producto_existente, dict) else 0),
-        "unidad": unidad,
-        "estado": estado_upper
-    }
+    with _DB_LOCK:
+        # Verificar si el producto ya existe
+        producto_existente = DESPENSA_DB.get(item_name_lower)
+        es_nuevo = producto_existente is None
+        
+        # Actualizar o crear el producto
+        datos = {
+            "stock": cantidad if cantidad is not None else (producto_existente["stock"] if producto_existente else 0),
+            "unidad": unidad,
+            "estado": estado_upper
+        }
+        DESPENSA_DB[item_name_lower] = datos
+        if es_nuevo:
+            _DB_KEY_FOLDED[item_name_lower.translate(_ACCENT_TABLE)] = item_name_lower
+        if _es_bajo_stock(datos):
+            _LOW_STOCK.add(item_name_lower)
+        else:
+            _LOW_STOCK.discard(item_name_lower)
+        _DB_VERSION += 1
     
     resultado = {
         "accion": "CREATE" if es_nuevo else "UPDATE",
         "producto": item_name,
         "exito": True,
-        "stock": cantidad if cantidad is not None else DESPENSA_DB[item_name_lower]["stock"],
+        "stock": datos["stock"],
         "unidad": unidad,
         "estado": estado_upper,
-        "mensaje": f"{'✅ Creado' if es_nuevo else '✅ Actualizado'}: '{item_name}' ahora tiene {cantidad if cantidad is not None else DESPENSA_DB[item_name_lower]['stock']} {unidad} (estado: {estado_upper})"
+        "mensaje": f"{'✅ Creado' if es_nuevo else '✅ Actualizado'}: '{item_name}' ahora tiene {datos['stock']} {unidad} (estado: {estado_upper})"
     }
     
-    return json.dumps(resultado, ensure_ascii=False)
+    return resultado
+
 
+def _actualizar_batch(productos: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Aplica en una sola pasada las actualizaciones de una lista de productos extraídos
+    (cada uno con "nombre", "cantidad" y "unidad") y retorna sus resultados.
+    El lote se aplica de forma atómica respecto de otras escrituras.
+    """
+    with _DB_LOCK:
+        return [
+            _update_item(producto.get("nombre"), producto.get("cantidad"), producto.get("unidad", "unidad"))
+            for producto in productos
+        ]
 
+
+# ============================================================================
+# HERRAMIENTAS (TOOLS)
+# ============================================================================
 @tool
-def procesar_extracto_productos(extracto_json: str) -> str:
+def consultar_despensa(item_name: str) -> str:
     """
-    Procesa un extracto estructurado de productos y ejecuta las acciones correspondientes.
+    Consulta el estado actual de un ítem en la despensa.
     
     Args:
-        extracto_json: JSON string con la estructura extraída de productos
+        item_name: Nombre del ítem a consultar (ej: "leche", "huevos")
     
     Returns:
-        JSON string con el resultado de todas las operaciones
+        JSON string con información del producto o mensaje de error
+    """
+    return _dumps(_consultar_item(item_name))
+
+
+@tool
+def actualizar_despensa(item_name: str, cantidad: Optional[int] = None, unidad: Optional[str] = None, estado: Optional[Literal["BAJO", "MEDIO", "ALTO"]] = None) -> str:
+    """
+    Actualiza o crea un producto en la despensa con información estructurada.
+    
+    Args:
+        item_name: Nombre del producto
+        cantidad: Cantidad de stock (opcional)
+        unidad: Unidad de medida (opcional, default: "unidad")
+        estado: "ALTO" si lo compró o agregó, "BAJO" si se acabó, "MEDIO" si queda poco
+            (opcional, se calcula a partir de la cantidad si no se proporciona)
+    
+    Returns:
+        JSON string con información de la actualización
+    """
+    return _dumps(_update_item(item_name, cantidad, unidad, estado))
+
+
+# Acciones de un extracto que escriben en la despensa
+_ACCIONES_ESCRITURA = frozenset({"UPDATE", "CREATE"})
+
+
+def _error_extracto(error: Exception) -> Dict[str, Any]:
+    """Resultado de `_procesar_extracto` cuando el extracto no se pudo procesar."""
+    return {
+        "accion": "ERROR",
+        "error": str(error),
+        "mensaje": f"Error procesando extracto: {str(error)}"
+    }
+
+
+def _procesar_extracto(extracto: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Procesa un extracto estructurado de productos (ya como dict) y ejecuta las
+    acciones correspondientes. Es el núcleo de `procesar_extracto_productos`, para
+    que el código que ya tiene el dict en memoria no lo serialice y reparsee.
+    
+    Returns:
+        Dict con el resultado de todas las operaciones
     """
     try:
-        extracto = json.loads(extracto_json) if isinstance(extracto_json, str) else extracto_json
         accion = extracto.get("accion")
         productos = extracto.get("productos", [])
         
-        print(f"🔄 Procesando extracto: {accion} - {len(productos)} producto(s)")
+        _log.debug("🔄 Procesando extracto: %s - %s producto(s)", accion, len(productos))
         
         resultados = []
         
-        if accion == "UPDATE" or accion == "CREATE":
-            for producto in productos:
-                nombre = producto.get("nombre")
-                cantidad = producto.get("cantidad")
-                unidad = producto.get("unidad", "unidad")
-                
-                # Actualizar o crear producto
-                resultado_actualizacion = json.loads(actualizar_despensa.invoke({
-                    "item_name": nombre,
-                    "cantidad": cantidad,
-                    "unidad": unidad
-                }))
-                resultados.append(resultado_actualizacion)
+        if accion in _ACCIONES_ESCRITURA:
+            # Actualizar o crear todos los productos en una sola pasada
+            resultados.extend(_actualizar_batch(productos))
         
         elif accion == "QUERY":
             if productos:
                 # Consultar productos específicos
                 for producto in productos:
                     nombre = producto.get("nombre")
-                    resultado_consulta = json.loads(consultar_despensa.invoke({"item_name": nombre}))
-                    resultados.append(resultado_consulta)
+                    resultados.append(_consultar_item(nombre))
             else:
                 # Consulta general - retornar todos los productos
-                todos_productos = []
-                for nombre, datos in DESPENSA_DB.items():
-                    if isinstance(datos, dict):
-                        todos_productos.append({
-                            "nombre": nombre,
-                            "stock": datos.get("stock"),
-                            "unidad": datos.get("unidad"),
-                            "estado": datos.get("estado")
-                        })
-                    else:
-                        todos_productos.append({
-                            "nombre": nombre,
-                            "estado": datos
-                        })
+                with _DB_LOCK:
+                    todos_productos = [
+                        {"nombre": nombre, **datos}
+                        for nombre, datos in DESPENSA_DB.items()
+                    ]
                 
                 resultados.append({
                     "accion": "QUERY",
@@ -357,22 +932,20 @@ def procesar_extracto_productos(extracto_json: str) -> str:
                 })
         
         elif accion == "SHOPPING_LIST":
-            # Generar lista de productos con bajo stock
-            productos_bajo_stock = []
-            for nombre, datos in DESPENSA_DB.items():
-                if isinstance(datos, dict):
-                    if datos.get("estado") == "BAJO" or datos.get("stock", 0) == 0:
-                        productos_bajo_stock.append({
-                            "nombre": nombre,
-                            "stock_actual": datos.get("stock", 0),
-                            "unidad": datos.get("unidad"),
-                            "estado": datos.get("estado")
-                        })
-                elif datos == "BAJO":
-                    productos_bajo_stock.append({
-                        "nombre": nombre,
-                        "estado": datos
-                    })
+            # Generar lista de productos con bajo stock desde el índice. Se toma una
+            # instantánea bajo el candado y se arma la respuesta fuera de él: la lista
+            # puede quedar levemente desactualizada, a cambio de no bloquear escrituras
+            with _DB_LOCK:
+                instantanea = [(nombre, DESPENSA_DB[nombre]) for nombre in sorted(_LOW_STOCK)]
+            productos_bajo_stock = [
+                {
+                    "nombre": nombre,
+                    "stock_actual": datos["stock"],
+                    "unidad": datos["unidad"],
+                    "estado": datos["estado"]
+                }
+                for nombre, datos in instantanea
+            ]
             
             resultados.append({
                 "accion": "SHOPPING_LIST",
@@ -386,21 +959,314 @@ def procesar_extracto_productos(extracto_json: str) -> str:
             "total_operaciones": len(resultados)
         }
         
-        print(f"✅ Procesamiento completado: {len(resultados)} operación(es)")
+        _log.debug("✅ Procesamiento completado: %s operación(es)", len(resultados))
         
-        return json.dumps(resultado_final, ensure_ascii=False)
+        return resultado_final
         
     except Exception as e:
-        return json.dumps({
-            "accion": "ERROR",
-            "error": str(e),
-            "mensaje": f"Error procesando extracto: {str(e)}"
-        }, ensure_ascii=False)
+        return _error_extracto(e)
+
+
+@tool
+def procesar_extracto_productos(extracto_json: str) -> str:
+    """
+    Procesa un extracto estructurado de productos y ejecuta las acciones correspondientes.
+    
+    Args:
+        extracto_json: JSON string con la estructura extraída de productos
+    
+    Returns:
+        JSON string con el resultado de todas las operaciones
+    """
+    try:
+        extracto = _loads(extracto_json) if isinstance(extracto_json, str) else extracto_json
+    except ValueError as e:
+        return _dumps(_error_extracto(e))
+    return _dumps(_procesar_extracto(extracto))
 
 
 # ============================================================================
 # HERRAMIENTAS MULTIMODALES (TOOLS)
 # ============================================================================
+_WHISPER_MODEL = "whisper-1"
+_VISION_MODEL = "gpt-4o-mini"  # Usar gpt-4o-mini para costos más bajos
+
+
+def _precheck(path: str, exts: frozenset, max_mb: Optional[float], tipo: str) -> Tuple[str, int]:
+    """
+    Valida existencia, tipo, extensión y tamaño de un archivo multimedia con un solo
+    `os.stat`. Retorna la extensión y el tamaño en bytes.
+    
+    Raises:
+        FileNotFoundError: Si el archivo no existe
+        ValueError: Si no es un archivo regular, el formato no es soportado o es demasiado grande
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"El archivo de {tipo} '{path}' no existe.") from None
+    
+    if not stat.S_ISREG(st.st_mode):
+        raise ValueError(f"'{path}' no es un archivo válido.")
+    
+    file_ext = os.path.splitext(path)[1].lower()
+    if file_ext not in exts:
+        raise ValueError(f"Formato de archivo '{file_ext}' no soportado. Formatos válidos: {', '.join(sorted(exts))}")
+    
+    if max_mb is not None and st.st_size > max_mb * 1024 * 1024:
+        raise ValueError(f"El archivo es demasiado grande ({st.st_size / (1024 * 1024):.2f} MB). El máximo es {max_mb} MB.")
+    
+    return file_ext, st.st_size
+
+
+def _validar_audio(audio_file_path: str) -> Tuple[str, bytes]:
+    """
+    Valida el archivo de audio y retorna su extensión y su contenido. El archivo se
+    lee una sola vez: el tamaño, el hash, la conversión con ffmpeg y la subida a
+    Whisper trabajan sobre los mismos bytes.
+    
+    Raises:
+        FileNotFoundError: Si el archivo no existe
+        ValueError: Si el formato no es soportado o el archivo es demasiado grande
+    """
+    # Nota: Whisper soporta: mp3, mp4, mpeg, mpga, m4a, wav, webm
+    # WhatsApp envía audios en formato .ogg (OGG Opus), que necesitamos convertir.
+    # Máximo 25 MB para Whisper; los audios más grandes se dividen en segmentos con
+    # ffmpeg, así que solo se rechazan si no está instalado
+    file_ext, _ = _precheck(audio_file_path, _WHISPER_EXTS, None if _FFMPEG_OK else _WHISPER_MAX_MB, "audio")
+    
+    with open(audio_file_path, "rb") as f:
+        datos = f.read()
+    
+    return file_ext, datos
+
+
+def _omitir_subida_directa(datos: bytes) -> bool:
+    """
+    Los OGG Opus (notas de voz de WhatsApp) son justamente los que Whisper rechaza,
+    así que se convierten de inmediato sin gastar un viaje de ida y vuelta a la API.
+    """
+    global _OGG_DIRECTO_OMITIDOS
+    if not _es_ogg_opus(datos):
+        return False
+    _OGG_DIRECTO_OMITIDOS += 1
+    _log.debug("🔄 OGG Opus detectado, se convierte directamente (subidas directas omitidas: %s)", _OGG_DIRECTO_OMITIDOS)
+    return True
+
+
+def _es_rechazo_de_formato(error: Exception) -> bool:
+    """Indica si Whisper rechazó el archivo por su formato (y conviene convertirlo)."""
+    error_msg = str(error).lower()
+    return "invalid" in error_msg or "format" in error_msg or "unsupported" in error_msg
+
+
+def _error_transcripcion(error: Exception) -> str:
+    """Traduce un error de Whisper a un mensaje para el agente."""
+    error_msg = str(error)
+    _log.error("❌ Error en transcripción de Whisper: %s", error_msg)
+    
+    if "rate_limit" in error_msg.lower():
+        return f"[ERROR_RATE_LIMIT] Límite de tasa de Whisper excedido. Intenta de nuevo en unos momentos."
+    elif "invalid_file" in error_msg.lower() or "invalid" in error_msg.lower() or "format" in error_msg.lower():
+        return f"[ERROR_FORMAT] El archivo de audio no es compatible con Whisper. Formato rechazado."
+    else:
+        return f"[ERROR_TRANSCRIPTION] Error al transcribir audio con Whisper: {error_msg}"
+
+
+def _error_conversion(error: Exception) -> str:
+    """Mensaje para el agente cuando falla la conversión de OGG a WAV."""
+    _log.error("❌ Error convirtiendo OGG a WAV: %s", error)
+    # En lugar de "Error:", usamos un formato que el LLM entienda como resultado de herramienta
+    return f"[ERROR_CONVERSION] No se pudo procesar el audio OGG. El archivo necesita conversión pero falló: {str(error)}"
+
+
+_ERROR_SIN_FFMPEG = "[ERROR_SETUP] ffmpeg no está instalado o no está en PATH. Se requiere para convertir audios de WhatsApp."
+
+
+def _armar_resultado_audio(texto_transcrito: str, extracto: Optional[Dict[str, Any]], digest: str) -> str:
+    """
+    Arma el JSON final de una transcripción y lo guarda en caché. Si la extracción
+    falló (`extracto` None) se usa el extracto de respaldo y no se cachea, así el
+    mismo audio se vuelve a extraer la próxima vez.
+    """
+    # Retornar tanto el texto transcrito como el extracto estructurado
+    resultado = {
+        "texto_transcrito": texto_transcrito,
+        "extracto_estructurado": extracto if extracto is not None else _extracto_error(),
+        "formato": "JSON_READY"  # Indica que está listo para integrar con BD
+    }
+    
+    resultado_json = _dumps(resultado)
+    if extracto is not None:
+        _media_cache_put(digest, resultado_json)
+    return resultado_json
+
+
+def _resultado_audio(texto_transcrito: str, digest: str) -> str:
+    """Extrae el extracto estructurado de la transcripción, lo guarda en caché y retorna el JSON final."""
+    # Extraer información estructurada del texto transcrito
+    _log.debug("📊 Extrayendo información estructurada del audio transcrito...")
+    return _armar_resultado_audio(texto_transcrito, _extraer_productos(texto_transcrito), digest)
+
+
+# ffmpeg se busca una sola vez al importar, en lugar de lanzar `ffmpeg -version`
+# antes de cada conversión
+_FFMPEG_OK = shutil.which('ffmpeg') is not None
+
+
+def _convertir_a_wav(datos: bytes) -> io.BytesIO:
+    """
+    Convierte un audio a WAV mono de 16 kHz (lo que mejor funciona con Whisper)
+    pasándole los bytes a ffmpeg por stdin y leyendo su salida directamente a memoria.
+    """
+    proceso = subprocess.run(
+        ['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0',
+         '-ac', '1', '-ar', '16000', '-f', 'wav', 'pipe:1'],
+        input=datos,
+        capture_output=True,
+        timeout=60,
+    )
+    if proceso.returncode != 0:
+        raise Exception(f"ffmpeg falló: {proceso.stderr.decode('utf-8', errors='replace').strip()}")
+    if not proceso.stdout:
+        raise Exception("El archivo convertido está vacío")
+    
+    wav = io.BytesIO(proceso.stdout)
+    wav.name = "audio.wav"  # El SDK de OpenAI usa el nombre para detectar el formato
+    return wav
+
+
+# Límite de Whisper por archivo y umbral a partir del cual el audio se divide en
+# segmentos de 10 minutos (WAV mono 16 kHz ≈ 19 MB por segmento, bajo el límite)
+_WHISPER_MAX_MB = 25
+_SEGMENTAR_DESDE_MB = 20
+_SEGMENTO_SEGUNDOS = 600
+
+# Hilos para transcribir los segmentos de un audio largo en paralelo
+_TRANSCRIPTION_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="despensa-whisper")
+
+
+def _requiere_segmentar(datos: bytes) -> bool:
+    """Indica si el audio supera el umbral y debe transcribirse por segmentos."""
+    return _FFMPEG_OK and len(datos) > _SEGMENTAR_DESDE_MB * 1024 * 1024
+
+
+def _buffer_audio(datos: bytes, audio_file_path: str) -> io.BytesIO:
+    """Envuelve los bytes del audio para subirlos a Whisper sin volver a abrir el archivo."""
+    buffer = io.BytesIO(datos)
+    buffer.name = os.path.basename(audio_file_path)  # El SDK de OpenAI usa el nombre para detectar el formato
+    return buffer
+
+
+def _segmentar_audio(audio_file_path: str) -> List[io.BytesIO]:
+    """
+    Divide un audio largo en segmentos WAV mono de 16 kHz de `_SEGMENTO_SEGUNDOS`
+    con el muxer `segment` de ffmpeg y los retorna en memoria, en orden.
+    """
+    with tempfile.TemporaryDirectory(prefix="despensa_seg_") as directorio:
+        patron = os.path.join(directorio, "parte_%03d.wav")
+        proceso = subprocess.run(
+            ['ffmpeg', '-loglevel', 'error', '-i', audio_file_path,
+             '-ac', '1', '-ar', '16000', '-f', 'segment',
+             '-segment_time', str(_SEGMENTO_SEGUNDOS), patron],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            timeout=600,
+        )
+        if proceso.returncode != 0:
+            raise Exception(f"ffmpeg falló: {proceso.stderr.decode('utf-8', errors='replace').strip()}")
+        
+        segmentos = []
+        for nombre in sorted(os.listdir(directorio)):
+            with open(os.path.join(directorio, nombre), "rb") as f:
+                segmento = io.BytesIO(f.read())
+            segmento.name = nombre
+            segmentos.append(segmento)
+    
+    if not segmentos:
+        raise Exception("ffmpeg no generó segmentos")
+    return segmentos
+
+
+def _unir_transcripciones(textos: List[str]) -> str:
+    """
+    Une las transcripciones de segmentos consecutivos con un espacio. Si el inicio
+    de un segmento repite el final del anterior (palabras cortadas en el borde),
+    se descarta la parte repetida.
+    """
+    unido = ""
+    for texto in textos:
+        texto = texto.strip()
+        if not texto:
+            continue
+        if unido:
+            # Mayor solapamiento de palabras entre la cola acumulada y el nuevo inicio
+            palabras_cola = unido.split()[-10:]
+            palabras = texto.split()
+            for n in range(min(len(palabras_cola), len(palabras)), 0, -1):
+                if [p.lower() for p in palabras_cola[-n:]] == [p.lower() for p in palabras[:n]]:
+                    texto = " ".join(palabras[n:])
+                    break
+            unido = f"{unido} {texto}".strip()
+        else:
+            unido = texto
+    return unido
+
+
+def _transcribir_segmento(segmento: io.BytesIO) -> str:
+    """Transcribe un segmento en memoria con Whisper."""
+    transcript = _rate_limited_call(
+        get_openai_client().audio.transcriptions.create,
+        model=_WHISPER_MODEL,
+        file=segmento,
+        language="es"
+    )
+    return transcript.text
+
+
+def _error_segmentacion(error: Exception) -> str:
+    """Mensaje para el agente cuando falla la división de un audio largo."""
+    _log.error("❌ Error dividiendo el audio en segmentos: %s", error)
+    return f"[ERROR_CONVERSION] No se pudo dividir el audio largo en segmentos: {str(error)}"
+
+
+# Extensiones reconocidas por tipo de archivo multimedia
+_AUDIO_EXTS = frozenset({'.wav', '.mp3', '.m4a', '.ogg', '.flac', '.aac', '.mp4', '.mpeg', '.mpga', '.webm'})
+_IMAGE_EXTS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.webp'})
+# Tamaño máximo de imagen para Vision API (whatsapp_server lo aplica antes de descargar)
+IMAGEN_MAX_MB = 20
+# Formatos que acepta Whisper, más .ogg (WhatsApp), que se convierte si hace falta
+_WHISPER_EXTS = frozenset({'.mp3', '.mp4', '.mpeg', '.mpga', '.m4a', '.wav', '.webm', '.ogg'})
+
+# Herramientas multimodales, cuyo resultado incluye un extracto estructurado
+_MEDIA_TOOL_NAMES = frozenset({TOOL_TRANSCRIBIR, TOOL_IMAGEN})
+
+
+@functools.lru_cache(maxsize=256)
+def _classify(path: str) -> Optional[Literal["audio", "imagen"]]:
+    """Clasifica un archivo multimedia por su extensión: "audio", "imagen" o None."""
+    file_ext = os.path.splitext(path)[1].lower()
+    if file_ext in _AUDIO_EXTS:
+        return "audio"
+    if file_ext in _IMAGE_EXTS:
+        return "imagen"
+    return None
+
+
+# Contador de subidas directas a Whisper evitadas gracias a la detección de Opus
+_OGG_DIRECTO_OMITIDOS = 0
+
+
+def _es_ogg_opus(datos: bytes) -> bool:
+    """
+    Detecta si un audio es OGG con códec Opus (el formato de las notas de voz de
+    WhatsApp) mirando solo su cabecera: la primera página OGG ("OggS") contiene
+    el paquete "OpusHead".
+    """
+    cabecera = datos[:64]
+    return cabecera.startswith(b"OggS") and b"OpusHead" in cabecera
+
+
 @tool
 def transcribir_audio(audio_file_path: str) -> str:
     """
@@ -416,207 +1282,316 @@ def transcribir_audio(audio_file_path: str) -> str:
         FileNotFoundError: Si el archivo no existe
         ValueError: Si el formato de archivo no es soportado
     """
-    # Validar que el archivo existe
-    if not os.path.exists(audio_file_path):
-        raise FileNotFoundError(f"El archivo de audio '{audio_file_path}' no existe.")
+    file_ext, datos = _validar_audio(audio_file_path)
     
-    if not os.path.isfile(audio_file_path):
-        raise ValueError(f"'{audio_file_path}' no es un archivo válido.")
-    
-    # Validar formato de archivo
-    # Nota: Whisper soporta: mp3, mp4, mpeg, mpga, m4a, wav, webm
-    # WhatsApp envía audios en formato .ogg (OGG Opus), que necesitamos convertir
-    valid_extensions = ['.mp3', '.mp4', '.mpeg', '.mpga', '.m4a', '.wav', '.webm', '.ogg']
-    file_ext = os.path.splitext(audio_file_path)[1].lower()
+    # Si este mismo audio ya fue transcrito, reutilizar el resultado
+    digest = _hash_bytes(datos)
+    resultado_cacheado = _media_cache_get(digest)
+    if resultado_cacheado is not None:
+        _log.debug("⚡ Transcripción obtenida desde caché")
+        return resultado_cacheado
     
-    if file_ext not in valid_extensions:
-        raise ValueError(f"Formato de archivo '{file_ext}' no soportado. Formatos válidos: {', '.join(valid_extensions)}")
-    
-    # Validar tamaño del archivo (máximo 25 MB para Whisper)
-    file_size = os.path.getsize(audio_file_path) / (1024 * 1024)  # MB
-    if file_size > 25:
-        raise ValueError(f"El archivo es demasiado grande ({file_size:.2f} MB). El máximo es 25 MB.")
+    # Audios largos: dividir en segmentos, transcribirlos en paralelo y extraer una sola vez
+    if _requiere_segmentar(datos):
+        try:
+            segmentos = _segmentar_audio(audio_file_path)
+        except Exception as seg_error:
+            return _error_segmentacion(seg_error)
+        _log.debug("✂️  Audio dividido en %s segmentos", len(segmentos))
+        try:
+            textos = list(_TRANSCRIPTION_EXECUTOR.map(_transcribir_segmento, segmentos))
+            return _resultado_audio(_unir_transcripciones(textos), digest)
+        except Exception as e:
+            return _error_transcripcion(e)
     
     # Si es OGG, intentamos primero enviarlo directamente a Whisper
     # Si falla, lo convertimos a WAV
-    audio_file_to_use = audio_file_path
-    temp_converted_file = None
+    audio_file_to_use = _buffer_audio(datos, audio_file_path)
     
-    # Intentar primero con OGG directamente (Whisper puede aceptarlo aunque no esté documentado)
-    if file_ext == '.ogg':
-        print(f"🔄 Archivo OGG detectado. Intentando transcripción directa primero...")
+    # Intentar primero con OGG directamente solo si no es Opus (Whisper suele aceptarlo)
+    if file_ext == '.ogg' and not _omitir_subida_directa(datos):
+        _log.debug("🔄 Archivo OGG detectado. Intentando transcripción directa primero...")
         try:
-            with open(audio_file_path, "rb") as audio_file:
-                transcript = openai_client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    language="es"
-                )
-            texto_transcrito = transcript.text.strip()
-            print(f"✅ Transcripción directa exitosa (sin conversión)")
-            
-            # Extraer información estructurada del texto transcrito
-            print(f"\n📊 Extrayendo información estructurada del audio transcrito...")
-            extracto = extraer_productos_desde_texto(texto_transcrito)
-            
-            # Retornar tanto el texto transcrito como el extracto estructurado
-            resultado = {
-                "texto_transcrito": texto_transcrito,
-                "extracto_estructurado": extracto,
-                "formato": "JSON_READY"
-            }
-            
-            return json.dumps(resultado, ensure_ascii=False)
+            transcript = _rate_limited_call(
+                get_openai_client().audio.transcriptions.create,
+                model=_WHISPER_MODEL,
+                file=audio_file_to_use,
+                language="es"
+            )
+            _log.debug("✅ Transcripción directa exitosa (sin conversión)")
+            return _resultado_audio(transcript.text.strip(), digest)
         except Exception as direct_error:
-            error_msg = str(direct_error).lower()
-            if "invalid" in error_msg or "format" in error_msg or "unsupported" in error_msg:
-                print(f"⚠️  Whisper rechazó OGG directamente. Convirtiendo a WAV...")
-                # Continuar con la conversión
-            else:
+            if not _es_rechazo_de_formato(direct_error):
                 # Otro tipo de error, re-lanzar
                 raise
+            _log.warning("⚠️  Whisper rechazó OGG directamente. Convirtiendo a WAV...")
     
-    # Si llegamos aquí, necesitamos convertir OGG a WAV
+    # Si llegamos aquí, necesitamos convertir OGG a WAV (en memoria, sin archivos temporales)
     if file_ext == '.ogg':
-        if PYDUB_AVAILABLE:
-            temp_wav_path = None
-            try:
-                print(f"🔄 Convirtiendo archivo OGG a WAV...")
-                print(f"   Archivo original: {audio_file_path}")
-                print(f"   Tamaño: {os.path.getsize(audio_file_path)} bytes")
-                
-                # Verificar que ffmpeg está disponible
-                import subprocess
-                try:
-                    result = subprocess.run(['ffmpeg', '-version'], capture_output=True, timeout=5)
-                    if result.returncode != 0:
-                        raise Exception("ffmpeg no está funcionando correctamente")
-                    print(f"   ✅ ffmpeg está disponible")
-                except FileNotFoundError:
-                    raise Exception("ffmpeg no está instalado o no está en PATH. Instala con: brew install ffmpeg (macOS)")
-                except Exception as ffmpeg_err:
-                    raise Exception(f"Error verificando ffmpeg: {ffmpeg_err}")
-                
-                # Intentar cargar el archivo OGG usando diferentes métodos
-                # WhatsApp envía OGG Opus, que puede necesitar especificación explícita
-                audio = None
-                try:
-                    # Método 1: Intentar con from_file sin especificar formato (pydub detecta automáticamente)
-                    audio = AudioSegment.from_file(audio_file_path)
-                    print(f"   ✅ Método 1 exitoso: from_file (detección automática)")
-                except Exception as e1:
-                    print(f"   ⚠️  Método 1 falló: {e1}")
-                    try:
-                        # Método 2: Intentar especificando formato ogg explícitamente
-                        audio = AudioSegment.from_file(audio_file_path, format="ogg")
-                        print(f"   ✅ Método 2 exitoso: from_file con format='ogg'")
-                    except Exception as e2:
-                        print(f"   ⚠️  Método 2 falló: {e2}")
-                        try:
-                            # Método 3: Intentar con from_ogg específico
-                            audio = AudioSegment.from_ogg(audio_file_path)
-                            print(f"   ✅ Método 3 exitoso: from_ogg")
-                        except Exception as e3:
-                            print(f"   ❌ Método 3 falló: {e3}")
-                            raise Exception(f"No se pudo cargar el archivo OGG con ningún método. Verifica que el archivo sea válido y que ffmpeg esté instalado correctamente.")
-                
-                if audio is None:
-                    raise Exception("No se pudo cargar el archivo de audio")
-                
-                print(f"   ✅ Archivo OGG cargado correctamente")
-                print(f"   Duración: {len(audio)} ms ({len(audio)/1000:.2f} segundos)")
-                
-                # Crear archivo temporal WAV
-                temp_wav_path = tempfile.mktemp(suffix='.wav')
-                
-                # Exportar a WAV con parámetros específicos para Whisper
-                # Whisper funciona mejor con mono, 16kHz
-                audio.export(temp_wav_path, format="wav", parameters=["-ac", "1", "-ar", "16000"])
-                
-                # Verificar que el archivo convertido existe y tiene contenido
-                if not os.path.exists(temp_wav_path):
-                    raise Exception("El archivo convertido no se creó")
-                
-                converted_size = os.path.getsize(temp_wav_path)
-                if converted_size == 0:
-                    raise Exception("El archivo convertido está vacío")
-                
-                print(f"✅ Archivo convertido a WAV: {temp_wav_path}")
-                print(f"   Tamaño convertido: {converted_size} bytes ({converted_size/1024:.2f} KB)")
-                
-                audio_file_to_use = temp_wav_path
-                # Guardar la ruta para limpieza posterior
-                temp_converted_file = temp_wav_path
-                    
-            except Exception as conv_error:
-                print(f"❌ Error convirtiendo OGG a WAV: {conv_error}")
-                import traceback
-                traceback.print_exc()
-                # Limpiar archivo temporal si existe
-                if temp_wav_path and os.path.exists(temp_wav_path):
-                    try:
-                        os.remove(temp_wav_path)
-                    except:
-                        pass
-                # Retornar un mensaje que indique el problema pero que el LLM pueda usar
-                # En lugar de "Error:", usamos un formato que el LLM entienda como resultado de herramienta
-                return f"[ERROR_CONVERSION] No se pudo procesar el audio OGG. El archivo necesita conversión pero falló: {str(conv_error)}"
-        else:
-            return f"[ERROR_SETUP] pydub no está disponible. Se requiere para convertir audios de WhatsApp."
+        if not _FFMPEG_OK:
+            return _ERROR_SIN_FFMPEG
+        try:
+            _log.debug("🔄 Convirtiendo archivo OGG a WAV...")
+            _log.debug("   Archivo original: %s", audio_file_path)
+            
+            audio_file_to_use = _convertir_a_wav(datos)
+            _log.debug("✅ Archivo convertido a WAV en memoria: %s bytes", audio_file_to_use.getbuffer().nbytes)
+        
+        except Exception as conv_error:
+            # Retornar un mensaje que indique el problema pero que el LLM pueda usar
+            return _error_conversion(conv_error)
     
     try:
         # Transcribir usando OpenAI Whisper API
-        with open(audio_file_to_use, "rb") as audio_file:
-            transcript = openai_client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="es"  # Especificar español para mejor precisión
-            )
+        transcript = _rate_limited_call(
+            get_openai_client().audio.transcriptions.create,
+            model=_WHISPER_MODEL,
+            file=audio_file_to_use,
+            language="es"  # Especificar español para mejor precisión
+        )
         
         # Retornar el texto transcrito en un formato estructurado
-        texto_transcrito = transcript.text.strip()
-        
-        # Limpiar archivo temporal convertido si existe
-        if temp_converted_file and isinstance(temp_converted_file, str):
-            if os.path.exists(temp_converted_file):
-                try:
-                    os.remove(temp_converted_file)
-                    print(f"🗑️  Archivo temporal eliminado: {temp_converted_file}")
-                except Exception as cleanup_err:
-                    print(f"⚠️  No se pudo eliminar archivo temporal: {cleanup_err}")
-        
-        # Extraer información estructurada del texto transcrito
-        print(f"\n📊 Extrayendo información estructurada del audio transcrito...")
-        extracto = extraer_productos_desde_texto(texto_transcrito)
-        
-        # Retornar tanto el texto transcrito como el extracto estructurado
-        resultado = {
-            "texto_transcrito": texto_transcrito,
-            "extracto_estructurado": extracto,
-            "formato": "JSON_READY"  # Indica que está listo para integrar con BD
-        }
-        
-        return json.dumps(resultado, ensure_ascii=False)
+        return _resultado_audio(transcript.text.strip(), digest)
     
     except Exception as e:
-        # Limpiar archivo temporal convertido si existe
-        if temp_converted_file and isinstance(temp_converted_file, str):
-            if os.path.exists(temp_converted_file):
-                try:
-                    os.remove(temp_converted_file)
-                except:
-                    pass
-        
-        # Manejo de errores de la API
-        error_msg = str(e)
-        print(f"❌ Error en transcripción de Whisper: {error_msg}")
+        # Manejo de errores de la API
+        return _error_transcripcion(e)
+
+
+async def _atranscribir(audio_file_path: str) -> str:
+    """
+    Versión asíncrona de `transcribir_audio`, usada cuando el grafo se ejecuta con
+    `ainvoke`: las llamadas a Whisper y a la extracción liberan el event loop, y
+    el hash y la conversión con ffmpeg corren en hilos.
+    """
+    file_ext, datos = await asyncio.to_thread(_validar_audio, audio_file_path)
+    
+    digest = await asyncio.to_thread(_hash_bytes, datos)
+    resultado_cacheado = _media_cache_get(digest)
+    if resultado_cacheado is not None:
+        _log.debug("⚡ Transcripción obtenida desde caché")
+        return resultado_cacheado
+    
+    client = get_openai_async_client()
+    audio_file_to_use = _buffer_audio(datos, audio_file_path)
+    
+    if _requiere_segmentar(datos):
+        try:
+            segmentos = await asyncio.to_thread(_segmentar_audio, audio_file_path)
+        except Exception as seg_error:
+            return _error_segmentacion(seg_error)
+        try:
+            transcripts = await asyncio.gather(*(
+                _arate_limited_call(client.audio.transcriptions.create, model=_WHISPER_MODEL, file=segmento, language="es")
+                for segmento in segmentos
+            ))
+            return await _aresultado_audio(_unir_transcripciones([t.text for t in transcripts]), digest)
+        except Exception as e:
+            return _error_transcripcion(e)
+    
+    if file_ext == '.ogg' and not _omitir_subida_directa(datos):
+        try:
+            transcript = await _arate_limited_call(client.audio.transcriptions.create, model=_WHISPER_MODEL, file=audio_file_to_use, language="es")
+            return await _aresultado_audio(transcript.text.strip(), digest)
+        except Exception as direct_error:
+            if not _es_rechazo_de_formato(direct_error):
+                raise
+            _log.warning("⚠️  Whisper rechazó OGG directamente. Convirtiendo a WAV...")
+    
+    if file_ext == '.ogg':
+        if not _FFMPEG_OK:
+            return _ERROR_SIN_FFMPEG
+        try:
+            audio_file_to_use = await asyncio.to_thread(_convertir_a_wav, datos)
+        except Exception as conv_error:
+            return _error_conversion(conv_error)
+    
+    try:
+        transcript = await _arate_limited_call(client.audio.transcriptions.create, model=_WHISPER_MODEL, file=audio_file_to_use, language="es")
+        return await _aresultado_audio(transcript.text.strip(), digest)
+    
+    except Exception as e:
+        return _error_transcripcion(e)
+
+
+async def _aresultado_audio(texto_transcrito: str, digest: str) -> str:
+    """Versión asíncrona de `_resultado_audio`."""
+    _log.debug("📊 Extrayendo información estructurada del audio transcrito...")
+    extracto = await _aextraer_productos(texto_transcrito)
+    return await asyncio.to_thread(_armar_resultado_audio, texto_transcrito, extracto, digest)
+
+
+transcribir_audio.coroutine = _atranscribir
+
+
+_VISION_PROMPT = """Analiza esta imagen de una despensa, compra de supermercado, o productos alimenticios.
+
+Identifica los productos visibles en la imagen para actualizar el inventario:
+- accion: "UPDATE" para los productos visibles (se consideran comprados, en stock)
+- productos: nombre en singular y minúsculas, cantidad si es visible (o null), unidad ("unidad" si no se distingue)
+- descripcion: resumen breve en una línea, ej: "Compra de 1kg de arroz, leche y pan"
+
+Si no puedes identificar productos claramente, retorna productos vacío, accion "QUERY" y descripcion "No se pudieron identificar productos claramente en la imagen"."""
+
+
+def _validar_imagen(image_file_path: str) -> Optional[str]:
+    """Valida el archivo de imagen. Retorna un mensaje de error o None si es válido."""
+    try:
+        _precheck(image_file_path, _IMAGE_EXTS, IMAGEN_MAX_MB, "imagen")
+    except (FileNotFoundError, ValueError) as e:
+        return f"Error: {e}"
+    return None
+
+
+# Payloads base64 ya codificados (con su tipo MIME), por hash de contenido. Se
+# guardan pocos porque cada uno ocupa ~4/3 del tamaño de la imagen.
+_B64_CACHE_MAX = 8
+_B64_CACHE: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+_B64_CACHE_LOCK = threading.Lock()
+
+# Bloque de codificación: múltiplo de 3 para que no haya relleno "=" entre bloques
+_B64_BLOQUE = 57 * 1024
+
+# Vision redimensiona internamente las imágenes grandes; reducirlas antes ahorra
+# ancho de banda y base64 sin perder detalle útil
+_VISION_MAX_LADO = 2048
+
+
+def _b64_por_bloques(buffer) -> str:
+    """Codifica un buffer en base64 por bloques, escribiendo sobre una salida preasignada."""
+    tamano = len(buffer)
+    salida = bytearray(((tamano + 2) // 3) * 4)
+    pos = 0
+    for inicio in range(0, tamano, _B64_BLOQUE):
+        codificado = base64.b64encode(buffer[inicio:inicio + _B64_BLOQUE])
+        salida[pos:pos + len(codificado)] = codificado
+        pos += len(codificado)
+    return salida.decode('ascii')
+
+
+def _reducir_imagen(image_file_path: str) -> Optional[Tuple[io.BytesIO, str]]:
+    """
+    Si Pillow está disponible y la imagen supera `_VISION_MAX_LADO` en su lado mayor,
+    la reduce en memoria. Retorna (buffer, tipo MIME) o None si no hace falta.
+    """
+    if not PIL_AVAILABLE:
+        return None
+    try:
+        with Image.open(image_file_path) as imagen:
+            if max(imagen.size) <= _VISION_MAX_LADO:
+                return None
+            formato = imagen.format if imagen.format in ("JPEG", "PNG", "WEBP") else "PNG"
+            # En JPEG, decodificar directamente a 1/2, 1/4 u 1/8 de escala (en el
+            # dominio DCT de libjpeg) en vez de descomprimir todos los píxeles y
+            # luego reducir; en otros formatos no hace nada
+            imagen.draft(imagen.mode, (_VISION_MAX_LADO, _VISION_MAX_LADO))
+            imagen.thumbnail((_VISION_MAX_LADO, _VISION_MAX_LADO))
+            salida = io.BytesIO()
+            imagen.save(salida, format=formato)
+    except Exception as e:
+        _log.debug("No se pudo reducir la imagen, se envía la original: %s", e)
+        return None
+    return salida, f"image/{formato.lower()}"
+
+
+def _codificar_imagen(image_file_path: str, digest: str) -> Tuple[str, str]:
+    """
+    Codifica la imagen en base64 (reduciéndola si es muy grande), reutilizando el
+    payload si ya se codificó. Retorna (base64, tipo MIME).
+    """
+    with _B64_CACHE_LOCK:
+        cacheado = _B64_CACHE.get(digest)
+        if cacheado is not None:
+            _B64_CACHE.move_to_end(digest)
+            return cacheado
+    
+    reducida = _reducir_imagen(image_file_path)
+    if reducida is not None:
+        buffer, mime_type = reducida
+        base64_image = _b64_por_bloques(buffer.getbuffer())
+    else:
+        # Determinar el tipo MIME
+        file_ext = os.path.splitext(image_file_path)[1].lower()
+        mime_type = f"image/{file_ext[1:]}"  # jpg -> image/jpeg
+        if file_ext == '.jpg':
+            mime_type = 'image/jpeg'
         
-        if "rate_limit" in error_msg.lower():
-            return f"[ERROR_RATE_LIMIT] Límite de tasa de Whisper excedido. Intenta de nuevo en unos momentos."
-        elif "invalid_file" in error_msg.lower() or "invalid" in error_msg.lower() or "format" in error_msg.lower():
-            return f"[ERROR_FORMAT] El archivo de audio no es compatible con Whisper. Formato rechazado."
-        else:
-            return f"[ERROR_TRANSCRIPTION] Error al transcribir audio con Whisper: {error_msg}"
+        with open(image_file_path, "rb") as image_file:
+            if os.fstat(image_file.fileno()).st_size == 0:
+                base64_image = ""
+            else:
+                # mmap evita copiar el archivo completo a un buffer intermedio antes de codificar
+                with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    base64_image = _b64_por_bloques(mm)
+    
+    _log.debug("🖼️  Payload base64 de la imagen: %s bytes (%s)", len(base64_image), mime_type)
+    
+    with _B64_CACHE_LOCK:
+        _B64_CACHE[digest] = (base64_image, mime_type)
+        _B64_CACHE.move_to_end(digest)
+        if len(_B64_CACHE) > _B64_CACHE_MAX:
+            _B64_CACHE.popitem(last=False)
+    return base64_image, mime_type
+
+
+def _solicitud_vision(image_file_path: str, digest: str) -> Dict[str, Any]:
+    """Lee la imagen y arma los parámetros de la llamada a OpenAI Vision API."""
+    base64_image, mime_type = _codificar_imagen(image_file_path, digest)
+    
+    return {
+        "model": _VISION_MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": _VISION_PROMPT},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{mime_type};base64,{base64_image}"
+                        }
+                    }
+                ]
+            }
+        ],
+        # Vision responde directamente con el extracto estructurado, sin una
+        # segunda llamada al LLM para parsear texto libre
+        "response_format": AnalisisImagen,
+        "max_tokens": 300
+    }
+
+
+def _resultado_imagen(response, digest: str) -> str:
+    """Toma el análisis estructurado de la respuesta de Vision, lo guarda en caché y retorna el JSON final."""
+    mensaje = response.choices[0].message
+    analisis = mensaje.parsed
+    if analisis is None:
+        raise ValueError(mensaje.refusal or "Vision no retornó un análisis")
+    
+    extracto = analisis.model_dump(exclude={"descripcion"})
+    _log.debug("📦 Extracción desde imagen: %s - %s producto(s)", extracto["accion"], len(extracto["productos"]))
+    
+    # Retornar tanto el análisis como el extracto estructurado
+    resultado = {
+        "analisis_imagen": analisis.descripcion,
+        "extracto_estructurado": extracto,
+        "formato": "JSON_READY"  # Indica que está listo para integrar con BD
+    }
+    
+    resultado_json = _dumps(resultado)
+    _media_cache_put(digest, resultado_json)
+    return resultado_json
+
+
+def _error_imagen(error: Exception, image_file_path: str) -> str:
+    """Traduce un error de la API de Vision a un mensaje para el agente."""
+    error_msg = str(error)
+    if "rate_limit" in error_msg.lower():
+        return "Error: Límite de tasa excedido. Por favor, intenta de nuevo en unos momentos."
+    elif "invalid_image" in error_msg.lower() or "invalid_file" in error_msg.lower():
+        return f"Error: El archivo '{image_file_path}' no es una imagen válida."
+    else:
+        return f"Error al procesar imagen: {error_msg}"
 
 
 @tool
@@ -634,97 +1609,111 @@ def procesar_imagen(image_file_path: str) -> str:
         FileNotFoundError: Si el archivo no existe
         ValueError: Si el formato de archivo no es soportado
     """
-    # Validar que el archivo existe
-    if not os.path.exists(image_file_path):
-        return f"Error: El archivo de imagen '{image_file_path}' no existe."
-    
-    if not os.path.isfile(image_file_path):
-        return f"Error: '{image_file_path}' no es un archivo válido."
-    
-    # Validar formato de archivo
-    valid_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp']
-    file_ext = os.path.splitext(image_file_path)[1].lower()
-    
-    if file_ext not in valid_extensions:
-        return f"Error: Formato de archivo '{file_ext}' no soportado. Formatos válidos: {', '.join(valid_extensions)}"
-    
-    # Validar tamaño del archivo (máximo 20 MB para Vision API)
-    file_size = os.path.getsize(image_file_path) / (1024 * 1024)  # MB
-    if file_size > 20:
-        return f"Error: El archivo es demasiado grande ({file_size:.2f} MB). El máximo es 20 MB."
-    
-    try:
-        # Leer y codificar la imagen en base64
-        with open(image_file_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-        
-        # Determinar el tipo MIME
-        mime_type = f"image/{file_ext[1:]}"  # jpg -> image/jpeg
-        if file_ext == '.jpg':
-            mime_type = 'image/jpeg'
-        
-        # Usar OpenAI Vision API para analizar la imagen
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",  # Usar gpt-4o-mini para costos más bajos
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": """Analiza esta imagen de una despensa, compra de supermercado, o productos alimenticios.
-
-Identifica los productos visibles en la imagen y genera un mensaje estructurado para actualizar el inventario.
-
-Formato de respuesta:
-- Si hay un solo producto: "Compra de [producto] [cantidad si es visible], establecer a ALTO"
-- Si hay múltiples productos: Lista cada uno en una línea separada con el mismo formato
-
-Ejemplos:
-- "Compra de 1kg de arroz, establecer a ALTO"
-- "Compra de pan, establecer a ALTO"
-- "Compra de leche, establecer a ALTO"
-- "Compra de huevos, establecer a ALTO"
-
-Si no puedes identificar productos claramente, indica: "No se pudieron identificar productos claramente en la imagen"."""
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{mime_type};base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=500
-        )
-        
-        # Extraer el resultado del análisis
-        analisis = response.choices[0].message.content.strip()
-        
-        # Extraer información estructurada del análisis de la imagen
-        print(f"\n📊 Extrayendo información estructurada del análisis de imagen...")
-        extracto = extraer_productos_desde_texto(analisis)
+    error = _validar_imagen(image_file_path)
+    if error:
+        return error
+    
+    # Si esta misma imagen ya fue analizada, reutilizar el resultado
+    digest = _hash_archivo(image_file_path)
+    resultado_cacheado = _media_cache_get(digest)
+    if resultado_cacheado is not None:
+        _log.debug("⚡ Análisis de imagen obtenido desde caché")
+        return resultado_cacheado
+    
+    def _analizar() -> str:
+        try:
+            # Usar OpenAI Vision API para analizar la imagen
+            response = _rate_limited_call(get_openai_client().chat.completions.parse, **_solicitud_vision(image_file_path, digest))
+            
+            # Extraer el resultado del análisis
+            return _resultado_imagen(response, digest)
         
-        # Retornar tanto el análisis como el extracto estructurado
-        resultado = {
-            "analisis_imagen": analisis,
-            "extracto_estructurado": extracto,
-            "formato": "JSON_READY"  # Indica que está listo para integrar con BD
-        }
+        except Exception as e:
+            # Manejo de errores de la API
+            return _error_imagen(e, image_file_path)
+    
+    # La misma foto reenviada a la vez por varios usuarios se analiza una sola vez
+    return _una_sola_vez(digest, _analizar)
+
+
+async def _aprocesar_imagen(image_file_path: str) -> str:
+    """Versión asíncrona de `procesar_imagen`, usada cuando el grafo se ejecuta con `ainvoke`."""
+    error = _validar_imagen(image_file_path)
+    if error:
+        return error
+    
+    digest = await asyncio.to_thread(_hash_archivo, image_file_path)
+    resultado_cacheado = _media_cache_get(digest)
+    if resultado_cacheado is not None:
+        _log.debug("⚡ Análisis de imagen obtenido desde caché")
+        return resultado_cacheado
+    
+    async def _analizar() -> str:
+        try:
+            solicitud = await asyncio.to_thread(_solicitud_vision, image_file_path, digest)
+            response = await _arate_limited_call(get_openai_async_client().chat.completions.parse, **solicitud)
+            return await asyncio.to_thread(_resultado_imagen, response, digest)
         
-        return json.dumps(resultado, ensure_ascii=False)
+        except Exception as e:
+            return _error_imagen(e, image_file_path)
     
-    except Exception as e:
-        # Manejo de errores de la API
-        error_msg = str(e)
-        if "rate_limit" in error_msg.lower():
-            return "Error: Límite de tasa excedido. Por favor, intenta de nuevo en unos momentos."
-        elif "invalid_image" in error_msg.lower() or "invalid_file" in error_msg.lower():
-            return f"Error: El archivo '{image_file_path}' no es una imagen válida."
-        else:
-            return f"Error al procesar imagen: {error_msg}"
+    return await _auna_sola_vez(digest, _analizar)
+
+
+procesar_imagen.coroutine = _aprocesar_imagen
+
+
+# ============================================================================
+# LLM DEL AGENTE (instancias compartidas)
+# ============================================================================
+# El cliente y los esquemas de herramientas no cambian entre turnos, así que se
+# construyen una sola vez (en el primer turno) en lugar de en cada nodo.
+_TEXT_TOOLS = [consultar_despensa, actualizar_despensa]
+
+
+@functools.lru_cache(maxsize=1)
+def _llm_agente() -> Any:
+    """
+    Retorna el LLM del agente con las herramientas de texto ya enlazadas (los
+    archivos multimedia llegan procesados). `bind_tools` convierte los esquemas
+    de las herramientas una sola vez.
+    """
+    _cargar_entorno()
+    # El prompt del sistema es un prefijo fijo: `prompt_cache_key` agrupa las llamadas
+    # para que OpenAI pueda servirlo desde su caché cuando el prefijo supere su mínimo
+    # (ver prompts.py), y `stream_usage` permite medir los aciertos
+    llm = ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0,
+        rate_limiter=_rate_limiter(),
+        stream_usage=True,
+        model_kwargs={"prompt_cache_key": prompts.PROMPT_CACHE_KEY},
+    )
+    # Llamadas en paralelo: con una ráfaga de mensajes (`run_agent_batch`) el agente
+    # puede consultar y actualizar varios ítems en un solo turno
+    return llm.bind_tools(_TEXT_TOOLS, parallel_tool_calls=True)
+
+
+@functools.lru_cache(maxsize=1)
+def _system_msg() -> SystemMessage:
+    """
+    Mensaje de sistema construido una sola vez (en el primer turno, no al importar)
+    y compartido por todas las conversaciones. El id fijo evita que `add_messages`
+    le asigne uno nuevo (y lo mute) cada vez que entra al estado del grafo.
+    """
+    return SystemMessage(content=compose_system(), id="despensa-system-prompt")
+
+
+def _mensaje_ejemplos(user_input: str) -> Tuple[BaseMessage, ...]:
+    """
+    Arma un mensaje con los ejemplos de uso más parecidos al mensaje del usuario.
+    Va después del historial, así que no altera el prefijo cacheado.
+    """
+    ejemplos = ejemplos_relevantes(user_input) if user_input else []
+    if not ejemplos:
+        return ()
+    lineas = [f'- "{ejemplo["text"]}" → {ejemplo["tool"]} ({ejemplo["op"]})' for ejemplo in ejemplos]
+    return (SystemMessage(content="Ejemplos de mensajes parecidos y la herramienta que corresponde:\n" + "\n".join(lineas)),)
 
 
 # ============================================================================
@@ -735,89 +1724,41 @@ def agent_node(state: AgentState) -> AgentState:
     Nodo del agente que usa el LLM para razonar sobre la intención del usuario
     y decidir qué herramienta usar. Maneja entradas de texto, audio e imágenes.
     """
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-    
-    # Obtener los mensajes del estado y el archivo multimedia
     messages = state["messages"]
-    media_file_path = state.get("media_file_path")
-    
-    # Determinar qué herramientas están disponibles según el contexto
-    all_tools = [consultar_despensa, actualizar_despensa]
-    
-    # Si hay un archivo multimedia, agregar las herramientas multimodales
-    if media_file_path:
-        # Determinar el tipo de archivo por extensión
-        file_ext = os.path.splitext(media_file_path)[1].lower()
-        if file_ext in ['.wav', '.mp3', '.m4a', '.ogg', '.flac', '.aac']:
-            # Es un archivo de audio
-            all_tools = [transcribir_audio, consultar_despensa, actualizar_despensa]
-        elif file_ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
-            # Es una imagen
-            all_tools = [procesar_imagen, consultar_despensa, actualizar_despensa]
-    
-    # Preparar el prompt del sistema
-    system_prompt = """Eres un asistente de despensa inteligente. Tu trabajo es entender la intención del usuario.
-
-FLUJO DE TRABAJO:
-1. Si el usuario envía un archivo multimedia (audio o imagen):
-   - PRIMERO debes usar 'transcribir_audio' para archivos de audio (.wav, .mp3, etc.)
-   - O 'procesar_imagen' para archivos de imagen (.jpg, .png, etc.)
-   - Luego, usa el resultado de estas herramientas para decidir la siguiente acción
-
-2. Si el usuario está CONSULTANDO el inventario (ej: "¿Qué me falta?", "¿Tengo leche?", "¿Qué tengo?"), 
-   debes usar la herramienta 'consultar_despensa'.
-
-3. Si el usuario está ACTUALIZANDO el inventario (ej: "Compré leche", "Agregué huevos", "Ya no tengo pan"),
-   debes usar la herramienta 'actualizar_despensa' con el estado apropiado:
-   - "Compré/Agregué" → estado "ALTO"
-   - "Se acabó/No tengo" → estado "BAJO"
-   - "Tengo poco" → estado "MEDIO"
-
-IMPORTANTE: 
-- Si hay un media_file_path en el estado, SIEMPRE procesa primero el archivo multimedia
-- Usa el texto resultante de la transcripción/procesamiento como input para decidir la acción
-- Responde de manera natural y amigable. Si no estás seguro de la intención, pregunta al usuario."""
-    
-    # Crear mensajes para el LLM con las herramientas disponibles
-    llm_with_tools = llm.bind_tools(all_tools)
-    
-    # Si hay un archivo multimedia y aún no se ha procesado, agregar contexto
-    if media_file_path and not any("transcribir_audio" in str(msg) or "procesar_imagen" in str(msg) for msg in messages):
-        file_ext = os.path.splitext(media_file_path)[1].lower()
-        if file_ext in ['.wav', '.mp3', '.m4a', '.ogg', '.flac', '.aac']:
-            # Agregar contexto sobre el archivo de audio
-            audio_context = f"El usuario ha enviado un archivo de audio: {media_file_path}. Debes transcribirlo primero usando 'transcribir_audio'."
-            if messages:
-                messages = [HumanMessage(content=audio_context)] + list(messages)
-            else:
-                messages = [HumanMessage(content=audio_context)]
-        elif file_ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
-            # Agregar contexto sobre la imagen
-            image_context = f"El usuario ha enviado una imagen: {media_file_path}. Debes procesarla primero usando 'procesar_imagen'."
-            if messages:
-                messages = [HumanMessage(content=image_context)] + list(messages)
-            else:
-                messages = [HumanMessage(content=image_context)]
+    llm_with_tools = _llm_agente()
     
-    # Preparar mensajes con el prompt del sistema
-    # Verificar si ya hay un SystemMessage en los mensajes
-    has_system_message = any(isinstance(msg, SystemMessage) for msg in messages)
+    # Ejemplos de uso solo al decidir la primera herramienta del turno; con los
+    # resultados de herramientas ya en el historial no aportan
+    ejemplos = _mensaje_ejemplos(state.get("user_input", "")) if isinstance(messages[-1], HumanMessage) else ()
     
-    if not has_system_message:
-        # Agregar el prompt del sistema al inicio
-        messages_with_system = [SystemMessage(content=system_prompt)] + list(messages)
+    # Preparar mensajes con el prompt del sistema. `run_agent` lo inyecta una sola
+    # vez en el estado; solo se agrega aquí si el grafo se invocó sin él
+    if state.get("_system_injected"):
+        messages_with_system = (*messages, *ejemplos)
     else:
-        messages_with_system = list(messages)
-    
-    # Obtener respuesta del LLM
-    response = llm_with_tools.invoke(messages_with_system)
-    
-    # Actualizar el estado con la respuesta del agente
-    return {
-        "messages": messages + [response],
-        "user_input": state["user_input"],
-        "media_file_path": state.get("media_file_path")
-    }
+        messages_with_system = (_system_msg(), *messages, *ejemplos)
+    
+    # Obtener respuesta del LLM en streaming: los tokens de texto quedan disponibles
+    # para quien consuma el grafo apenas se generan, y los fragmentos se acumulan
+    # en el mensaje final (incluyendo los tool calls)
+    response = None
+    for chunk in llm_with_tools.stream(messages_with_system):
+        response = chunk if response is None else response + chunk
+    response = message_chunk_to_message(response)
+    
+    # Los nombres que llegan de la API son strings nuevos: internarlos hace que el
+    # despacho del ToolNode (un dict por nombre) los resuelva por identidad
+    for tool_call in response.tool_calls if isinstance(response, AIMessage) else ():
+        tool_call["name"] = sys.intern(tool_call["name"])
+    
+    uso = response.usage_metadata
+    if uso:
+        _log.debug("🧾 Tokens de entrada: %s (prompt del sistema: %s, desde caché: %s)",
+                   uso.get("input_tokens"), prompts.SYSTEM_PROMPT_TOKENS, uso.get("input_token_details", {}).get("cache_read", 0))
+    
+    # Actualizar el estado con la respuesta del agente (`add_messages` la agrega
+    # al historial, sin copiar la lista completa)
+    return {"messages": [response]}
 
 
 # ============================================================================
@@ -845,24 +1786,21 @@ def should_continue(state: AgentState) -> Literal["tools", "end"]:
 # ============================================================================
 # CONSTRUCCIÓN DEL GRAFO
 # ============================================================================
+@functools.lru_cache(maxsize=1)
 def create_despensa_graph():
     """
     Crea y retorna el grafo de LangGraph para el agente de despensa.
+    
+    La topología del grafo y la lista de herramientas son estáticas, así que el
+    grafo se compila una sola vez y se reutiliza en todas las invocaciones.
     """
     # Crear el grafo
     workflow = StateGraph(AgentState)
     
-    # Agregar nodos
-    # Incluir todas las herramientas en el ToolNode
-    all_tools = [
-        consultar_despensa,
-        actualizar_despensa,
-        transcribir_audio,
-        procesar_imagen,
-        procesar_extracto_productos
-    ]
+    # Agregar nodos. El ToolNode solo necesita las herramientas que el agente
+    # tiene enlazadas: los archivos multimedia llegan ya procesados
     workflow.add_node("agent", agent_node)
-    workflow.add_node("tools", ToolNode(all_tools))
+    workflow.add_node("tools", ToolNode(_TEXT_TOOLS))
     
     # Definir el punto de entrada
     workflow.set_entry_point("agent")
@@ -886,69 +1824,178 @@ def create_despensa_graph():
     return app
 
 
+# ============================================================================
+# PRE-PROCESAMIENTO ESPECULATIVO DE ARCHIVOS MULTIMEDIA
+# ============================================================================
+# Cuando llega un archivo multimedia, la transcripción/análisis se hace apenas
+# entra la solicitud, antes de invocar el grafo. El resultado se inyecta en el
+# mensaje inicial, de modo que el agente no necesita una vuelta extra por la
+# herramienta multimodal. En una ráfaga (`run_agent_batch`), los archivos se
+# procesan en paralelo en este executor.
+_MEDIA_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="despensa-media")
+
+
+def _procesar_media(media_file_path: str) -> str:
+    """
+    Ejecuta la herramienta multimodal que corresponde al archivo y retorna su resultado.
+    Los errores se retornan como texto para que el agente pueda explicarlos al usuario.
+    """
+    try:
+        if _classify(media_file_path) == "audio":
+            return transcribir_audio.invoke({"audio_file_path": media_file_path})
+        return procesar_imagen.invoke({"image_file_path": media_file_path})
+    except Exception as e:
+        return f"[ERROR_MEDIA] No se pudo procesar el archivo: {e}"
+
+
+async def _aprocesar_media(media_file_path: str) -> str:
+    """Versión asíncrona de `_procesar_media`."""
+    try:
+        if _classify(media_file_path) == "audio":
+            return await transcribir_audio.ainvoke({"audio_file_path": media_file_path})
+        return await procesar_imagen.ainvoke({"image_file_path": media_file_path})
+    except Exception as e:
+        return f"[ERROR_MEDIA] No se pudo procesar el archivo: {e}"
+
+
 # ============================================================================
 # FUNCIÓN PRINCIPAL PARA PROBAR EL AGENTE
 # ============================================================================
-def run_agent(user_input: str = "", chat_history: list[BaseMessage] = None, media_file_path: Optional[str] = None):
+def _preparar_estado(user_input: str, chat_history: Optional[list], media_file_path: Optional[str]):
     """
-    Ejecuta el agente con un input del usuario (texto, audio o imagen).
-    
-    Args:
-        user_input: Mensaje del usuario en texto (simulado desde WhatsApp)
-        chat_history: Historial previo de la conversación (opcional)
-        media_file_path: Ruta al archivo multimedia (audio o imagen) (opcional)
+    Construye el estado inicial del grafo. Si hay un archivo multimedia, lo procesa
+    primero e inyecta el resultado en el mensaje inicial.
     
     Returns:
-        Respuesta del agente
+        Tupla (estado_inicial, extracto_prefetch)
     """
-    # Crear el grafo
-    app = create_despensa_graph()
+    # No hay otro trabajo que solapar con el archivo: se procesa en este mismo hilo
+    resultado_media = _procesar_media(media_file_path) if media_file_path else None
+    return _estado_inicial(user_input, chat_history, media_file_path, resultado_media)
+
+
+async def _apreparar_estado(user_input: str, chat_history: Optional[list], media_file_path: Optional[str]):
+    """Versión asíncrona de `_preparar_estado`."""
+    resultado_media = await _aprocesar_media(media_file_path) if media_file_path else None
+    return _estado_inicial(user_input, chat_history, media_file_path, resultado_media)
+
+
+# Mensajes que conserva el historial del modo interactivo, y turnos recientes cuyas
+# llamadas a herramientas se mantienen en el contexto
+_HISTORIAL_MAX = 20
+_TURNOS_CON_HERRAMIENTAS = 2
+
+# Presupuesto de contexto del historial (~4 caracteres por token): además del
+# límite de turnos, unos pocos mensajes largos (audios transcritos, listas de
+# compras) no pueden encarecer cada llamada siguiente
+_HISTORIAL_MAX_CARACTERES = int(os.getenv("DESPENSA_HISTORY_CHARS", "8000"))
+
+
+def _recortar_historial(chat_history) -> List[BaseMessage]:
+    """
+    Descarta del historial los resultados de herramientas (y las llamadas que los
+    originaron) anteriores a los últimos `_TURNOS_CON_HERRAMIENTAS` turnos: sus
+    extractos ya se procesaron y solo inflan el prompt. Luego descarta los turnos
+    más antiguos que no caben en `_HISTORIAL_MAX_CARACTERES`.
+    """
+    historial = list(chat_history or ())
+    inicios = [i for i, m in enumerate(historial) if isinstance(m, HumanMessage)]
+    corte = inicios[-_TURNOS_CON_HERRAMIENTAS] if len(inicios) >= _TURNOS_CON_HERRAMIENTAS else 0
     
-    # Preparar el estado inicial
-    initial_messages = chat_history if chat_history else []
+    recortado = [
+        m for i, m in enumerate(historial)
+        if i >= corte or not (isinstance(m, ToolMessage) or (isinstance(m, AIMessage) and m.tool_calls))
+    ]
+    
+    # Si aún excede el presupuesto, descartar turnos completos desde el más antiguo
+    # (el último turno siempre se conserva)
+    tamanos = [len(str(m.content)) for m in recortado]
+    total = sum(tamanos)
+    if total > _HISTORIAL_MAX_CARACTERES:
+        desde = 0
+        for i in [i for i, m in enumerate(recortado) if isinstance(m, HumanMessage)][1:]:
+            total -= sum(tamanos[desde:i])
+            desde = i
+            if total <= _HISTORIAL_MAX_CARACTERES:
+                break
+        recortado = recortado[desde:]
+    
+    # Un resultado sin su llamada (p. ej. cortada por el límite del historial) es inválido para la API
+    llamadas = {tc["id"] for m in recortado if isinstance(m, AIMessage) for tc in m.tool_calls}
+    return [m for m in recortado if not isinstance(m, ToolMessage) or m.tool_call_id in llamadas]
+
+
+def _mensajes_de_entrada(user_input: str, media_file_path: Optional[str], resultado_media: Optional[str]) -> Tuple[List[BaseMessage], Optional[dict]]:
+    """
+    Convierte un mensaje del usuario (texto y/o archivo ya procesado) en los mensajes
+    que recibe el agente. Retorna también el extracto estructurado del archivo, si lo hay.
+    """
+    mensajes = []
     
     # Si hay un archivo multimedia, no necesariamente necesitamos texto
     if user_input:
-        initial_messages.append(HumanMessage(content=user_input))
-    elif media_file_path:
-        # Si solo hay archivo multimedia, agregar un mensaje indicando que hay un archivo
-        file_type = "audio" if os.path.splitext(media_file_path)[1].lower() in ['.wav', '.mp3', '.m4a', '.ogg', '.flac', '.aac'] else "imagen"
-        initial_messages.append(HumanMessage(content=f"El usuario ha enviado un archivo {file_type}: {media_file_path}"))
+        mensajes.append(HumanMessage(content=user_input))
     
-    initial_state = {
+    extracto_prefetch = None
+    if resultado_media is not None:
+        # Inyectar el resultado ya procesado para que el agente no tenga que llamar
+        # a la herramienta multimodal
+        file_type = "audio" if _classify(media_file_path) == "audio" else "imagen"
+        try:
+            extracto_prefetch = _loads(resultado_media).get("extracto_estructurado")
+        except (ValueError, AttributeError):
+            extracto_prefetch = None
+        mensajes.append(HumanMessage(
+            content=f"El usuario ha enviado un archivo {file_type}. Resultado de su procesamiento: {resultado_media}"
+        ))
+    
+    return mensajes, extracto_prefetch
+
+
+def _estado_desde_mensajes(initial_messages: List[BaseMessage], user_input: str) -> dict:
+    """Estado inicial del grafo para mensajes cuyos archivos ya fueron procesados."""
+    return {
         "messages": initial_messages,
         "user_input": user_input or "",
-        "media_file_path": media_file_path
+        "_system_injected": True
     }
-    
-    # Ejecutar el grafo
-    result = app.invoke(initial_state)
-    
+
+
+def _estado_inicial(user_input: str, chat_history: Optional[list], media_file_path: Optional[str], resultado_media: Optional[str]):
+    """Arma el estado inicial del grafo a partir del input y del archivo ya procesado."""
+    # Preparar el estado inicial con el prompt del sistema al inicio. Se copia el
+    # historial (sin resultados de herramientas viejos) para no modificar la lista del llamador
+    mensajes, extracto_prefetch = _mensajes_de_entrada(user_input, media_file_path, resultado_media)
+    initial_messages = [_system_msg()] + _recortar_historial(chat_history) + mensajes
+    
+    return _estado_desde_mensajes(initial_messages, user_input), extracto_prefetch
+
+
+def _construir_respuesta(result: dict, extracto_prefetch: Optional[dict]):
+    """
+    Extrae la respuesta final del estado resultante y, si hay un extracto
+    estructurado, lo procesa contra la despensa.
+    """
     # Obtener la última respuesta del agente
     last_message = result["messages"][-1]
     respuesta_final = last_message.content if hasattr(last_message, "content") else str(last_message)
     
-    # Buscar extractos estructurados en los mensajes de herramientas
-    extracto_estructurado = None
-    for msg in reversed(result["messages"]):
-        if hasattr(msg, "content"):
-            contenido = msg.content
-            # Buscar si hay un extracto estructurado en el contenido
-            if isinstance(contenido, str) and "extracto_estructurado" in contenido:
-                try:
-                    datos = json.loads(contenido)
-                    if "extracto_estructurado" in datos:
-                        extracto_estructurado = datos["extracto_estructurado"]
-                        break
-                except:
-                    pass
+    # Buscar el extracto estructurado en el resultado más reciente de una herramienta
+    # multimodal. Solo se parsean sus ToolMessage, no el resto de la conversación
+    extracto_estructurado = extracto_prefetch
+    for msg in reversed(result["messages"] if extracto_estructurado is None else ()):
+        if isinstance(msg, ToolMessage) and msg.name in _MEDIA_TOOL_NAMES:
+            try:
+                extracto_estructurado = _loads(msg.content).get("extracto_estructurado")
+            except (ValueError, TypeError, AttributeError):
+                # Mensajes de error de la herramienta (texto plano, no JSON)
+                pass
+            break
     
     # Si hay extracto estructurado, procesarlo y retornar información completa
     if extracto_estructurado:
         try:
-            resultado_procesado = json.loads(procesar_extracto_productos.invoke({
-                "extracto_json": json.dumps(extracto_estructurado)
-            }))
+            resultado_procesado = _procesar_extracto(extracto_estructurado)
             
             # Retornar respuesta con extracto procesado para integración con BD
             return {
@@ -958,19 +2005,209 @@ def run_agent(user_input: str = "", chat_history: list[BaseMessage] = None, medi
                 "formato": "JSON_READY"
             }
         except Exception as e:
-            print(f"⚠️  Error procesando extracto: {e}")
-            import traceback
-            traceback.print_exc()
+            _log.warning("⚠️  Error procesando extracto: %s", e, exc_info=True)
             # Retornar solo la respuesta si falla el procesamiento
             return respuesta_final
     
     return respuesta_final
 
 
+def run_agent(user_input: str = "", chat_history: list[BaseMessage] = None, media_file_path: Optional[str] = None):
+    """
+    Ejecuta el agente con un input del usuario (texto, audio o imagen).
+    
+    Args:
+        user_input: Mensaje del usuario en texto (simulado desde WhatsApp)
+        chat_history: Historial previo de la conversación (opcional)
+        media_file_path: Ruta al archivo multimedia (audio o imagen) (opcional)
+    
+    Returns:
+        Respuesta del agente
+    """
+    # Consultas de texto repetidas con el mismo contexto se responden desde caché
+    clave = None
+    if user_input and not media_file_path:
+        clave = _clave_cache(user_input, chat_history)
+        respuesta_cacheada = _cache_get(clave)
+        if respuesta_cacheada is not None:
+            _log.debug("⚡ Respuesta obtenida desde caché")
+            return respuesta_cacheada
+    
+    # Obtener el grafo compilado (se construye solo en la primera llamada)
+    app = create_despensa_graph()
+    
+    initial_state, extracto_prefetch = _preparar_estado(user_input, chat_history, media_file_path)
+    
+    # Ejecutar el grafo
+    result = app.invoke(initial_state)
+    
+    respuesta_final = _construir_respuesta(result, extracto_prefetch)
+    
+    if clave is not None and isinstance(respuesta_final, str):
+        _cache_put(clave, respuesta_final)
+    
+    return respuesta_final
+
+
+def run_agent_batch(inputs: List[Dict[str, Any]], chat_history: list[BaseMessage] = None):
+    """
+    Procesa una ráfaga de mensajes de un mismo usuario (ej: audio + imagen + texto
+    enviados seguidos) en una sola ejecución del grafo: los archivos se procesan en
+    paralelo y el agente ve todos los mensajes a la vez, así que responde en un solo
+    viaje al LLM (con llamadas a herramientas en paralelo si necesita varias).
+    
+    Args:
+        inputs: Lista de mensajes, cada uno con "user_input" y/o "media_file_path"
+        chat_history: Historial previo de la conversación (opcional)
+    
+    Returns:
+        Respuesta del agente. Si hubo archivos con extracto estructurado, un dict con
+        la respuesta y los extractos procesados de cada uno, en orden
+    """
+    if not inputs:
+        return ""
+    
+    app = create_despensa_graph()
+    
+    # Procesar todos los archivos multimedia en paralelo antes de invocar el grafo
+    rutas = [entrada.get("media_file_path") for entrada in inputs]
+    resultados_media = list(_MEDIA_EXECUTOR.map(lambda ruta: _procesar_media(ruta) if ruta else None, rutas))
+    
+    initial_messages = [_system_msg()] + _recortar_historial(chat_history)
+    extractos = []
+    for entrada, ruta, resultado_media in zip(inputs, rutas, resultados_media):
+        mensajes, extracto = _mensajes_de_entrada(entrada.get("user_input", ""), ruta, resultado_media)
+        initial_messages.extend(mensajes)
+        if extracto:
+            extractos.append(extracto)
+    
+    user_input = "\n".join(entrada["user_input"] for entrada in inputs if entrada.get("user_input"))
+    result = app.invoke(_estado_desde_mensajes(initial_messages, user_input))
+    
+    if not extractos:
+        return _construir_respuesta(result, None)
+    
+    last_message = result["messages"][-1]
+    return {
+        "respuesta": last_message.content if hasattr(last_message, "content") else str(last_message),
+        "extractos_estructurados": extractos,
+        "resultados_procesados": [_procesar_extracto(extracto) for extracto in extractos],
+        "formato": "JSON_READY"
+    }
+
+
+def run_agent_bulk(inputs: List[str], bulk: bool = True, intervalo_sondeo: float = 30.0) -> List[Dict[str, Any]]:
+    """
+    Ingesta masiva de mensajes (ej: varias boletas o una lista larga de productos).
+    No pasa por el grafo conversacional: extrae los productos de cada input y los
+    aplica directamente sobre la despensa.
+    
+    Args:
+        inputs: Textos a procesar
+        bulk: Si es True usa la Batch API (más barata, asíncrona); si es False
+            usa el endpoint síncrono, uno por uno
+        intervalo_sondeo: Segundos entre consultas del estado del batch
+    
+    Returns:
+        Lista con el extracto y el resultado procesado de cada input, en orden
+    """
+    if not inputs:
+        return []
+    
+    if bulk:
+        extractos = _extraer_productos_batch(inputs, intervalo_sondeo)
+    else:
+        extractos = list(_EXTRACTION_EXECUTOR.map(extraer_productos_desde_texto, inputs))
+    
+    return [
+        {
+            "extracto_estructurado": extracto,
+            "resultado_procesado": _procesar_extracto(extracto),
+            "formato": "JSON_READY",
+        }
+        for extracto in extractos
+    ]
+
+
+async def arun_agent(user_input: str = "", chat_history: list[BaseMessage] = None, media_file_path: Optional[str] = None):
+    """
+    Versión asíncrona de `run_agent`: libera el event loop mientras espera a OpenAI,
+    de modo que un servidor asíncrono puede atender varias conversaciones a la vez.
+    
+    Args:
+        user_input: Mensaje del usuario en texto
+        chat_history: Historial previo de la conversación (opcional)
+        media_file_path: Ruta al archivo multimedia (audio o imagen) (opcional)
+    
+    Returns:
+        Respuesta del agente
+    """
+    clave = None
+    if user_input and not media_file_path:
+        clave = _clave_cache(user_input, chat_history)
+        respuesta_cacheada = _cache_get(clave)
+        if respuesta_cacheada is not None:
+            _log.debug("⚡ Respuesta obtenida desde caché")
+            return respuesta_cacheada
+    
+    app = create_despensa_graph()
+    initial_state, extracto_prefetch = await _apreparar_estado(user_input, chat_history, media_file_path)
+    
+    result = await app.ainvoke(initial_state)
+    
+    respuesta_final = _construir_respuesta(result, extracto_prefetch)
+    
+    if clave is not None and isinstance(respuesta_final, str):
+        _cache_put(clave, respuesta_final)
+    
+    return respuesta_final
+
+
+def run_agent_stream(user_input: str = "", chat_history: list[BaseMessage] = None, media_file_path: Optional[str] = None):
+    """
+    Variante de `run_agent` que entrega la respuesta del agente a medida que se genera.
+    
+    Args:
+        user_input: Mensaje del usuario en texto
+        chat_history: Historial previo de la conversación (opcional)
+        media_file_path: Ruta al archivo multimedia (audio o imagen) (opcional)
+    
+    Yields:
+        Fragmentos de texto de la respuesta del agente
+    
+    Returns:
+        Al agotarse, lo mismo que `run_agent` (la respuesta completa o el dict con
+        el extracto y el resultado de procesarlo contra la despensa). Se obtiene con
+        `resultado = yield from run_agent_stream(...)` o desde `StopIteration.value`
+    """
+    app = create_despensa_graph()
+    initial_state, extracto_prefetch = _preparar_estado(user_input, chat_history, media_file_path)
+    
+    estado_final = initial_state
+    for modo, payload in app.stream(initial_state, stream_mode=["messages", "values"]):
+        if modo == "values":
+            estado_final = payload
+            continue
+        
+        chunk, metadata = payload
+        # Solo interesan los tokens de texto generados por el nodo del agente
+        if metadata.get("langgraph_node") == "agent" and isinstance(chunk.content, str) and chunk.content:
+            yield chunk.content
+    
+    # Procesar el extracto (si lo hay) igual que en la versión no-streaming. El texto
+    # ya se entregó por fragmentos; el resultado completo va como valor de retorno
+    return _construir_respuesta(estado_final, extracto_prefetch)
+
+
 # ============================================================================
 # EJECUCIÓN PRINCIPAL (Para pruebas)
 # ============================================================================
 if __name__ == "__main__":
+    # INFO por defecto: el detalle por petición queda en DEBUG y no se formatea.
+    # DESPENSA_LOG_LEVEL=DEBUG lo vuelve a mostrar
+    logging.basicConfig(level=os.getenv("DESPENSA_LOG_LEVEL", "INFO").upper(), format="%(message)s")
+    _cargar_entorno()
+    
     # Verificar que existe la API key
     if not os.getenv("OPENAI_API_KEY"):
         print("⚠️  Error: OPENAI_API_KEY no encontrada en las variables de entorno.")
@@ -997,49 +2234,52 @@ if __name__ == "__main__":
     print("   - 'imagen:compra_arroz.png'")
     print("\nEscribe 'salir' para terminar.\n")
     
-    chat_history = []
-    
-    while True:
-        user_input = input("\n👤 Tú: ").strip()
-        
-        if user_input.lower() in ["salir", "exit", "quit"]:
-            print("\n👋 ¡Hasta luego!")
-            break
+    async def _main():
+        """Bucle interactivo asíncrono: cada turno se ejecuta con `arun_agent`."""
+        # Historial acotado: el prompt no crece indefinidamente con cada turno
+        chat_history = deque(maxlen=_HISTORIAL_MAX)
         
-        if not user_input:
-            continue
-        
-        try:
-            # Detectar si el input es un archivo multimedia
-            media_file_path = None
-            text_input = user_input
-            
-            # Detectar formato: "audio:archivo.wav" o "imagen:archivo.jpg"
-            if user_input.startswith("audio:"):
-                media_file_path = user_input.replace("audio:", "").strip()
-                text_input = ""
-            elif user_input.startswith("imagen:"):
-                media_file_path = user_input.replace("imagen:", "").strip()
-                text_input = ""
-            elif os.path.exists(user_input) and os.path.isfile(user_input):
-                # Si es una ruta de archivo válida
-                media_file_path = user_input
-                text_input = ""
+        while True:
+            user_input = (await asyncio.to_thread(input, "\n👤 Tú: ")).strip()
             
-            print("\n🤖 Agente: ", end="", flush=True)
-            response = run_agent(text_input, chat_history, media_file_path)
-            print(response)
+            if user_input.lower() in ["salir", "exit", "quit"]:
+                print("\n👋 ¡Hasta luego!")
+                break
             
-            # Actualizar historial
-            if text_input:
-                chat_history.append(HumanMessage(content=text_input))
-            elif media_file_path:
-                file_type = "audio" if os.path.splitext(media_file_path)[1].lower() in ['.wav', '.mp3', '.m4a', '.ogg', '.flac', '.aac'] else "imagen"
-                chat_history.append(HumanMessage(content=f"Archivo {file_type}: {media_file_path}"))
-            chat_history.append(AIMessage(content=response))
+            if not user_input:
+                continue
             
-        except Exception as e:
-            print(f"\n❌ Error: {e}")
-            import traceback
-            traceback.print_exc()
-
+            try:
+                # Detectar si el input es un archivo multimedia
+                media_file_path = None
+                text_input = user_input
+                
+                # Detectar formato: "audio:archivo.wav" o "imagen:archivo.jpg"
+                if user_input.startswith("audio:"):
+                    media_file_path = user_input.replace("audio:", "").strip()
+                    text_input = ""
+                elif user_input.startswith("imagen:"):
+                    media_file_path = user_input.replace("imagen:", "").strip()
+                    text_input = ""
+                elif os.path.exists(user_input) and os.path.isfile(user_input):
+                    # Si es una ruta de archivo válida
+                    media_file_path = user_input
+                    text_input = ""
+                
+                print("\n🤖 Agente: ", end="", flush=True)
+                response = await arun_agent(text_input, chat_history, media_file_path)
+                print(response)
+                
+                # Actualizar historial
+                if text_input:
+                    chat_history.append(HumanMessage(content=text_input))
+                elif media_file_path:
+                    file_type = "audio" if _classify(media_file_path) == "audio" else "imagen"
+                    chat_history.append(HumanMessage(content=f"Archivo {file_type}: {media_file_path}"))
+                chat_history.append(AIMessage(content=response))
+                
+            except Exception as e:
+                print(f"\n❌ Error: {e}")
+                _log.debug("Detalle del error", exc_info=True)
+    
+    asyncio.run(_main())
@@ -0,0 +1,211 @@
+"""
+Prompts del Agente de Despensa.
+
+El prompt del sistema va siempre al inicio de cada llamada al LLM y no cambia
+entre turnos ni entre usuarios, así que es un prefijo idéntico en todas las
+peticiones. Hoy mide unos 140 tokens (ver SYSTEM_PROMPT_TOKENS): por debajo del
+mínimo de 1024 tokens de la caché automática de OpenAI, que por lo tanto no lo
+reutiliza. Sí lo aprovechan los servidores propios con caché de prefijos (vLLM,
+llama.cpp; ver README), que no tienen ese mínimo, y OpenAI lo hará si el prefijo
+fijo crece por encima del umbral.
+
+Nunca anteponer nada a SYSTEM_PROMPT: rompería esa caché de prefijos. El
+contexto propio de cada usuario o sesión se agrega al final con `compose_system`.
+
+El texto vive en `system_prompt.txt` y se carga recién la primera vez que se
+accede a alguno de sus atributos (ej: `prompts.SYSTEM_PROMPT`). Está armado por
+capas separadas por una línea en blanco, de la más estable a la más volátil:
+identidad (PERSONALITY_BLOCK), catálogo de herramientas (TOOLS_BLOCK) y reglas
+(RULES_BLOCK). Las cachés de prefijos reutilizan el tramo idéntico más largo,
+así que editar las reglas no invalida la caché de las capas anteriores. El
+bloque de herramientas se genera desde el código con `python scripts/build_prompt.py`.
+
+Los ejemplos de uso de cada herramienta no van en el prompt: viven en
+`examples.jsonl` y `ejemplos_relevantes` elige en cada turno solo los más
+parecidos al mensaje del usuario.
+"""
+
+import functools
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import sys
+import unicodedata
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+# Vocabulario del contrato entre el prompt, las herramientas y la despensa. Son
+# frozensets para validar con una sola búsqueda por hash, sin construir listas
+ESTADOS_VALIDOS = frozenset({"BAJO", "MEDIO", "ALTO"})
+
+# Nombres de herramientas internados: las tablas de despacho que los usan como
+# clave resuelven por identidad en vez de comparar caracteres
+TOOL_CONSULTAR = sys.intern("consultar_despensa")
+TOOL_ACTUALIZAR = sys.intern("actualizar_despensa")
+TOOL_PROCESAR_EXTRACTO = sys.intern("procesar_extracto_productos")
+TOOL_TRANSCRIBIR = sys.intern("transcribir_audio")
+TOOL_IMAGEN = sys.intern("procesar_imagen")
+
+TOOL_NAMES = frozenset({
+    TOOL_CONSULTAR,
+    TOOL_ACTUALIZAR,
+    TOOL_PROCESAR_EXTRACTO,
+    TOOL_TRANSCRIBIR,
+    TOOL_IMAGEN,
+})
+
+_PROMPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "system_prompt.txt")
+_EJEMPLOS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples.jsonl")
+
+
+@functools.lru_cache(maxsize=1)
+def _tokenizador():
+    """Tokenizador de gpt-4o-mini, o None si tiktoken no está disponible."""
+    if not TIKTOKEN_AVAILABLE:
+        return None
+    try:
+        return tiktoken.encoding_for_model("gpt-4o-mini")
+    except Exception:
+        # El archivo del tokenizador se descarga la primera vez; sin red se estima
+        return None
+
+
+def _contar_tokens(texto: str) -> int:
+    """Cuenta tokens con el tokenizador de gpt-4o-mini; si no está disponible, estima ~4 bytes por token."""
+    tokenizador = _tokenizador()
+    if tokenizador is not None:
+        return len(tokenizador.encode(texto))
+    return len(texto.encode("utf-8")) // 4
+
+
+def _canonizar(texto: str) -> str:
+    """
+    Deja el prompt en una forma canónica: Unicode NFC, saltos de línea LF y sin
+    espacios al final de cada línea. Así, el mismo texto guardado desde editores
+    distintos (tildes en NFD, CRLF) produce exactamente los mismos bytes y no
+    rompe la caché de prefijos.
+    """
+    texto = unicodedata.normalize("NFC", texto)
+    lineas = texto.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(linea.rstrip() for linea in lineas).strip("\n")
+
+
+@functools.lru_cache(maxsize=1)
+def _prompt() -> Dict[str, Any]:
+    """Lee el prompt del sistema y calcula, una sola vez, todos sus derivados."""
+    # El archivo se mapea en memoria de solo lectura: con varios workers (gunicorn)
+    # todos comparten las mismas páginas físicas del page cache. El mapa queda
+    # abierto y se expone como SYSTEM_PROMPT_MMAP para quien consuma bytes sin copiar
+    with open(_PROMPT_PATH, "rb") as f:
+        mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    system_prompt = _canonizar(mapa[:].decode("utf-8"))
+    personalidad, herramientas, reglas = system_prompt.split("\n\n")
+    
+    # El prompt es fijo: sus bytes UTF-8 se calculan una sola vez, en lugar de en
+    # cada petición
+    system_prompt_bytes = system_prompt.encode("utf-8")
+    
+    # Hash estable del prompt: identifica la caché de prefijo (KV) en servidores
+    # propios y cambia solo cuando el prompt se edita, invalidándola automáticamente
+    system_prompt_sha = hashlib.sha256(system_prompt_bytes).hexdigest()
+    
+    # Identificador corto del prefijo compartido: todas las peticiones que empiezan
+    # con este prompt pueden agruparse y reutilizar el mismo KV (ver README)
+    system_prompt_prefix_id = f"despensa-{system_prompt_sha[:12]}"
+    
+    return {
+        "SYSTEM_PROMPT": system_prompt,
+        "PERSONALITY_BLOCK": personalidad,
+        "TOOLS_BLOCK": herramientas,
+        "RULES_BLOCK": reglas,
+        "SYSTEM_PROMPT_BYTES": system_prompt_bytes,
+        "SYSTEM_PROMPT_MMAP": mapa,
+        "SYSTEM_PROMPT_SHA": system_prompt_sha,
+        "SYSTEM_PROMPT_PREFIX_ID": system_prompt_prefix_id,
+        # Clave de caché de prompts: enruta las llamadas del agente a los mismos
+        # servidores de OpenAI para aumentar los aciertos sobre el prefijo compartido.
+        # Incluye el hash para que un prompt editado no compita con el anterior
+        "PROMPT_CACHE_KEY": f"{system_prompt_prefix_id}-agent",
+    }
+
+
+_ATRIBUTOS_PEREZOSOS = frozenset({
+    "SYSTEM_PROMPT", "PERSONALITY_BLOCK", "TOOLS_BLOCK", "RULES_BLOCK",
+    "SYSTEM_PROMPT_BYTES", "SYSTEM_PROMPT_MMAP", "SYSTEM_PROMPT_SHA", "SYSTEM_PROMPT_PREFIX_ID",
+    "PROMPT_CACHE_KEY",
+})
+
+
+@functools.lru_cache(maxsize=1)
+def _system_prompt_tokens() -> int:
+    return _contar_tokens(_prompt()["SYSTEM_PROMPT"])
+
+
+def __getattr__(name: str) -> Any:
+    """Materializa el prompt y sus derivados en el primer acceso."""
+    if name == "SYSTEM_PROMPT_TOKENS":
+        # Aparte: cargar el tokenizador es lo más caro y solo lo necesitan las métricas
+        valor = _system_prompt_tokens()
+        globals()[name] = valor
+        return valor
+    if name not in _ATRIBUTOS_PEREZOSOS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    # Se guardan como atributos del módulo para que los siguientes accesos sean directos
+    valores = _prompt()
+    globals().update(valores)
+    return valores[name]
+
+
+def _trigramas(texto: str) -> FrozenSet[str]:
+    """Trigramas de caracteres del texto en minúsculas, sin tildes ni puntuación."""
+    sin_tildes = "".join(c for c in unicodedata.normalize("NFD", texto.lower()) if not unicodedata.combining(c))
+    normalizado = " ".join("".join(c if c.isalnum() else " " for c in sin_tildes).split())
+    relleno = f" {normalizado} "
+    return frozenset(relleno[i:i + 3] for i in range(len(relleno) - 2))
+
+
+@functools.lru_cache(maxsize=1)
+def _banco_ejemplos() -> Tuple[Tuple[Dict[str, str], FrozenSet[str]], ...]:
+    """Carga `examples.jsonl` y precalcula los trigramas de cada ejemplo una sola vez."""
+    try:
+        with open(_EJEMPLOS_PATH, "r", encoding="utf-8") as f:
+            ejemplos = [json.loads(linea) for linea in f if linea.strip()]
+    except FileNotFoundError:
+        return ()
+    return tuple((ejemplo, _trigramas(ejemplo["text"])) for ejemplo in ejemplos)
+
+
+def ejemplos_relevantes(user_msg: str, k: int = 2) -> List[Dict[str, str]]:
+    """
+    Retorna los `k` ejemplos de `examples.jsonl` más parecidos al mensaje del
+    usuario (similitud coseno sobre trigramas de caracteres, que tolera tildes y
+    conjugaciones: "compre" ~ "compré"). Si ninguno se parece, retorna una lista vacía.
+    """
+    consulta = _trigramas(user_msg)
+    if not consulta:
+        return []
+    banco = _banco_ejemplos()
+    puntajes = (
+        (len(consulta & trigramas) / (len(consulta) * len(trigramas)) ** 0.5, i)
+        for i, (_, trigramas) in enumerate(banco)
+    )
+    return [banco[i][0] for puntaje, i in heapq.nlargest(k, puntajes) if puntaje > 0]
+
+
+def compose_system(user_context: Optional[str] = None) -> str:
+    """
+    Arma el prompt del sistema agregando el contexto del usuario o de la sesión
+    (nombre, despensa, idioma...) siempre después de `SYSTEM_PROMPT`, para que el
+    prefijo cacheable quede intacto.
+    """
+    system_prompt = _prompt()["SYSTEM_PROMPT"]
+    if not user_context:
+        return system_prompt
+    return system_prompt + "\n\n" + user_context
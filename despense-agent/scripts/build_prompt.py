@@ -0,0 +1,94 @@
+"""
+Genera el bloque de herramientas (TOOLS_BLOCK) de `system_prompt.txt` a partir de
+las herramientas definidas en `despensa_agent.py`.
+
+La lista de herramientas sale de `_TEXT_TOOLS` (las que el agente tiene enlazadas,
+en ese orden) y la descripción de cada una, de la primera línea del docstring de
+su función @tool, así que el prompt no se desalinea de la implementación. Las capas de identidad y reglas se mantienen a mano, y los
+ejemplos de uso viven en `examples.jsonl` (se eligen por turno, no van en el prompt).
+
+La salida es determinista: el mismo código produce byte a byte el mismo prompt,
+y con ello el mismo prefijo cacheable.
+
+Uso:
+    python scripts/build_prompt.py          # reescribe system_prompt.txt
+    python scripts/build_prompt.py --check  # falla si el archivo está desactualizado
+"""
+
+import ast
+import os
+import sys
+
+_RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_AGENTE = os.path.join(_RAIZ, "despensa_agent.py")
+_PROMPT = os.path.join(_RAIZ, "system_prompt.txt")
+
+_ENCABEZADO = "HERRAMIENTAS (sus parámetros van en el esquema de cada una):"
+
+# Lista de despensa_agent.py con las herramientas enlazadas al agente
+_LISTA_HERRAMIENTAS = "_TEXT_TOOLS"
+
+
+def _leer_modulo(path: str) -> ast.Module:
+    """Parsea el módulo del agente sin importarlo (no requiere sus dependencias)."""
+    with open(path, "r", encoding="utf-8") as f:
+        return ast.parse(f.read(), filename=path)
+
+
+def _herramientas_del_agente(arbol: ast.Module, path: str) -> list:
+    """Retorna los nombres de `_TEXT_TOOLS`, en orden."""
+    for nodo in arbol.body:
+        if isinstance(nodo, ast.Assign) and any(isinstance(t, ast.Name) and t.id == _LISTA_HERRAMIENTAS for t in nodo.targets):
+            if not isinstance(nodo.value, (ast.List, ast.Tuple)) or not all(isinstance(e, ast.Name) for e in nodo.value.elts):
+                raise SystemExit(f"{_LISTA_HERRAMIENTAS} en {path} debe ser una lista de nombres de herramientas")
+            return [e.id for e in nodo.value.elts]
+    raise SystemExit(f"No se encontró {_LISTA_HERRAMIENTAS} en {path}")
+
+
+def _descripciones_de_herramientas(arbol: ast.Module) -> dict:
+    """Retorna la primera línea del docstring de cada función @tool."""
+    descripciones = {}
+    for nodo in arbol.body:
+        if not isinstance(nodo, ast.FunctionDef):
+            continue
+        if not any(isinstance(d, ast.Name) and d.id == "tool" for d in nodo.decorator_list):
+            continue
+        docstring = ast.get_docstring(nodo) or ""
+        descripciones[nodo.name] = docstring.strip().splitlines()[0] if docstring.strip() else ""
+    return descripciones
+
+
+def construir_bloque_herramientas(path: str = _AGENTE) -> str:
+    """Arma el texto de TOOLS_BLOCK."""
+    arbol = _leer_modulo(path)
+    descripciones = _descripciones_de_herramientas(arbol)
+    lineas = [_ENCABEZADO]
+    for nombre in _herramientas_del_agente(arbol, path):
+        if nombre not in descripciones:
+            raise SystemExit(f"La herramienta '{nombre}' no está definida con @tool en {path}")
+        lineas.append(f"- '{nombre}': {descripciones[nombre]}")
+    return "\n".join(lineas)
+
+
+def main() -> int:
+    with open(_PROMPT, "r", encoding="utf-8") as f:
+        actual = f.read()
+    
+    personalidad, _, reglas = actual.rstrip("\n").split("\n\n")
+    nuevo = "\n\n".join((personalidad, construir_bloque_herramientas(), reglas)) + "\n"
+    
+    if "--check" in sys.argv[1:]:
+        if nuevo != actual:
+            print("❌ system_prompt.txt está desactualizado. Ejecuta: python scripts/build_prompt.py")
+            return 1
+        print("✅ system_prompt.txt está al día")
+        return 0
+    
+    with open(_PROMPT, "w", encoding="utf-8") as f:
+        f.write(nuevo)
+    print(f"✅ system_prompt.txt generado ({len(nuevo.encode('utf-8'))} bytes)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
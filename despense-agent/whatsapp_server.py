@@ -3,18 +3,67 @@ Servidor Flask para integrar el Agente de Despensa con WhatsApp usando Meta What
 """
 
 import os
+import hashlib
+import hmac
+import importlib.util
 import requests
+import shutil
 import tempfile
 import json
-from flask import Flask, request, jsonify
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue
+from typing import Optional, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, request
 from dotenv import load_dotenv
-from despensa_agent import run_agent
+from despensa_agent import run_agent, IMAGEN_MAX_MB
 from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.rate_limiters import InMemoryRateLimiter
+
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+except ImportError:
+    HTTPX_AVAILABLE = False
+
+# orjson parsea y serializa los webhooks (texto en español, UTF-8) varias veces
+# más rápido que json; es opcional
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Redis comparte historiales y mensajes ya vistos entre varios procesos (gunicorn
+# con más de un worker); es opcional y solo se usa si REDIS_URL está configurado
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
 
 # Cargar variables de entorno
 load_dotenv()
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
 
+# INFO por defecto: el detalle de cada webhook (payloads completos, headers)
+# queda en DEBUG y ni siquiera se serializa. DESPENSA_LOG_LEVEL=DEBUG lo muestra
+logging.basicConfig(level=os.getenv("DESPENSA_LOG_LEVEL", "INFO").upper(), format="%(message)s")
+_log = logging.getLogger(__name__)
+# httpx registra cada petición en INFO; solo interesan sus advertencias
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Separadores de los bloques de log
+_SEPARADOR = "=" * 70
+_SEPARADOR_MENSAJE = "=" * 60
+_SEPARADOR_CAMBIO = "-" * 60
+
 app = Flask(__name__)
 
 # Configuración de WhatsApp Cloud API
@@ -23,9 +72,258 @@ WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
 WHATSAPP_VERIFY_TOKEN = os.getenv("WHATSAPP_VERIFY_TOKEN", "mi_token_secreto")
 WHATSAPP_API_VERSION = os.getenv("WHATSAPP_API_VERSION", "v22.0")  # Actualizado a v22.0 según el curl de Meta
 WHATSAPP_API_URL = f"https://graph.facebook.com/{WHATSAPP_API_VERSION}/{WHATSAPP_PHONE_NUMBER_ID}/messages"
+# Secreto de la app de Meta: firma cada webhook (X-Hub-Signature-256). Sin él no
+# se verifican las firmas
+WHATSAPP_APP_SECRET = os.getenv("WHATSAPP_APP_SECRET")
+_APP_SECRET_BYTES = WHATSAPP_APP_SECRET.encode() if WHATSAPP_APP_SECRET else None
+
+# La configuración se valida una sola vez al importar: sin token o número no se
+# puede responder, y es mejor saberlo al arrancar que en el primer mensaje
+AUTH_HEADER = f"Bearer {WHATSAPP_TOKEN}"
+ENVIO_CONFIGURADO = bool(WHATSAPP_TOKEN and WHATSAPP_PHONE_NUMBER_ID)
+if not ENVIO_CONFIGURADO:
+    _log.error("❌ WHATSAPP_TOKEN o WHATSAPP_PHONE_NUMBER_ID no configurados: el servidor no podrá responder mensajes")
+
+# Sesión HTTP compartida para todas las llamadas a la Graph API: reutiliza las
+# conexiones keep-alive (sin un handshake TCP+TLS por mensaje) y lleva el token
+# ya configurado. Los reintentos solo aplican a métodos idempotentes (GET), así
+# que un POST de envío nunca se duplica
+SESSION = requests.Session()
+SESSION.headers.update({"Authorization": AUTH_HEADER})
+# pool_block: si los workers superan el pool, esperan una conexión libre en vez
+# de abrir conexiones extra que luego se descartan
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    pool_block=True,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# Timeouts (conexión, lectura) de cada llamada a la Graph API: una conexión
+# colgada de Meta no puede bloquear un worker indefinidamente. Conectar debe ser
+# rápido (3.05s, justo sobre el reintento SYN de 3s); leer depende de la operación
+_TIMEOUT_ENVIO = (3.05, 10)
+_TIMEOUT_CONSULTA = (3.05, 30)
+_TIMEOUT_DESCARGA = (3.05, 60)
+
+# Cliente para la Graph API (envíos y descargas). Con httpx (y h2) usa HTTP/2:
+# los pedidos comparten una conexión multiplexada por host, sin esperar uno por
+# otro. Sin httpx, todo usa SESSION
+HTTPX_CLIENT = httpx.Client(
+    http2=importlib.util.find_spec("h2") is not None,
+    headers={"Authorization": AUTH_HEADER},
+    timeout=httpx.Timeout(_TIMEOUT_DESCARGA[1], connect=_TIMEOUT_DESCARGA[0]),
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+) if HTTPX_AVAILABLE else None
+_HTTPX_TIMEOUT_ENVIO = httpx.Timeout(_TIMEOUT_ENVIO[1], connect=_TIMEOUT_ENVIO[0]) if HTTPX_AVAILABLE else None
+_HTTPX_TIMEOUT_CONSULTA = httpx.Timeout(_TIMEOUT_CONSULTA[1], connect=_TIMEOUT_CONSULTA[0]) if HTTPX_AVAILABLE else None
+
+# Extensión del archivo temporal según el tipo MIME del multimedia
+EXTENSION_MAP = {
+    "audio/ogg": ".ogg",
+    "audio/ogg; codecs=opus": ".ogg",
+    "audio/mpeg": ".mp3",
+    "audio/mp4": ".m4a",
+    "audio/wav": ".wav",
+    "audio/x-m4a": ".m4a",
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp"
+}
+
+# Imágenes que el agente puede analizar, y el mismo tamaño máximo que aplica
+# procesar_imagen: lo que no cumple se rechaza sin descargarlo
+_IMAGEN_MIME_SOPORTADOS = frozenset(mime for mime in EXTENSION_MAP if mime.startswith("image/"))
+_MAX_BYTES_IMAGEN = IMAGEN_MAX_MB * 1024 * 1024
+
+# Directorio de los multimedia descargados: /dev/shm (tmpfs) si existe, para
+# que escribir el archivo y que el agente lo vuelva a leer no toque el disco.
+# Configurable con MEDIA_TMP_DIR; None usa el directorio temporal del sistema
+_MEDIA_TMP_DIR = os.getenv("MEDIA_TMP_DIR") or (
+    "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+)
+
+# Caracteres que se quitan de los números de teléfono (en una sola pasada)
+_PHONE_STRIP = str.maketrans("", "", "+ -")
+
+# Cuerpo de un mensaje de texto saliente, ya serializado salvo el destinatario y
+# el texto: cada respuesta solo serializa esos dos strings y concatena bytes
+_MENSAJE_PREFIJO = b'{"messaging_product":"whatsapp","recipient_type":"individual","to":'
+_MENSAJE_MEDIO = b',"type":"text","text":{"preview_url":false,"body":'
+_MENSAJE_SUFIJO = b'}}'
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Límite de la Cloud API para el cuerpo de un mensaje de texto
+_MAX_TEXTO = 4096
+
+# Token bucket de envíos, compartido por todos los workers del proceso: respeta
+# el throughput del número de WhatsApp (WHATSAPP_MPS mensajes por segundo)
+WHATSAPP_MPS = float(os.getenv("WHATSAPP_MPS", 50))
+_SEND_LIMITER = InMemoryRateLimiter(
+    requests_per_second=WHATSAPP_MPS,
+    check_every_n_seconds=0.01,
+    max_bucket_size=WHATSAPP_MPS,
+)
+
+# Errores de red de cualquiera de los dos clientes HTTP
+_TIMEOUT_ERRORS = (requests.exceptions.Timeout,) + ((httpx.TimeoutException,) if HTTPX_AVAILABLE else ())
+_HTTP_ERRORS = (requests.exceptions.RequestException,) + ((httpx.HTTPError,) if HTTPX_AVAILABLE else ())
+
+# Almacenar historial de conversación por número de teléfono. Es un LRU acotado:
+# se conservan las MAX_USERS conversaciones más recientes y, de cada una, los
+# últimos MAX_TURNS turnos, así la memoria y el prompt del agente no crecen sin límite
+MAX_USERS = int(os.getenv("MAX_CHAT_HISTORIES", 1000))
+MAX_TURNS = 10
+chat_histories = OrderedDict()
+_chat_histories_lock = threading.Lock()
+
+# Con REDIS_URL, el historial de cada número vive en una lista de Redis (el turno
+# más reciente primero) y los IDs vistos en claves con expiración: cualquier
+# proceso ve la misma conversación, sin sesiones pegadas a un worker
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS = None
+if REDIS_URL and REDIS_AVAILABLE:
+    REDIS = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(REDIS_URL, max_connections=32))
+elif REDIS_URL:
+    _log.warning("⚠️  REDIS_URL configurado pero el paquete 'redis' no está instalado: se usa memoria local")
+_REDIS_ERRORS = (redis.RedisError,) if REDIS_AVAILABLE else ()
+# Conversaciones sin actividad se descartan solas (el equivalente al LRU en memoria)
+_HISTORIAL_REDIS_TTL = 7 * 24 * 3600
+
+
+def _dumps(obj, indent: bool = False) -> str:
+    """Serializa a JSON (UTF-8 sin escapar), usando orjson si está disponible."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None).decode()
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
+
+
+def _json_bytes(obj) -> bytes:
+    """Serializa a bytes JSON UTF-8, listos para enviar como cuerpo de una petición."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _loads(data: bytes):
+    """Parsea JSON, usando orjson si está disponible. Lanza ValueError si no es válido."""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_response(obj, status: int = 200) -> Response:
+    """Respuesta JSON de Flask serializada con `_dumps` (reemplaza a `jsonify`)."""
+    return Response(_dumps(obj), status=status, mimetype="application/json")
+
+
+def _clave_historial(numero: str) -> str:
+    return f"whatsapp:hist:{numero}"
+
+
+def _mensaje_de_turno(turno: bytes):
+    """Reconstruye un mensaje del historial guardado en Redis."""
+    datos = _loads(turno)
+    return (HumanMessage if datos["r"] == "h" else AIMessage)(content=datos["c"])
+
+
+def get_history(numero: str) -> list:
+    """Retorna el historial de un número (creándolo si no existe) y lo marca como el más reciente."""
+    if REDIS is not None:
+        try:
+            turnos = REDIS.lrange(_clave_historial(numero), 0, 2 * MAX_TURNS - 1)
+            return [_mensaje_de_turno(turno) for turno in reversed(turnos)]
+        except _REDIS_ERRORS as e:
+            _log.warning("⚠️  Redis no disponible, se usa el historial en memoria: %s", e)
+    
+    with _chat_histories_lock:
+        historial = chat_histories.pop(numero, None)
+        if historial is None:
+            historial = []
+        chat_histories[numero] = historial
+        if len(chat_histories) > MAX_USERS:
+            chat_histories.popitem(last=False)
+        return historial
+
+
+def _agregar_turno(numero: str, chat_history: list, mensaje_usuario: str, respuesta: str):
+    """Agrega un turno (usuario + agente) al historial y descarta los más antiguos."""
+    chat_history.append(HumanMessage(content=mensaje_usuario))
+    chat_history.append(AIMessage(content=respuesta))
+    if len(chat_history) > 2 * MAX_TURNS:
+        del chat_history[:len(chat_history) - 2 * MAX_TURNS]
+    
+    if REDIS is not None:
+        clave = _clave_historial(numero)
+        try:
+            # Un solo viaje a Redis: agregar el turno, recortar y renovar la expiración
+            with REDIS.pipeline() as pipe:
+                pipe.lpush(clave, _json_bytes({"r": "h", "c": mensaje_usuario}), _json_bytes({"r": "a", "c": respuesta}))
+                pipe.ltrim(clave, 0, 2 * MAX_TURNS - 1)
+                pipe.expire(clave, _HISTORIAL_REDIS_TTL)
+                pipe.execute()
+        except _REDIS_ERRORS as e:
+            _log.warning("⚠️  No se pudo guardar el turno en Redis: %s", e)
+
+# Locks de conversación: los workers procesan webhooks en paralelo, pero los
+# mensajes de una misma conversación deben ir en orden (dentro del proceso). Es
+# un conjunto fijo repartido por hash del número, así que la memoria no crece con
+# cada número nuevo; dos números que caen en el mismo lock solo se turnan
+_LOCKS_CONVERSACION = tuple(threading.Lock() for _ in range(64))
+
+
+def _lock_de_numero(numero: str) -> threading.Lock:
+    """Retorna el lock que corresponde a la conversación de un número."""
+    return _LOCKS_CONVERSACION[hash(numero) % len(_LOCKS_CONVERSACION)]
+
+
+# IDs de mensajes ya recibidos en los últimos minutos. Meta reintenta los webhooks
+# que no se confirman a tiempo, y un reintento no debe ejecutar el agente de nuevo
+# ni responder dos veces. Con REDIS_URL, el registro se comparte entre procesos
+_MENSAJES_VISTOS_TTL = 600
+_MENSAJES_VISTOS_MAX = 50000
+_mensajes_vistos = OrderedDict()
+_mensajes_vistos_lock = threading.Lock()
+
+
+def _marcar_mensaje_nuevo(message_id: str) -> bool:
+    """Registra el ID de un mensaje. Retorna False si ya se había recibido (duplicado)."""
+    if not message_id:
+        return True
+    if REDIS is not None:
+        try:
+            # SET NX es atómico: de dos workers con el mismo reintento, solo uno lo procesa
+            return bool(REDIS.set(f"whatsapp:seen:{message_id}", 1, nx=True, ex=_MENSAJES_VISTOS_TTL))
+        except _REDIS_ERRORS as e:
+            _log.warning("⚠️  Redis no disponible, se deduplica en memoria: %s", e)
+    
+    ahora = time.monotonic()
+    with _mensajes_vistos_lock:
+        # Los IDs se insertan en orden de llegada: los vencidos están al principio
+        while _mensajes_vistos and next(iter(_mensajes_vistos.values())) < ahora:
+            _mensajes_vistos.popitem(last=False)
+        if message_id in _mensajes_vistos:
+            return False
+        _mensajes_vistos[message_id] = ahora + _MENSAJES_VISTOS_TTL
+        if len(_mensajes_vistos) > _MENSAJES_VISTOS_MAX:
+            _mensajes_vistos.popitem(last=False)
+        return True
+
+
+def _mensaje_ya_visto(message_id: str) -> bool:
+    """Indica si un mensaje ya se recibió, sin registrarlo (consulta de solo lectura)."""
+    if not message_id:
+        return False
+    if REDIS is not None:
+        try:
+            return bool(REDIS.exists(f"whatsapp:seen:{message_id}"))
+        except _REDIS_ERRORS as e:
+            _log.warning("⚠️  Redis no disponible, se consulta el registro en memoria: %s", e)
+    
+    with _mensajes_vistos_lock:
+        expira = _mensajes_vistos.get(message_id)
+    return expira is not None and expira >= time.monotonic()
 
-# Almacenar historial de conversación por número de teléfono
-chat_histories = {}
 
 # Estadísticas de webhooks recibidos
 webhook_stats = {
@@ -36,6 +334,22 @@ webhook_stats = {
     "test_messages": 0,
     "real_messages": 0
 }
+_stats_lock = threading.Lock()
+
+# Heurística de origen cuando no hay WHATSAPP_APP_SECRET para verificar la firma
+_META_UA_RE = re.compile(r"facebook|meta", re.IGNORECASE)
+
+
+def _contar(clave: str):
+    """Incrementa un contador de `webhook_stats` (`+=` no es atómico entre hilos)."""
+    with _stats_lock:
+        webhook_stats[clave] += 1
+
+
+def _snapshot_stats() -> dict:
+    """Copia consistente de los contadores (sin ver un incremento a medias)."""
+    with _stats_lock:
+        return dict(webhook_stats)
 
 
 def send_whatsapp_message(to: str, message: str):
@@ -46,143 +360,263 @@ def send_whatsapp_message(to: str, message: str):
         to: Número de teléfono del destinatario (formato: 1234567890)
         message: Mensaje de texto a enviar
     """
-    if not WHATSAPP_TOKEN or not WHATSAPP_PHONE_NUMBER_ID:
-        print("⚠️  Error: WHATSAPP_TOKEN o WHATSAPP_PHONE_NUMBER_ID no configurados")
+    if not ENVIO_CONFIGURADO:
+        # Ya se reportó al arrancar
         return False
     
     # Formatear número de teléfono (debe incluir código de país sin +)
-    phone_number = to.replace("+", "").replace(" ", "").replace("-", "")
+    phone_number = to.translate(_PHONE_STRIP)
     
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    
-    payload = {
-        "messaging_product": "whatsapp",
-        "recipient_type": "individual",
-        "to": phone_number,
-        "type": "text",
-        "text": {
-            "preview_url": False,
-            "body": message
-        }
-    }
+    cuerpo = b"".join((
+        _MENSAJE_PREFIJO, _json_bytes(phone_number),
+        _MENSAJE_MEDIO, _json_bytes(message), _MENSAJE_SUFIJO,
+    ))
     
     try:
-        print(f"\n📤 Enviando mensaje a WhatsApp:")
-        print(f"   Para: {phone_number}")
-        print(f"   URL: {WHATSAPP_API_URL}")
-        print(f"   Mensaje: {message[:50]}..." if len(message) > 50 else f"   Mensaje: {message}")
+        _log.debug("📤 Enviando mensaje a WhatsApp: para %s (%s): %.50s", phone_number, WHATSAPP_API_URL, message)
         
-        response = requests.post(WHATSAPP_API_URL, headers=headers, json=payload)
-        
-        print(f"   Status Code: {response.status_code}")
+        _SEND_LIMITER.acquire()
+        if HTTPX_CLIENT is not None:
+            response = HTTPX_CLIENT.post(WHATSAPP_API_URL, content=cuerpo, headers=_JSON_HEADERS, timeout=_HTTPX_TIMEOUT_ENVIO)
+        else:
+            response = SESSION.post(WHATSAPP_API_URL, data=cuerpo, headers=_JSON_HEADERS, timeout=_TIMEOUT_ENVIO)
         
         if response.status_code == 200:
-            print(f"✅ Mensaje enviado correctamente")
-            print(f"   Respuesta: {response.json()}")
+            _log.info("✅ Mensaje enviado a %s", phone_number)
+            _log.debug("   Respuesta: %s", response.text)
             return True
         else:
-            print(f"❌ Error en respuesta: {response.status_code}")
-            print(f"   Respuesta: {response.text}")
+            _log.error("❌ Error en respuesta: %s - %s", response.status_code, response.text)
             response.raise_for_status()
             return False
-            
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Error enviando mensaje a WhatsApp: {e}")
+    
+    except _HTTP_ERRORS as e:
+        _log.error("❌ Error enviando mensaje a WhatsApp: %s", e)
         if hasattr(e, 'response') and e.response is not None:
-            print(f"   Status Code: {e.response.status_code}")
-            print(f"   Respuesta: {e.response.text}")
+            _log.error("   Status Code: %s - Respuesta: %s", e.response.status_code, e.response.text)
         return False
 
 
-def download_media(media_id: str, mime_type: str) -> str:
+def _partir_texto(texto: str) -> list:
+    """Divide un texto en partes de a lo más `_MAX_TEXTO` caracteres, cortando en saltos de línea o espacios."""
+    partes = []
+    while len(texto) > _MAX_TEXTO:
+        corte = max(texto.rfind("\n", 0, _MAX_TEXTO), texto.rfind(" ", 0, _MAX_TEXTO))
+        if corte <= 0:
+            corte = _MAX_TEXTO
+        partes.append(texto[:corte])
+        texto = texto[corte:].lstrip()
+    if texto:
+        partes.append(texto)
+    return partes
+
+
+def flush_messages(to: str, textos: list) -> bool:
+    """
+    Envía una respuesta de varias partes a un número. Las partes van en orden y
+    una tras otra sobre la misma conexión keep-alive: en paralelo podrían llegar
+    desordenadas al usuario. Los textos más largos que el límite de WhatsApp se
+    dividen. Se detiene en el primer envío fallido y retorna si se enviaron todos.
+    """
+    for texto in textos:
+        for parte in _partir_texto(texto):
+            if not send_whatsapp_message(to, parte):
+                return False
+    return True
+
+
+def _descargar_en(url: str, destino) -> None:
+    """Descarga `url` en streaming al archivo `destino`, en bloques de 64 KB."""
+    if HTTPX_CLIENT is not None:
+        with HTTPX_CLIENT.stream("GET", url) as respuesta:
+            respuesta.raise_for_status()
+            for bloque in respuesta.iter_bytes(64 * 1024):
+                destino.write(bloque)
+        return
+    
+    with SESSION.get(url, stream=True, timeout=_TIMEOUT_DESCARGA) as respuesta:
+        respuesta.raise_for_status()
+        # Descomprimir de forma transparente si la respuesta viene con gzip
+        respuesta.raw.decode_content = True
+        shutil.copyfileobj(respuesta.raw, destino, length=64 * 1024)
+
+
+def _eliminar_temporal(path: str):
+    """
+    Elimina un archivo temporal. Solo se ignoran errores del sistema de archivos
+    (ya borrado, permisos): un Ctrl+C o la salida de un worker no se tragan.
+    """
+    try:
+        os.remove(path)
+        _log.debug("🗑️  Archivo temporal eliminado: %s", path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        _log.warning("⚠️  No se pudo eliminar archivo temporal %s: %s", path, e)
+
+
+def download_media(media_id: str, mime_type: str, max_bytes: Optional[int] = None) -> Optional[Tuple[Optional[str], int]]:
     """
     Descarga un archivo multimedia desde WhatsApp Cloud API.
     
     Args:
         media_id: ID del archivo multimedia en WhatsApp
         mime_type: Tipo MIME del archivo (ej: "audio/ogg", "image/jpeg")
+        max_bytes: Tamaño máximo aceptado según los metadatos de Meta (opcional);
+            si lo supera, no se descarga
     
     Returns:
-        Ruta al archivo descargado temporalmente
+        Tupla (ruta al archivo descargado temporalmente, tamaño en bytes); si el
+        archivo supera `max_bytes`, (None, tamaño declarado). None si no se pudo
+        descargar
     """
     if not WHATSAPP_TOKEN:
-        print("❌ ERROR: WHATSAPP_TOKEN no configurado")
+        # Ya se reportó al arrancar
         return None
     
     # Obtener URL del archivo
     media_url = f"https://graph.facebook.com/{WHATSAPP_API_VERSION}/{media_id}"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
     
     try:
-        print(f"   📡 Obteniendo URL de descarga...")
-        print(f"      Media URL: {media_url}")
+        _log.debug("   📡 Obteniendo URL de descarga: %s", media_url)
         
         # Obtener URL de descarga
-        response = requests.get(media_url, headers=headers, timeout=30)
+        if HTTPX_CLIENT is not None:
+            response = HTTPX_CLIENT.get(media_url, timeout=_HTTPX_TIMEOUT_CONSULTA)
+        else:
+            response = SESSION.get(media_url, timeout=_TIMEOUT_CONSULTA)
         response.raise_for_status()
         media_data = response.json()
         download_url = media_data.get("url")
         
-        print(f"   📦 Respuesta de Meta:")
-        print(f"      Keys: {list(media_data.keys())}")
-        print(f"      Download URL: {download_url[:100] if download_url else 'None'}...")
+        _log.debug("   📦 Respuesta de Meta: keys %s, URL de descarga: %.100s", list(media_data), download_url)
         
         if not download_url:
-            print(f"❌ ERROR: No se encontró URL de descarga en la respuesta")
-            print(f"   Respuesta completa: {media_data}")
+            _log.error("❌ ERROR: No se encontró URL de descarga en la respuesta: %s", media_data)
             return None
         
-        # Descargar el archivo
-        print(f"   ⬇️  Descargando archivo desde Meta...")
-        download_response = requests.get(download_url, headers=headers, timeout=60)
-        download_response.raise_for_status()
-        
-        file_size = len(download_response.content)
-        print(f"   ✅ Archivo descargado: {file_size} bytes ({file_size / 1024:.2f} KB)")
+        # La consulta de la URL ya trae el tamaño: un archivo demasiado grande se
+        # descarta sin bajar el binario
+        tamano_declarado = media_data.get("file_size")
+        if max_bytes is not None and tamano_declarado is not None and int(tamano_declarado) > max_bytes:
+            _log.warning("⚠️  Archivo multimedia demasiado grande (%s bytes, máximo %s): no se descarga", tamano_declarado, max_bytes)
+            return None, int(tamano_declarado)
         
         # Determinar extensión del archivo
-        extension_map = {
-            "audio/ogg": ".ogg",
-            "audio/ogg; codecs=opus": ".ogg",
-            "audio/mpeg": ".mp3",
-            "audio/mp4": ".m4a",
-            "audio/wav": ".wav",
-            "audio/x-m4a": ".m4a",
-            "image/jpeg": ".jpg",
-            "image/png": ".png",
-            "image/webp": ".webp"
-        }
-        extension = extension_map.get(mime_type, ".tmp")
-        
-        print(f"   📝 MIME Type: {mime_type}")
-        print(f"   📝 Extensión asignada: {extension}")
-        
-        # Guardar en archivo temporal
-        with tempfile.NamedTemporaryFile(delete=False, suffix=extension) as tmp_file:
-            tmp_file.write(download_response.content)
-            tmp_path = tmp_file.name
-            print(f"   💾 Archivo guardado en: {tmp_path}")
-            return tmp_path
-    
-    except requests.exceptions.Timeout:
-        print(f"❌ ERROR: Timeout descargando archivo multimedia")
+        extension = EXTENSION_MAP.get(mime_type, ".tmp")
+        _log.debug("   📝 MIME Type: %s, extensión asignada: %s", mime_type, extension)
+        
+        # Descargar el archivo en streaming, directo al archivo temporal y por
+        # bloques: no se carga entero en memoria y se escribe mientras llega
+        _log.debug("   ⬇️  Descargando archivo desde Meta...")
+        tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=extension, dir=_MEDIA_TMP_DIR)
+        try:
+            with tmp_file:
+                _descargar_en(download_url, tmp_file)
+                # La posición final es el tamaño escrito: no hace falta otro stat()
+                file_size = tmp_file.tell()
+        except Exception:
+            # No dejar archivos a medio descargar
+            _eliminar_temporal(tmp_file.name)
+            raise
+        
+        tmp_path = tmp_file.name
+        _log.info("   ✅ Archivo descargado: %s bytes (%.2f KB) en %s", file_size, file_size / 1024, tmp_path)
+        return tmp_path, file_size
+    
+    except _TIMEOUT_ERRORS:
+        _log.error("❌ ERROR: Timeout descargando archivo multimedia")
         return None
-    except requests.exceptions.RequestException as e:
-        print(f"❌ ERROR descargando archivo multimedia: {e}")
+    except _HTTP_ERRORS as e:
+        _log.error("❌ ERROR descargando archivo multimedia: %s", e)
         if hasattr(e, 'response') and e.response is not None:
-            print(f"   Status Code: {e.response.status_code}")
-            print(f"   Response: {e.response.text[:500]}")
+            _log.error("   Status Code: %s - Response: %.500s", e.response.status_code, e.response.text)
         return None
     except Exception as e:
-        print(f"❌ ERROR inesperado descargando archivo: {e}")
-        import traceback
-        traceback.print_exc()
+        _log.exception("❌ ERROR inesperado descargando archivo: %s", e)
         return None
 
 
+# Descargas anticipadas: apenas se encola un webhook con audios o imágenes, su
+# descarga arranca en segundo plano, así el archivo ya está (o va llegando)
+# cuando el worker toma el mensaje, aunque espere detrás de otros mensajes del
+# mismo número. Las que nadie reclama en `_DESCARGAS_TTL` segundos las borra
+# `_barrer_descargas_vencidas`
+_DESCARGAS_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="descarga-media")
+_DESCARGAS_TTL = 300
+_DESCARGAS_BARRIDO_CADA = 60
+_MIME_POR_DEFECTO = {"audio": "audio/ogg", "image": "image/jpeg"}
+_descargas_anticipadas = {}
+_descargas_lock = threading.Lock()
+
+
+def _descartar_descarga(futuro: Future):
+    """Borra el archivo de una descarga anticipada que nadie reclamó."""
+    if futuro.cancelled() or futuro.exception() is not None:
+        return
+    resultado = futuro.result()
+    if resultado is not None and resultado[0] is not None:
+        _eliminar_temporal(resultado[0])
+
+
+def _barrer_descargas_vencidas():
+    """Descarta periódicamente las descargas anticipadas vencidas (hilo daemon)."""
+    while True:
+        time.sleep(_DESCARGAS_BARRIDO_CADA)
+        ahora = time.monotonic()
+        with _descargas_lock:
+            vencidas = [m for m, (expira, _) in _descargas_anticipadas.items() if expira < ahora]
+            futuros = [_descargas_anticipadas.pop(media_id)[1] for media_id in vencidas]
+        for futuro in futuros:
+            futuro.add_done_callback(_descartar_descarga)
+        if futuros:
+            _log.debug("🧹 %s descarga(s) anticipada(s) vencida(s) descartada(s)", len(futuros))
+
+
+def _anticipar_descargas(data: dict):
+    """
+    Lanza la descarga de los audios e imágenes de un payload, sin esperarla. Se
+    llama antes de encolar el payload, para que el worker siempre encuentre la
+    descarga registrada. Los reintentos de mensajes ya recibidos no se descargan.
+    """
+    ahora = time.monotonic()
+    for entry in data.get("entry", []):
+        for change in entry.get("changes", []):
+            for message in change.get("value", {}).get("messages", []):
+                tipo = message.get("type")
+                if tipo not in _MIME_POR_DEFECTO:
+                    continue
+                media = message.get(tipo) or {}
+                media_id = media.get("id")
+                mime_type = media.get("mime_type", _MIME_POR_DEFECTO[tipo])
+                if not media_id or _mensaje_ya_visto(message.get("id")):
+                    continue
+                if tipo == "image" and mime_type not in _IMAGEN_MIME_SOPORTADOS:
+                    continue
+                max_bytes = _MAX_BYTES_IMAGEN if tipo == "image" else None
+                with _descargas_lock:
+                    if media_id in _descargas_anticipadas:
+                        continue
+                    futuro = _DESCARGAS_EXECUTOR.submit(download_media, media_id, mime_type, max_bytes)
+                    _descargas_anticipadas[media_id] = (ahora + _DESCARGAS_TTL, futuro)
+
+
+def _obtener_descarga(media_id: str, mime_type: str, max_bytes: Optional[int] = None) -> Optional[Tuple[Optional[str], int]]:
+    """
+    Usa la descarga anticipada del archivo si existe; si no, o si falló (p. ej.
+    por un error transitorio de red), lo descarga ahora. Un archivo rechazado
+    por tamaño no se reintenta. Retorna lo mismo que `download_media`.
+    """
+    with _descargas_lock:
+        entrada = _descargas_anticipadas.pop(media_id, None)
+    if entrada is not None:
+        resultado = entrada[1].result()
+        if resultado is not None:
+            return resultado
+        _log.warning("⚠️  Falló la descarga anticipada de %s, se reintenta", media_id)
+    return download_media(media_id, mime_type, max_bytes)
+
+
 @app.route("/webhook", methods=["GET"])
 def verify_webhook():
     """
@@ -193,10 +627,10 @@ def verify_webhook():
     challenge = request.args.get("hub.challenge")
     
     if mode == "subscribe" and token == WHATSAPP_VERIFY_TOKEN:
-        print("✅ Webhook verificado correctamente")
+        _log.info("✅ Webhook verificado correctamente")
         return challenge, 200
     else:
-        print("❌ Verificación de webhook fallida")
+        _log.warning("❌ Verificación de webhook fallida")
         return "Forbidden", 403
 
 
@@ -206,7 +640,7 @@ def debug_endpoint():
     Endpoint de debug para ver los datos recibidos (similar a n8n).
     """
     if request.method == "GET":
-        return jsonify({
+        return _json_response({
             "status": "debug_endpoint_active",
             "message": "Envía un POST con datos para verlos aquí",
             "webhook_url": "/webhook"
@@ -223,145 +657,165 @@ def debug_endpoint():
         "raw_data": request.get_data(as_text=True) if not request.is_json else None
     }
     
-    print("\n" + "="*70)
-    print("🔍 DEBUG ENDPOINT - Datos recibidos")
-    print("="*70)
-    print(json.dumps(debug_info, indent=2, ensure_ascii=False))
-    print("="*70 + "\n")
+    # Este endpoint existe para inspeccionar lo recibido: se muestra siempre
+    _log.info("%s\n🔍 DEBUG ENDPOINT - Datos recibidos\n%s\n%s\n%s",
+              _SEPARADOR, _SEPARADOR, _dumps(debug_info, indent=True), _SEPARADOR)
     
-    return jsonify(debug_info)
+    return _json_response(debug_info)
+
+
+def _firma_valida(cuerpo: bytes, firma: str) -> bool:
+    """
+    Verifica la firma HMAC-SHA256 que Meta calcula sobre el cuerpo crudo del
+    webhook con el secreto de la app. Si no hay secreto configurado, acepta todo.
+    """
+    if _APP_SECRET_BYTES is None:
+        return True
+    esperada = hmac.new(_APP_SECRET_BYTES, cuerpo, hashlib.sha256).hexdigest()
+    # Se comparan bytes: con str, `compare_digest` lanza TypeError ante caracteres
+    # no ASCII (Werkzeug decodifica los headers como latin-1) y una firma falsa
+    # terminaría en un 500 en vez de un 403
+    return hmac.compare_digest(firma.removeprefix("sha256=").encode("latin-1"), esperada.encode())
+
+
+def _tiene_mensajes(data) -> bool:
+    """Indica si algún cambio del webhook trae mensajes (y no solo statuses)."""
+    if not isinstance(data, dict):
+        return False
+    return any(
+        "messages" in change.get("value", {})
+        for entry in data.get("entry", [])
+        for change in entry.get("changes", [])
+    )
 
 
 @app.route("/webhook", methods=["POST"])
 def handle_webhook():
     """
-    Maneja los mensajes entrantes de WhatsApp.
+    Recibe los mensajes entrantes de WhatsApp. Solo encola el payload y responde
+    200 de inmediato: Meta reintenta los webhooks que no se confirman a tiempo
+    (~20s), y el agente, las descargas y las respuestas pueden tardar más que eso.
+    El procesamiento lo hacen los workers de `WORK_Q`.
     """
-    # Log INMEDIATO - antes de cualquier procesamiento
-    print("\n" + "="*70)
-    print("🔥 POST RECIBIDO EN /webhook")
-    print("="*70)
-    print(f"📥 Método: {request.method}")
-    print(f"📥 Content-Type: {request.headers.get('Content-Type', 'N/A')}")
-    print(f"📥 User-Agent: {request.headers.get('User-Agent', 'N/A')}")
-    print(f"📥 X-Hub-Signature-256: {request.headers.get('X-Hub-Signature-256', 'N/A')}")
-    print(f"📥 Raw data length: {len(request.get_data())} bytes")
-    
-    # Intentar obtener datos raw antes de parsear JSON
+    cuerpo = request.get_data()
+    
+    # Rechazar tráfico no firmado por Meta antes de parsear, deduplicar o encolar
+    if not _firma_valida(cuerpo, request.headers.get("X-Hub-Signature-256", "")):
+        _contar("not_from_meta")
+        _log.warning("🚫 Webhook con firma inválida rechazado (desde %s)", request.remote_addr)
+        return "", 403
+    if _APP_SECRET_BYTES is not None:
+        _contar("from_meta")
+    
     try:
-        raw_data = request.get_data(as_text=True)
-        print(f"📥 Raw data (primeros 500 chars): {raw_data[:500]}")
-    except Exception as e:
-        print(f"⚠️  No se pudo obtener raw data: {e}")
+        data = _loads(cuerpo)
+    except ValueError:
+        data = None
+    
+    # Log detallado para debugging (similar a n8n). El payload solo se serializa
+    # si el nivel DEBUG está activo
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug("%s\n🔥 POST RECIBIDO EN /webhook\n%s", _SEPARADOR, _SEPARADOR)
+        _log.debug("📥 Content-Type: %s", request.headers.get('Content-Type', 'N/A'))
+        _log.debug("📥 User-Agent: %s", request.headers.get('User-Agent', 'N/A'))
+        _log.debug("📥 X-Hub-Signature-256: %s", request.headers.get('X-Hub-Signature-256', 'N/A'))
+        _log.debug("📥 Raw data length: %s bytes", len(cuerpo))
+        _log.debug("📦 Datos completos recibidos: %s", _dumps(data))
+    
+    if not data:
+        _log.warning("⚠️  No se recibieron datos")
+        return _json_response({"status": "error", "message": "No data received"}, 400)
+    
+    # La mayoría de los webhooks son confirmaciones de entrega/lectura (`statuses`),
+    # sin mensajes: se confirman sin pasar por la cola ni por los workers
+    if not _tiene_mensajes(data):
+        return _json_response({"status": "ok"})
     
+    # Las descargas se registran antes de encolar: un worker libre podría tomar
+    # el payload de inmediato y, sin la descarga registrada, bajar el archivo de nuevo
+    if ENVIO_CONFIGURADO:
+        _anticipar_descargas(data)
+    WORK_Q.put(data)
+    _log.debug("📬 Webhook encolado (%s pendiente(s))", WORK_Q.qsize())
+    return _json_response({"status": "ok"})
+
+
+def _process_payload(data: dict) -> int:
+    """
+    Procesa un payload de webhook de WhatsApp (lo ejecutan los workers de `WORK_Q`).
+    
+    Returns:
+        Cantidad de mensajes procesados
+    """
     try:
-        data = request.get_json()
-        
-        # Log detallado para debugging (similar a n8n)
-        print("\n" + "="*70)
-        print("📥 WEBHOOK RECIBIDO - " + str(request.headers.get('X-Hub-Signature-256', 'Sin firma')))
-        print("="*70)
-        print("📦 Datos completos recibidos:")
-        print(json.dumps(data, indent=2, ensure_ascii=False))
-        print("="*70)
-        
-        # Mostrar headers importantes
-        print("\n📋 Headers importantes:")
-        print(f"   Content-Type: {request.headers.get('Content-Type')}")
-        print(f"   User-Agent: {request.headers.get('User-Agent', 'N/A')}")
-        print("="*70 + "\n")
-        
-        if not data:
-            print("⚠️  No se recibieron datos")
-            return jsonify({"status": "error", "message": "No data received"}), 400
-        
         # WhatsApp envía notificaciones en 'entry'
         if "object" not in data:
-            print(f"⚠️  Objeto no encontrado en datos. Keys: {list(data.keys()) if data else 'None'}")
-            return jsonify({"status": "ok"}), 200
+            _log.warning("⚠️  Objeto no encontrado en datos. Keys: %s", list(data.keys()) if data else 'None')
+            return 0
         
         if data["object"] != "whatsapp_business_account":
-            print(f"⚠️  Objeto no es whatsapp_business_account: {data.get('object')}")
-            return jsonify({"status": "ok"}), 200
+            _log.warning("⚠️  Objeto no es whatsapp_business_account: %s", data.get('object'))
+            return 0
         
         entries = data.get("entry", [])
-        print(f"📋 Entradas encontradas: {len(entries)}")
+        _log.debug("📋 Entradas encontradas: %s", len(entries))
         
         if not entries:
-            print("⚠️  No hay entradas en el webhook")
-            print("💡 Esto puede ser normal si es solo una notificación de estado")
-            return jsonify({"status": "ok"}), 200
+            _log.debug("⚠️  No hay entradas en el webhook (puede ser solo una notificación de estado)")
+            return 0
         
         # Variable para rastrear si se procesó algún mensaje
         mensajes_procesados = 0
         
         for entry_idx, entry in enumerate(entries):
-            print(f"\n📂 Procesando entrada #{entry_idx + 1}")
             changes = entry.get("changes", [])
-            print(f"🔄 Cambios encontrados: {len(changes)}")
+            _log.debug("📂 Procesando entrada #%s: %s cambio(s)", entry_idx + 1, len(changes))
             
             for change_idx, change in enumerate(changes):
-                print(f"\n   " + "-"*60)
-                print(f"   🔄 Procesando cambio #{change_idx + 1}")
-                print(f"   " + "-"*60)
-                
                 value = change.get("value", {})
                 field = change.get("field", "unknown")
-                print(f"   📊 Campo del webhook: '{field}'")
-                print(f"   📊 Keys disponibles en 'value': {list(value.keys())}")
+                _log.debug("   %s\n   🔄 Procesando cambio #%s (campo '%s', keys %s)",
+                           _SEPARADOR_CAMBIO, change_idx + 1, field, list(value.keys()))
                 
                 # Mostrar metadata si existe
                 metadata = value.get("metadata", {})
                 if metadata:
-                    print(f"\n   📱 Metadata:")
-                    print(f"      - Display Phone Number: {metadata.get('display_phone_number')}")
-                    print(f"      - Phone Number ID: {metadata.get('phone_number_id')}")
+                    _log.debug("   📱 Metadata: Display Phone Number %s, Phone Number ID %s",
+                               metadata.get('display_phone_number'), metadata.get('phone_number_id'))
                 
                 # Verificar si hay contacts (información del contacto)
-                contacts = value.get("contacts", [])
-                if contacts:
-                    print(f"\n   👤 Contactos encontrados: {len(contacts)}")
-                    for contact_idx, contact in enumerate(contacts):
-                        profile = contact.get("profile", {})
-                        wa_id = contact.get("wa_id")
-                        print(f"      Contacto #{contact_idx + 1}:")
-                        print(f"         - Nombre: {profile.get('name', 'N/A')}")
-                        print(f"         - WhatsApp ID: {wa_id}")
+                for contact in value.get("contacts", []):
+                    _log.debug("   👤 Contacto: %s (WhatsApp ID: %s)",
+                               contact.get("profile", {}).get('name', 'N/A'), contact.get("wa_id"))
                 
                 # Verificar si hay mensajes
                 messages = value.get("messages", [])
-                print(f"\n   💬 Mensajes encontrados: {len(messages)}")
                 
                 # Verificar si hay statuses (notificaciones de estado)
                 statuses = value.get("statuses", [])
-                if statuses:
-                    print(f"   📊 Notificaciones de estado encontradas: {len(statuses)}")
-                    for status in statuses:
-                        print(f"      - Status: {status.get('status')}, ID: {status.get('id')}, Recipient: {status.get('recipient_id')}")
-                
-                # Mostrar estructura completa si no hay mensajes (para debug)
-                if not messages and not statuses:
-                    print(f"\n   ⚠️  No se encontraron mensajes ni statuses")
-                    print(f"   📦 Estructura completa del 'value' para debug:")
-                    print(f"   {json.dumps(value, indent=6, ensure_ascii=False)}")
+                for status in statuses:
+                    _log.debug("   📊 Status: %s, ID: %s, Recipient: %s",
+                               status.get('status'), status.get('id'), status.get('recipient_id'))
                 
                 if not messages:
                     # Puede ser una notificación de estado, no un mensaje nuevo
-                    print(f"   ⚠️  No hay mensajes en este cambio")
-                    print(f"   💡 Esto puede ser una notificación de estado o un tipo de evento diferente")
-                    print(f"   📋 Todos los datos disponibles en 'value':")
-                    print(f"   {json.dumps(value, indent=6, ensure_ascii=False)}")
+                    if not statuses and _log.isEnabledFor(logging.DEBUG):
+                        _log.debug("   ⚠️  No se encontraron mensajes ni statuses. 'value': %s",
+                                   _dumps(value))
                     continue
                 
-                webhook_stats["with_messages"] += 1
-                print(f"\n   ✅ ¡MENSAJES ENCONTRADOS! Procesando {len(messages)} mensaje(s)...")
+                _contar("with_messages")
+                _log.debug("   ✅ ¡MENSAJES ENCONTRADOS! Procesando %s mensaje(s)...", len(messages))
                 
                 for msg_idx, message in enumerate(messages):
-                    print(f"\n   " + "="*60)
-                    print(f"   📨 MENSAJE #{msg_idx + 1} RECIBIDO:")
-                    print(f"   " + "="*60)
-                    print(f"   {json.dumps(message, indent=6, ensure_ascii=False)}")
-                    print(f"   " + "="*60)
+                    # Descartar reintentos de Meta antes de cualquier procesamiento
+                    if not _marcar_mensaje_nuevo(message.get("id")):
+                        _log.info("♻️  Mensaje duplicado ignorado (ID: %s)", message.get('id'))
+                        continue
+                    
+                    if _log.isEnabledFor(logging.DEBUG):
+                        _log.debug("   %s\n   📨 MENSAJE #%s RECIBIDO: %s\n   %s",
+                                   _SEPARADOR_MENSAJE, msg_idx + 1, _dumps(message), _SEPARADOR_MENSAJE)
                     
                     # Obtener información del mensaje
                     from_number = message.get("from")
@@ -369,193 +823,153 @@ def handle_webhook():
                     message_type = message.get("type")
                     timestamp = message.get("timestamp")
                     
-                    print(f"\n   📋 Información extraída del mensaje:")
-                    print(f"      👤 De (from_number): {from_number}")
-                    print(f"      🆔 ID del mensaje: {message_id}")
-                    print(f"      📝 Tipo: {message_type}")
-                    print(f"      ⏰ Timestamp: {timestamp}")
-                    
-                    # Mostrar contenido según el tipo
-                    if message_type == "text":
-                        text_body = message.get("text", {}).get("body", "")
-                        print(f"      💬 Texto: {text_body}")
-                    elif message_type in ["audio", "voice"]:
-                        audio_data = message.get("audio") or message.get("voice")
-                        print(f"      🎤 Audio ID: {audio_data.get('id') if audio_data else 'N/A'}")
-                    elif message_type == "image":
-                        image_data = message.get("image", {})
-                        print(f"      🖼️  Imagen ID: {image_data.get('id') if image_data else 'N/A'}")
-                    
-                    print(f"\n   🔄 Iniciando procesamiento del mensaje...")
+                    _log.info("📨 Mensaje %s de %s (ID: %s, timestamp: %s)", message_type, from_number, message_id, timestamp)
                     
                     if not from_number:
-                        print(f"   ❌ ERROR: No se encontró número de teléfono en el mensaje")
-                        print(f"   📦 Mensaje completo para debug:")
-                        print(f"   {json.dumps(message, indent=6, ensure_ascii=False)}")
+                        _log.error("   ❌ ERROR: No se encontró número de teléfono en el mensaje: %s",
+                                   _dumps(message))
                         continue
                     
-                    # Obtener o crear historial de conversación
-                    if from_number not in chat_histories:
-                        chat_histories[from_number] = []
-                        print(f"   ✅ Nuevo historial creado para {from_number}")
-                    else:
-                        print(f"   📚 Historial existente encontrado para {from_number} ({len(chat_histories[from_number])} mensajes previos)")
-                    
-                    chat_history = chat_histories[from_number]
-                    
-                    # Detectar si es mensaje de prueba o real
-                    # Los mensajes de prueba de Meta suelen tener números como "16315551181"
-                    # Los mensajes reales tienen números reales de WhatsApp
-                    is_test_message = from_number in ["16315551181", "1234567890"] or "test" in str(message.get("id", "")).lower()
-                    
-                    if is_test_message:
-                        webhook_stats["test_messages"] += 1
-                        print(f"   🧪 Mensaje de PRUEBA detectado")
-                    else:
-                        webhook_stats["real_messages"] += 1
-                        print(f"   📱 Mensaje REAL detectado de {from_number}")
-                    
-                    # Procesar según el tipo de mensaje
-                    if message_type == "text":
-                        # Mensaje de texto
-                        text_body = message.get("text", {}).get("body", "")
-                        print(f"   📝 Procesando mensaje de texto: '{text_body}'")
-                        mensajes_procesados += 1
-                        process_text_message(from_number, text_body, chat_history)
-                    
-                    elif message_type == "audio" or message_type == "voice":
-                        # Mensaje de audio
-                        print(f"   🎤 Procesando mensaje de audio...")
-                        mensajes_procesados += 1
-                        audio_data = message.get("audio") or message.get("voice")
-                        if audio_data:
-                            media_id = audio_data.get("id")
-                            mime_type = audio_data.get("mime_type", "audio/ogg")
-                            process_audio_message(from_number, media_id, mime_type, chat_history)
+                    # Los mensajes de un mismo número se procesan de a uno (en orden y
+                    # sin pisarse el historial), aunque lleguen a workers distintos
+                    with _lock_de_numero(from_number):
+                        # Obtener o crear historial de conversación
+                        chat_history = get_history(from_number)
+                        _log.debug("   📚 Historial de %s: %s mensajes previos", from_number, len(chat_history))
+                        
+                        # Detectar si es mensaje de prueba o real
+                        # Los mensajes de prueba de Meta suelen tener números como "16315551181"
+                        # Los mensajes reales tienen números reales de WhatsApp
+                        is_test_message = from_number in ["16315551181", "1234567890"] or "test" in str(message.get("id", "")).lower()
+                        
+                        if is_test_message:
+                            _contar("test_messages")
+                            _log.debug("   🧪 Mensaje de PRUEBA detectado")
                         else:
-                            print(f"   ⚠️  No se encontraron datos de audio en el mensaje")
-                    
-                    elif message_type == "image":
-                        # Mensaje de imagen
-                        print(f"   🖼️  Procesando mensaje de imagen...")
-                        mensajes_procesados += 1
-                        image_data = message.get("image", {})
-                        if image_data:
-                            media_id = image_data.get("id")
-                            mime_type = image_data.get("mime_type", "image/jpeg")
-                            process_image_message(from_number, media_id, mime_type, chat_history)
+                            _contar("real_messages")
+                        
+                        # Procesar según el tipo de mensaje
+                        if message_type == "text":
+                            # Mensaje de texto
+                            text_body = message.get("text", {}).get("body", "")
+                            mensajes_procesados += 1
+                            process_text_message(from_number, text_body, chat_history)
+                        
+                        elif message_type == "audio" or message_type == "voice":
+                            # Mensaje de audio
+                            mensajes_procesados += 1
+                            audio_data = message.get("audio") or message.get("voice")
+                            if audio_data:
+                                media_id = audio_data.get("id")
+                                mime_type = audio_data.get("mime_type", "audio/ogg")
+                                process_audio_message(from_number, media_id, mime_type, chat_history)
+                            else:
+                                _log.warning("   ⚠️  No se encontraron datos de audio en el mensaje")
+                        
+                        elif message_type == "image":
+                            # Mensaje de imagen
+                            mensajes_procesados += 1
+                            image_data = message.get("image", {})
+                            if image_data:
+                                media_id = image_data.get("id")
+                                mime_type = image_data.get("mime_type", "image/jpeg")
+                                process_image_message(from_number, media_id, mime_type, chat_history)
+                            else:
+                                _log.warning("   ⚠️  No se encontraron datos de imagen en el mensaje")
+                        
                         else:
-                            print(f"   ⚠️  No se encontraron datos de imagen en el mensaje")
-                    
-                    else:
-                        # Tipo de mensaje no soportado
-                        print(f"   ⚠️  Tipo de mensaje no soportado: {message_type}")
-                        print(f"   📦 Mensaje completo: {json.dumps(message, indent=6, ensure_ascii=False)}")
-                        mensajes_procesados += 1
-                        send_whatsapp_message(
-                            from_number,
-                            "Lo siento, solo puedo procesar mensajes de texto, audio e imágenes."
-                        )
-        
-        print("\n" + "="*70)
-        print(f"✅ WEBHOOK PROCESADO - {mensajes_procesados} mensaje(s) procesado(s)")
-        print("="*70 + "\n")
-        return jsonify({"status": "ok", "messages_processed": mensajes_procesados}), 200
+                            # Tipo de mensaje no soportado
+                            _log.warning("   ⚠️  Tipo de mensaje no soportado: %s", message_type)
+                            mensajes_procesados += 1
+                            send_whatsapp_message(
+                                from_number,
+                                "Lo siento, solo puedo procesar mensajes de texto, audio e imágenes."
+                            )
+        
+        _log.debug("✅ WEBHOOK PROCESADO - %s mensaje(s) procesado(s)", mensajes_procesados)
+        return mensajes_procesados
     
     except Exception as e:
-        print(f"\n❌ Error procesando webhook: {e}")
-        import traceback
-        traceback.print_exc()
-        print(f"\n📦 Datos que causaron el error:")
-        try:
-            print(f"   Raw data: {request.get_data(as_text=True)[:500]}")
-        except:
-            print("   No se pudo obtener raw data")
-        return jsonify({"status": "error", "message": str(e)}), 500
+        _log.exception("❌ Error procesando webhook: %s", e)
+        _log.error("📦 Datos que causaron el error: %.500s", _dumps(data))
+        return 0
 
 
 @app.before_request
 def log_request_info():
     """Log todas las requests para debugging"""
     if request.path == "/webhook" and request.method == "POST":
-        webhook_stats["total_requests"] += 1
-        print(f"\n🔍 [BEFORE_REQUEST] {request.method} {request.path}")
-        print(f"   Headers: {dict(request.headers)}")
-        print(f"   Remote Addr: {request.remote_addr}")
-        # Verificar si viene de Meta
+        _contar("total_requests")
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("🔍 [BEFORE_REQUEST] %s %s desde %s - Headers: %s",
+                       request.method, request.path, request.remote_addr, dict(request.headers))
+        # Con secreto configurado el origen lo prueba la firma (se cuenta en
+        # handle_webhook); sin secreto queda solo la heurística del User-Agent
+        if _APP_SECRET_BYTES is not None:
+            return
         user_agent = request.headers.get('User-Agent', '')
-        if 'facebook' in user_agent.lower() or 'meta' in user_agent.lower():
-            webhook_stats["from_meta"] += 1
-            print(f"   ✅ Request viene de Meta/Facebook")
+        if _META_UA_RE.search(user_agent):
+            _contar("from_meta")
         else:
-            webhook_stats["not_from_meta"] += 1
-            print(f"   ⚠️  Request NO viene de Meta (User-Agent: {user_agent})")
+            _contar("not_from_meta")
+            _log.warning("⚠️  Request NO viene de Meta (User-Agent: %s)", user_agent)
 
 
 @app.route("/stats", methods=["GET"])
 def get_stats():
     """Endpoint para ver estadísticas de webhooks recibidos"""
-    return jsonify({
-        "webhook_stats": webhook_stats,
+    return _json_response({
+        "webhook_stats": _snapshot_stats(),
         "chat_histories_count": len(chat_histories),
         "message": "Estas son las estadísticas de webhooks recibidos. Si 'from_meta' es 0 cuando envías mensajes reales, Meta no está enviando webhooks."
     })
 
 
+def _log_extracto(extracto: dict, resultado: dict):
+    """
+    Registra el extracto estructurado que devolvió el agente: un resumen a nivel
+    INFO y, solo con DEBUG activo, el JSON completo del extracto y del resultado.
+    """
+    if not extracto or not _log.isEnabledFor(logging.INFO):
+        return
+    productos = extracto.get('productos', [])
+    _log.info("📦 Extracto estructurado: %s - %s producto(s) (%s)",
+              extracto.get('accion'), len(productos), extracto.get('intencion'))
+    for idx, producto in enumerate(productos, 1):
+        _log.info("   %s. %s: %s %s", idx, producto.get('nombre', 'N/A'),
+                  producto.get('cantidad', 'N/A'), producto.get('unidad', 'unidad'))
+    
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug("📄 JSON completo del extracto: %s", _dumps(extracto))
+        if resultado:
+            _log.debug("🔄 Resultado del procesamiento: %s", _dumps(resultado))
+
+
 def process_text_message(from_number: str, text: str, chat_history: list):
     """
     Procesa un mensaje de texto.
     """
     try:
-        print(f"📨 Mensaje de texto recibido de {from_number}: {text}")
+        _log.debug("📨 Mensaje de texto recibido de %s: %s", from_number, text)
         
         # Ejecutar el agente
         response = run_agent(text, chat_history, None)
         
         # Manejar respuesta estructurada o simple
         respuesta_texto = response
-        extracto_estructurado = None
         
         if isinstance(response, dict):
             respuesta_texto = response.get("respuesta", str(response))
-            extracto_estructurado = response.get("extracto_estructurado")
-            resultado_procesado = response.get("resultado_procesado")
-            
-            if extracto_estructurado:
-                print(f"\n{'='*70}")
-                print(f"📦 EXTRACTO ESTRUCTURADO - LISTO PARA INTEGRACIÓN CON BD")
-                print(f"{'='*70}")
-                print(f"✅ Acción: {extracto_estructurado.get('accion')}")
-                print(f"✅ Productos: {len(extracto_estructurado.get('productos', []))}")
-                print(f"✅ Intención: {extracto_estructurado.get('intencion')}")
-                
-                if extracto_estructurado.get('productos'):
-                    print(f"\n📋 Productos extraídos:")
-                    for idx, producto in enumerate(extracto_estructurado.get('productos', []), 1):
-                        nombre = producto.get('nombre', 'N/A')
-                        cantidad = producto.get('cantidad', 'N/A')
-                        unidad = producto.get('unidad', 'unidad')
-                        print(f"   {idx}. {nombre}: {cantidad} {unidad}")
-                
-                print(f"\n📄 JSON completo del extracto:")
-                print(json.dumps(extracto_estructurado, ensure_ascii=False, indent=2))
-                
-                if resultado_procesado:
-                    print(f"\n🔄 Resultado del procesamiento:")
-                    print(json.dumps(resultado_procesado, ensure_ascii=False, indent=2))
-                
-                print(f"\n💡 Este JSON está listo para enviar a tu endpoint de BD")
-                print(f"{'='*70}\n")
+            _log_extracto(response.get("extracto_estructurado"), response.get("resultado_procesado"))
         
         # Enviar respuesta
-        send_whatsapp_message(from_number, respuesta_texto)
+        flush_messages(from_number, [respuesta_texto])
         
         # Actualizar historial
-        chat_history.append(HumanMessage(content=text))
-        chat_history.append(AIMessage(content=respuesta_texto))
-        
+        _agregar_turno(from_number, chat_history, text, respuesta_texto)
+    
     except Exception as e:
-        print(f"❌ Error procesando mensaje de texto: {e}")
+        _log.error("❌ Error procesando mensaje de texto: %s", e, exc_info=True)
         send_whatsapp_message(
             from_number,
             "Lo siento, hubo un error procesando tu mensaje. Por favor, intenta de nuevo."
@@ -567,126 +981,57 @@ def process_audio_message(from_number: str, media_id: str, mime_type: str, chat_
     Procesa un mensaje de audio.
     """
     try:
-        print(f"\n{'='*70}")
-        print(f"🎤 PROCESANDO MENSAJE DE AUDIO")
-        print(f"{'='*70}")
-        print(f"   De: {from_number}")
-        print(f"   Media ID: {media_id}")
-        print(f"   MIME Type: {mime_type}")
+        _log.debug("🎤 Procesando mensaje de audio de %s (Media ID: %s, MIME Type: %s)", from_number, media_id, mime_type)
         
         # Descargar archivo de audio
-        print(f"\n📥 Descargando archivo de audio...")
-        audio_path = download_media(media_id, mime_type)
+        descarga = _obtener_descarga(media_id, mime_type)
         
-        if not audio_path:
-            print(f"❌ ERROR: No se pudo descargar el archivo de audio")
-            print(f"   Media ID: {media_id}")
-            print(f"   MIME Type: {mime_type}")
+        if descarga is None:
+            _log.error("❌ ERROR: No se pudo descargar el archivo de audio (Media ID: %s, MIME Type: %s)", media_id, mime_type)
             send_whatsapp_message(
                 from_number,
                 "Lo siento, no pude descargar el archivo de audio. Por favor, intenta de nuevo."
             )
             return
         
-        print(f"✅ Archivo descargado: {audio_path}")
-        
-        # Verificar que el archivo existe y tiene contenido
-        if not os.path.exists(audio_path):
-            print(f"❌ ERROR: El archivo descargado no existe: {audio_path}")
-            send_whatsapp_message(
-                from_number,
-                "Lo siento, hubo un error con el archivo de audio. Por favor, intenta de nuevo."
-            )
-            return
-        
-        file_size = os.path.getsize(audio_path)
-        print(f"   Tamaño del archivo: {file_size} bytes ({file_size / 1024:.2f} KB)")
+        # download_media ya conoce el tamaño: no hace falta volver a consultar el disco
+        audio_path, file_size = descarga
         
         if file_size == 0:
-            print(f"❌ ERROR: El archivo está vacío")
+            _log.error("❌ ERROR: El archivo está vacío")
             send_whatsapp_message(
                 from_number,
                 "Lo siento, el archivo de audio está vacío. Por favor, intenta de nuevo."
             )
-            try:
-                os.remove(audio_path)
-            except:
-                pass
+            _eliminar_temporal(audio_path)
             return
         
-        # Verificar extensión del archivo
-        file_ext = os.path.splitext(audio_path)[1].lower()
-        print(f"   Extensión del archivo: {file_ext}")
-        
         # Ejecutar el agente con el archivo de audio
-        print(f"\n🤖 Ejecutando agente con archivo de audio...")
-        print(f"   Ruta: {audio_path}")
-        print(f"   Historial previo: {len(chat_history)} mensajes")
+        _log.debug("🤖 Ejecutando agente con archivo de audio %s (historial previo: %s mensajes)", audio_path, len(chat_history))
         
-        response = run_agent("", chat_history, audio_path)
+        try:
+            response = run_agent("", chat_history, audio_path)
+        finally:
+            # Se elimina aunque el agente haya fallado
+            _eliminar_temporal(audio_path)
         
         # Manejar respuesta estructurada o simple
         respuesta_texto = response
-        extracto_estructurado = None
         
         if isinstance(response, dict):
             respuesta_texto = response.get("respuesta", str(response))
-            extracto_estructurado = response.get("extracto_estructurado")
-            resultado_procesado = response.get("resultado_procesado")
-            
-            if extracto_estructurado:
-                print(f"\n{'='*70}")
-                print(f"📦 EXTRACTO ESTRUCTURADO - LISTO PARA INTEGRACIÓN CON BD")
-                print(f"{'='*70}")
-                print(f"✅ Acción: {extracto_estructurado.get('accion')}")
-                print(f"✅ Productos: {len(extracto_estructurado.get('productos', []))}")
-                print(f"✅ Intención: {extracto_estructurado.get('intencion')}")
-                
-                if extracto_estructurado.get('productos'):
-                    print(f"\n📋 Productos extraídos:")
-                    for idx, producto in enumerate(extracto_estructurado.get('productos', []), 1):
-                        nombre = producto.get('nombre', 'N/A')
-                        cantidad = producto.get('cantidad', 'N/A')
-                        unidad = producto.get('unidad', 'unidad')
-                        print(f"   {idx}. {nombre}: {cantidad} {unidad}")
-                
-                print(f"\n📄 JSON completo del extracto:")
-                print(json.dumps(extracto_estructurado, ensure_ascii=False, indent=2))
-                
-                if resultado_procesado:
-                    print(f"\n🔄 Resultado del procesamiento:")
-                    print(json.dumps(resultado_procesado, ensure_ascii=False, indent=2))
-                
-                print(f"\n💡 Este JSON está listo para enviar a tu endpoint de BD")
-                print(f"{'='*70}\n")
+            _log_extracto(response.get("extracto_estructurado"), response.get("resultado_procesado"))
         
-        print(f"\n✅ Respuesta del agente recibida:")
-        print(f"   Longitud: {len(respuesta_texto)} caracteres")
-        print(f"   Contenido: {respuesta_texto[:200]}..." if len(respuesta_texto) > 200 else f"   Contenido: {respuesta_texto}")
+        _log.debug("✅ Respuesta del agente recibida (%s caracteres): %.200s", len(respuesta_texto), respuesta_texto)
         
         # Enviar respuesta
-        print(f"\n📤 Enviando respuesta a WhatsApp...")
-        send_whatsapp_message(from_number, respuesta_texto)
+        flush_messages(from_number, [respuesta_texto])
         
         # Actualizar historial
-        chat_history.append(HumanMessage(content=f"Archivo audio: {audio_path}"))
-        chat_history.append(AIMessage(content=respuesta_texto))
-        
-        print(f"✅ Mensaje de audio procesado correctamente")
-        print(f"{'='*70}\n")
-        
-        # Limpiar archivo temporal
-        try:
-            os.remove(audio_path)
-            print(f"🗑️  Archivo temporal eliminado: {audio_path}")
-        except Exception as cleanup_error:
-            print(f"⚠️  No se pudo eliminar archivo temporal: {cleanup_error}")
+        _agregar_turno(from_number, chat_history, f"Archivo audio: {media_id}", respuesta_texto)
     
     except Exception as e:
-        print(f"\n❌ ERROR procesando mensaje de audio: {e}")
-        import traceback
-        traceback.print_exc()
-        print(f"{'='*70}\n")
+        _log.exception("❌ ERROR procesando mensaje de audio: %s", e)
         send_whatsapp_message(
             from_number,
             "Lo siento, hubo un error procesando tu audio. Por favor, intenta de nuevo."
@@ -698,109 +1043,126 @@ def process_image_message(from_number: str, media_id: str, mime_type: str, chat_
     Procesa un mensaje de imagen.
     """
     try:
-        print(f"🖼️  Mensaje de imagen recibido de {from_number}")
+        _log.debug("🖼️  Mensaje de imagen recibido de %s", from_number)
         
-        # Descargar archivo de imagen
-        image_path = download_media(media_id, mime_type)
+        # Un formato que el agente no puede analizar se rechaza sin descargarlo
+        if mime_type not in _IMAGEN_MIME_SOPORTADOS:
+            _log.warning("⚠️  Formato de imagen no soportado: %s", mime_type)
+            send_whatsapp_message(
+                from_number,
+                "Lo siento, ese formato de imagen no es compatible. Envía una foto en JPG, PNG o WEBP."
+            )
+            return
         
-        if not image_path:
+        # Descargar archivo de imagen (si excede el tamaño máximo, no se descarga)
+        descarga = _obtener_descarga(media_id, mime_type, _MAX_BYTES_IMAGEN)
+        
+        if descarga is None:
             send_whatsapp_message(
                 from_number,
                 "Lo siento, no pude descargar la imagen. Por favor, intenta de nuevo."
             )
             return
+        image_path, tamano = descarga
+        
+        if image_path is None:
+            # Reenviar el mismo archivo no sirve: se explica el límite
+            send_whatsapp_message(
+                from_number,
+                f"Lo siento, la imagen es demasiado grande ({tamano / (1024 * 1024):.1f} MB). "
+                f"El máximo es {IMAGEN_MAX_MB} MB: envíala con menor resolución."
+            )
+            return
         
-        # Ejecutar el agente con la imagen
-        response = run_agent("", chat_history, image_path)
+        try:
+            # Ejecutar el agente con la imagen
+            response = run_agent("", chat_history, image_path)
+        finally:
+            # El archivo solo lo lee el agente: se elimina apenas termina, aunque
+            # haya fallado, y no queda en disco mientras se envía la respuesta
+            _eliminar_temporal(image_path)
         
         # Manejar respuesta estructurada o simple
         respuesta_texto = response
-        extracto_estructurado = None
         
         if isinstance(response, dict):
             respuesta_texto = response.get("respuesta", str(response))
-            extracto_estructurado = response.get("extracto_estructurado")
-            resultado_procesado = response.get("resultado_procesado")
-            
-            if extracto_estructurado:
-                print(f"\n{'='*70}")
-                print(f"📦 EXTRACTO ESTRUCTURADO - LISTO PARA INTEGRACIÓN CON BD")
-                print(f"{'='*70}")
-                print(f"✅ Acción: {extracto_estructurado.get('accion')}")
-                print(f"✅ Productos: {len(extracto_estructurado.get('productos', []))}")
-                print(f"✅ Intención: {extracto_estructurado.get('intencion')}")
-                
-                if extracto_estructurado.get('productos'):
-                    print(f"\n📋 Productos extraídos:")
-                    for idx, producto in enumerate(extracto_estructurado.get('productos', []), 1):
-                        nombre = producto.get('nombre', 'N/A')
-                        cantidad = producto.get('cantidad', 'N/A')
-                        unidad = producto.get('unidad', 'unidad')
-                        print(f"   {idx}. {nombre}: {cantidad} {unidad}")
-                
-                print(f"\n📄 JSON completo del extracto:")
-                print(json.dumps(extracto_estructurado, ensure_ascii=False, indent=2))
-                
-                if resultado_procesado:
-                    print(f"\n🔄 Resultado del procesamiento:")
-                    print(json.dumps(resultado_procesado, ensure_ascii=False, indent=2))
-                
-                print(f"\n💡 Este JSON está listo para enviar a tu endpoint de BD")
-                print(f"{'='*70}\n")
+            _log_extracto(response.get("extracto_estructurado"), response.get("resultado_procesado"))
         
         # Enviar respuesta
-        send_whatsapp_message(from_number, respuesta_texto)
+        flush_messages(from_number, [respuesta_texto])
         
-        # Actualizar historial
-        chat_history.append(HumanMessage(content=f"Archivo imagen: {image_path}"))
-        chat_history.append(AIMessage(content=respuesta_texto))
-        
-        # Limpiar archivo temporal
-        try:
-            os.remove(image_path)
-        except:
-            pass
+        # Actualizar historial. La imagen se referencia por su ID de WhatsApp: la
+        # ruta temporal ya no existe y el agente no debe intentar volver a leerla
+        _agregar_turno(from_number, chat_history, f"Archivo imagen: {media_id}", respuesta_texto)
     
     except Exception as e:
-        print(f"❌ Error procesando mensaje de imagen: {e}")
-        import traceback
-        traceback.print_exc()
+        _log.exception("❌ Error procesando mensaje de imagen: %s", e)
         send_whatsapp_message(
             from_number,
             "Lo siento, hubo un error procesando tu imagen. Por favor, intenta de nuevo."
         )
 
 
+# ============================================================================
+# WORKERS DE WEBHOOKS
+# ============================================================================
+# Payloads recibidos y pendientes de procesar. Para escalar horizontalmente o no
+# perder trabajo al reiniciar, reemplazar por una cola persistente (ej: RQ + Redis)
+WORK_Q = Queue()
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+
+
+def _webhook_worker():
+    """Procesa payloads de `WORK_Q` indefinidamente."""
+    while True:
+        payload = WORK_Q.get()
+        try:
+            _process_payload(payload)
+        except Exception as e:
+            # `_process_payload` ya maneja sus errores; esto solo protege al worker
+            _log.exception("❌ Error inesperado en worker de webhooks: %s", e)
+        finally:
+            WORK_Q.task_done()
+
+
+for _i in range(WEBHOOK_WORKERS):
+    threading.Thread(target=_webhook_worker, name=f"webhook-worker-{_i}", daemon=True).start()
+threading.Thread(target=_barrer_descargas_vencidas, name="barredor-descargas", daemon=True).start()
+
+
 if __name__ == "__main__":
-    # Verificar configuración
-    if not WHATSAPP_TOKEN:
-        print("⚠️  Advertencia: WHATSAPP_TOKEN no configurado")
-    if not WHATSAPP_PHONE_NUMBER_ID:
-        print("⚠️  Advertencia: WHATSAPP_PHONE_NUMBER_ID no configurado")
+    # La falta de credenciales ya se reportó al importar (ENVIO_CONFIGURADO)
     
     # Puerto configurable (por defecto 5001 para evitar conflicto con AirPlay en macOS)
     PORT = int(os.getenv("FLASK_PORT", 5001))
     
-    print("🚀 Iniciando servidor de WhatsApp...")
-    print(f"📡 Webhook URL: https://tu-dominio.com/webhook")
-    print(f"🔐 Verify Token: {WHATSAPP_VERIFY_TOKEN}")
-    print(f"🌐 Puerto: {PORT}")
-    print(f"\n🔍 Endpoints disponibles:")
-    print(f"   - POST /webhook (webhook principal de WhatsApp)")
-    print(f"   - GET/POST /debug (endpoint de debug para ver datos)")
-    print(f"   - GET /stats (estadísticas de webhooks recibidos)")
-    print(f"\n💡 Para desarrollo local, usa ngrok:")
-    print(f"   ngrok http {PORT}")
-    print("   Luego configura el webhook en Meta con: https://tu-url-ngrok.ngrok.io/webhook")
-    print("\n⚠️  Si el puerto está en uso, cambia FLASK_PORT en .env o desactiva AirPlay Receiver")
-    
-    # Verificar credenciales
-    print(f"\n🔑 Verificación de credenciales:")
-    print(f"   ✅ WHATSAPP_VERIFY_TOKEN: {'Configurado' if WHATSAPP_VERIFY_TOKEN else '❌ NO CONFIGURADO'}")
-    print(f"   {'✅' if WHATSAPP_TOKEN else '❌'} WHATSAPP_TOKEN: {'Configurado' if WHATSAPP_TOKEN else 'NO CONFIGURADO (necesario para enviar mensajes)'}")
-    print(f"   {'✅' if WHATSAPP_PHONE_NUMBER_ID else '❌'} WHATSAPP_PHONE_NUMBER_ID: {'Configurado' if WHATSAPP_PHONE_NUMBER_ID else 'NO CONFIGURADO (necesario para enviar mensajes)'}")
-    print(f"   {'✅' if os.getenv('OPENAI_API_KEY') else '❌'} OPENAI_API_KEY: {'Configurado' if os.getenv('OPENAI_API_KEY') else 'NO CONFIGURADO (necesario para el agente)'}")
-    
-    # Ejecutar servidor
-    app.run(host="0.0.0.0", port=PORT, debug=True)
+    # Banner de arranque y verificación de credenciales, en una sola escritura
+    print("\n".join((
+        "🚀 Iniciando servidor de WhatsApp...",
+        "📡 Webhook URL: https://tu-dominio.com/webhook",
+        f"🔐 Verify Token: {WHATSAPP_VERIFY_TOKEN}",
+        f"🌐 Puerto: {PORT}",
+        "\n🔍 Endpoints disponibles:",
+        "   - POST /webhook (webhook principal de WhatsApp)",
+        "   - GET/POST /debug (endpoint de debug para ver datos)",
+        "   - GET /stats (estadísticas de webhooks recibidos)",
+        "\n💡 Para desarrollo local, usa ngrok:",
+        f"   ngrok http {PORT}",
+        "   Luego configura el webhook en Meta con: https://tu-url-ngrok.ngrok.io/webhook",
+        "\n⚠️  Si el puerto está en uso, cambia FLASK_PORT en .env o desactiva AirPlay Receiver",
+        "\n🔑 Verificación de credenciales:",
+        f"   {'✅' if WHATSAPP_APP_SECRET else '⚠️ '} WHATSAPP_APP_SECRET: {'Configurado' if WHATSAPP_APP_SECRET else 'NO CONFIGURADO (las firmas de los webhooks no se verifican)'}",
+        f"   ✅ WHATSAPP_VERIFY_TOKEN: {'Configurado' if WHATSAPP_VERIFY_TOKEN else '❌ NO CONFIGURADO'}",
+        f"   {'✅' if WHATSAPP_TOKEN else '❌'} WHATSAPP_TOKEN: {'Configurado' if WHATSAPP_TOKEN else 'NO CONFIGURADO (necesario para enviar mensajes)'}",
+        f"   {'✅' if WHATSAPP_PHONE_NUMBER_ID else '❌'} WHATSAPP_PHONE_NUMBER_ID: {'Configurado' if WHATSAPP_PHONE_NUMBER_ID else 'NO CONFIGURADO (necesario para enviar mensajes)'}",
+        f"   {'✅' if os.getenv('OPENAI_API_KEY') else '❌'} OPENAI_API_KEY: {'Configurado' if os.getenv('OPENAI_API_KEY') else 'NO CONFIGURADO (necesario para el agente)'}",
+    )))
+    
+    # Ejecutar servidor (servidor de desarrollo; en producción usar gunicorn, ver
+    # WHATSAPP_SETUP.md). Cada request se atiende en su propio hilo, así que un
+    # webhook nunca espera a otro. El modo debug (recarga automática y debugger)
+    # solo con DEV=1: el recargador importa el módulo dos veces y arranca otra
+    # tanda de workers
+    app.run(host="0.0.0.0", port=PORT, debug=bool(os.getenv("DEV")), threaded=True)
 